@@ -0,0 +1,89 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+import requests
+
+from http_client import RETRYABLE_STATUS_CODES
+
+
+# aiohttpのレスポンスの本文を読み込み、requestsのレスポンスと同じように扱えるようにしたクラス
+class BufferedResponse:
+    # コンストラクタでステータスコード、ヘッダー、本文とリトライ回数を設定します
+    def __init__(self, status_code, headers, content, retry_count=0):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.retry_count = retry_count
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+# 常駐するサーバーで使う、イベントループで応答を待つHTTPクライアントのクラス
+# リトライ、待ち時間の計算、タイムアウトはRetryingHttpClientと同じ設定で行い、応答を待つ間はスレッドを占有しません
+class AsyncRetryingHttpClient:
+    # コンストラクタで同じ設定のRetryingHttpClientと、コネクションプールの大きさを設定します
+    def __init__(self, client, pool_size=1000, max_in_flight=0):
+        self.client = client
+        self.pool_size = pool_size
+        # 同時に送信するリクエスト数の上限です（0の場合は制限しません）
+        self.in_flight_limit = asyncio.Semaphore(max_in_flight) if max_in_flight > 0 else None
+        self.session = None
+
+    # セッションを取得します。イベントループの中で初めて必要になった時に作成します
+    def get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self.session
+
+    # POSTリクエストを送信します。429/5xxと通信エラーの場合は指数バックオフでリトライし、
+    # リトライを含めた全体がtotal_timeout（またはdeadline）を超えないようにします。ヘッジとストリーミングは行いません
+    # 呼び出し側が同期のクライアントと同じように扱えるよう、通信エラーはrequestsの例外として送出します
+    async def post(self, url, headers=None, json=None, deadline=None):
+        if deadline is None:
+            deadline = time.monotonic() + self.client.total_timeout
+        retry_count = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.Timeout(f"Exceeded the total timeout of {self.client.total_timeout} seconds")
+            try:
+                response = await self.send(url, headers, json, remaining)
+                delay = self.client.get_retry_delay(retry_count, response)
+                if (response.status_code not in RETRYABLE_STATUS_CODES or retry_count >= self.client.max_retries
+                        or time.monotonic() + delay >= deadline):
+                    response.retry_count = retry_count
+                    return response
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = self.client.get_retry_delay(retry_count, None)
+                if retry_count >= self.client.max_retries or time.monotonic() + delay >= deadline:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise requests.Timeout(str(e)) from e
+                    raise requests.ConnectionError(str(e)) from e
+            retry_count += 1
+            await asyncio.sleep(delay)
+
+    # 1回分のリクエストを送信し、本文を読み込んだレスポンスを返します
+    async def send(self, url, headers, json, remaining):
+        timeout = aiohttp.ClientTimeout(total=min(self.client.connect_timeout + self.client.read_timeout, remaining),
+                                        connect=min(self.client.connect_timeout, remaining))
+        if self.in_flight_limit is None:
+            return await self.request(url, headers, json, timeout)
+        async with self.in_flight_limit:
+            return await self.request(url, headers, json, timeout)
+
+    async def request(self, url, headers, json, timeout):
+        async with self.get_session().post(url, headers=headers, json=json, timeout=timeout) as response:
+            return BufferedResponse(response.status, response.headers, await response.read())
+
+    # セッションを閉じます
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
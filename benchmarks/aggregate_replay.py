@@ -0,0 +1,216 @@
+# 会話のシナリオを流した時のユーザーとログのテーブルの変更（DynamoDB Streams）を記録し、usage_aggregates.pyに再生して
+# 集計がテーブルをScanして数えた値と一致することを確認します。同じバッチの再試行やバッチの大きさの違いでも結果が変わらないことも確認します
+# 実行方法: python benchmarks/aggregate_replay.py [--users N] [--record 保存先.jsonl]
+#           python benchmarks/aggregate_replay.py --replay 記録したレコード.jsonl
+import argparse
+import base64
+import collections
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fakes import FAKE_ENV, FakeOpenAIServer, LineRecorder, build_message_event, create_tables
+
+AGGREGATE_TABLE_NAME = 'usage_aggregates'
+# 1日の利用上限を超えるまでメッセージを送るシナリオです
+LIMIT_SCENARIO = ('limit', 1, ['【モード:フリートーク】'] + [f'I like sport number {index}.' for index in range(8)])
+
+
+# 環境変数を設定し、変更を記録するテーブルと外部サービスの代わりを用意してからlambda_functionを読み込みます
+def setup():
+    os.environ.update(FAKE_ENV)
+    os.environ.setdefault('TRACE_OUTPUT', 'off')
+    server = FakeOpenAIServer(latency=0.05, jitter=0.01).start()
+    os.environ['OPENAI_API_URL'] = server.url
+
+    from moto import mock_aws
+    mock = mock_aws()
+    mock.start()
+    create_tables(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'], stream=True)
+
+    import boto3
+    boto3.client('dynamodb').create_table(
+        TableName=AGGREGATE_TABLE_NAME,
+        KeySchema=[{'AttributeName': 'aggregate_key', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'aggregate_key', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+    import lambda_function
+    import line_handler
+    line_handler.LINE_BOT_API = LineRecorder()
+    return lambda_function, mock
+
+
+# 1人のユーザーとしてシナリオのメッセージを1件ずつ送信します
+def run_user(lambda_function, scenario, user_index, rng):
+    from end_to_end import SENTENCES
+    name, _, messages = scenario
+    user_id = f'U{name}-{user_index}'
+    for message_index, text in enumerate(messages):
+        event = build_message_event(f'{user_id}-{message_index}', user_id, text.format(sentence=rng.choice(SENTENCES)))
+        lambda_function.lambda_handler({'body': json.dumps({'events': [event]})}, None)
+
+
+# LambdaのイベントではバイナリがBase64の文字列になるため、記録するレコードも同じ形式にします
+def to_lambda_value(value):
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    if isinstance(value, dict):
+        return {key: to_lambda_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_lambda_value(item) for item in value]
+    return value
+
+
+# テーブルのStreamsのレコードをすべて読み込み、Lambdaのイベントと同じ形式で返します
+def read_stream(table_name):
+    import boto3
+    stream_arn = boto3.client('dynamodb').describe_table(TableName=table_name)['Table']['LatestStreamArn']
+    streams = boto3.client('dynamodbstreams')
+    records = []
+    for shard in streams.describe_stream(StreamArn=stream_arn)['StreamDescription']['Shards']:
+        iterator = streams.get_shard_iterator(StreamArn=stream_arn, ShardId=shard['ShardId'],
+                                              ShardIteratorType='TRIM_HORIZON')['ShardIterator']
+        while iterator:
+            response = streams.get_records(ShardIterator=iterator, Limit=1000)
+            if not response['Records']:
+                break
+            records += [to_lambda_value(dict(record, eventSourceARN=stream_arn)) for record in response['Records']]
+            iterator = response.get('NextShardIterator')
+    return records
+
+
+# ユーザーとログのテーブルをScanし、集計と同じ名前のカウンタを数えます（モードごとのAPIの利用回数は現在の状態から分からないため除きます）
+def count_by_scan():
+    from dynamodb_handler import DAILY_API_LIMIT, get_dynamodb_resource
+    from usage_aggregates import add_log_counts
+    dynamodb = get_dynamodb_resource()
+    counters = collections.defaultdict(collections.Counter)
+    # 利用したユーザー数は、ログのあるユーザーを利用日ごとに数えます
+    user_days = set()
+    for item in scan_all(dynamodb.Table(FAKE_ENV['LOG_TABLE_NAME'])):
+        add_log_counts(counters, user_days, item)
+    for usage_date, name, _ in user_days:
+        counters[usage_date][name] += 1
+    for item in scan_all(dynamodb.Table(FAKE_ENV['USER_TABLE_NAME'])):
+        api_count = int(item.get('api_count_total', 0))
+        counts = counters[item['last_used_date']]
+        counts['api_calls'] += api_count
+        counts['limit_reached_users'] += 1 if api_count >= DAILY_API_LIMIT else 0
+    return {usage_date: {name: value for name, value in counts.items() if value} for usage_date, counts in counters.items()}
+
+
+def scan_all(table):
+    arguments = {}
+    while True:
+        response = table.scan(**arguments)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# 集計のうち、Scanで数えられるカウンタだけを返します
+def comparable(counts):
+    return {name: value for name, value in counts.items() if value and not name.endswith('_api_calls')}
+
+
+# 集計の項目がScanで数えた値と一致するか確認し、一致しない利用日のリストを返します
+def find_mismatches(store, expected):
+    mismatches = []
+    for usage_date, counts in expected.items():
+        actual = comparable(store.get_day(usage_date))
+        if actual != comparable(counts):
+            mismatches.append((usage_date, actual, comparable(counts)))
+    return mismatches
+
+
+# レコードを再生し、再試行とバッチの大きさを変えた場合も含めて集計を確認します
+def check_replay(records, expected):
+    from usage_aggregates import DynamoDBAggregateStore, InMemoryAggregateStore, replay, summarize_day
+
+    store = DynamoDBAggregateStore(AGGREGATE_TABLE_NAME)
+    started_at = time.perf_counter()
+    batches = replay(records, store, batch_size=100)
+    elapsed = time.perf_counter() - started_at
+    print(f"replay            : {len(records)} records in {batches} batches, {len(records) / elapsed:.0f} records/s")
+    # Lambdaが同じバッチを再試行した場合を再現します
+    retried = replay(records, store, batch_size=100)
+    print(f"retried batches   : {retried} applied again (expected 0)")
+    # バッチの区切りが変わっても同じ集計になることを確認します
+    small_batches = InMemoryAggregateStore()
+    replay(records, small_batches, batch_size=7)
+
+    failures = []
+    for name, checked_store in [('batch_size=100 + retry', store), ('batch_size=7', small_batches)]:
+        for usage_date, actual, wanted in find_mismatches(checked_store, expected):
+            failures.append(name)
+            print(f"MISMATCH {name} {usage_date}: aggregate={actual} scan={wanted}")
+    if retried:
+        failures.append('retry')
+
+    for usage_date in sorted(expected):
+        # ダッシュボードは利用日の項目を1回読み込むだけで表示できます
+        summary = summarize_day(store.get_day(usage_date))
+        print(f"dashboard {usage_date}: {json.dumps({key: value for key, value in summary.items() if key != 'modes'})}")
+        for mode, mode_summary in summary['modes'].items():
+            print(f"  mode {mode:>2}: messages={mode_summary['messages']} api_calls={mode_summary['api_calls']} "
+                  f"latency mean={mode_summary['latency_mean_ms']}ms p50<={mode_summary['latency_p50_ms']}ms "
+                  f"p95<={mode_summary['latency_p95_ms']}ms")
+    print(f"result            : {'OK' if not failures else 'FAILED'}")
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2, help='シナリオごとのユーザー数')
+    parser.add_argument('--record', help='記録したレコードと、Scanで数えた値を保存するファイル')
+    parser.add_argument('--replay', help='記録したレコードのファイル。会話を流さずに再生だけを行います')
+    args = parser.parse_args()
+
+    lambda_function, mock = setup()
+    try:
+        if args.replay:
+            from usage_aggregates import load_recorded_records
+            records = load_recorded_records(args.replay)
+            with open(args.replay + '.expected.json', encoding='utf-8') as file:
+                expected = json.load(file)
+        else:
+            from end_to_end import SCENARIOS
+            rng = random.Random(0)
+            jobs = [(scenario, user_index, random.Random(rng.random()))
+                    for user_index in range(args.users) for scenario in SCENARIOS + [LIMIT_SCENARIO]]
+            # 処理中に出力されるメトリクスのログは捨てます
+            with contextlib.redirect_stdout(io.StringIO()):
+                with ThreadPoolExecutor(8) as executor:
+                    list(executor.map(lambda job: run_user(lambda_function, *job), jobs))
+            records = read_stream(FAKE_ENV['USER_TABLE_NAME']) + read_stream(FAKE_ENV['LOG_TABLE_NAME'])
+            expected = count_by_scan()
+            print(f"recorded          : {len(records)} stream records from {len(jobs)} conversations")
+            if args.record:
+                with open(args.record, 'w', encoding='utf-8') as file:
+                    for record in records:
+                        file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                with open(args.record + '.expected.json', 'w', encoding='utf-8') as file:
+                    json.dump(expected, file, ensure_ascii=False, indent=2)
+        succeeded = check_replay(records, expected)
+    finally:
+        mock.stop()
+    sys.exit(0 if succeeded else 1)
+
+
+if __name__ == '__main__':
+    main()
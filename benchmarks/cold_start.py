@@ -0,0 +1,59 @@
+# コールドスタート時のモジュール読み込み時間と、呼び出しごとのハンドラ準備時間を計測します
+# 実行方法: python benchmarks/cold_start.py [表示するモジュール数]
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# 計測用のダミーの環境変数です（外部サービスには接続しません）
+ENV = dict(
+    os.environ,
+    USER_TABLE_NAME='users',
+    LOG_TABLE_NAME='logs',
+    LINE_CHANNEL_ACCESS_TOKEN='dummy',
+    OPENAI_API_KEY='dummy',
+    AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'ap-northeast-1'),
+)
+
+SETUP_SCRIPT = '''
+import time
+started_at = time.perf_counter()
+import lambda_function
+imported_at = time.perf_counter()
+lambda_function.get_handlers()
+cold_at = time.perf_counter()
+lambda_function.get_handlers()
+warm_at = time.perf_counter()
+print(f"import lambda_function : {(imported_at - started_at) * 1000:8.1f} ms")
+print(f"handler setup (cold)   : {(cold_at - imported_at) * 1000:8.1f} ms")
+print(f"handler setup (warm)   : {(warm_at - cold_at) * 1000:8.3f} ms")
+'''
+
+
+# -X importtimeの出力から、累積時間の大きいモジュールを表示します
+def report_import_time(limit):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import lambda_function; lambda_function.get_handlers()'],
+        cwd=ROOT, env=ENV, capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.split('|', 1)[0].split(':', 1) + line.split('|')[1:]]
+        rows.append((int(cumulative_us), int(self_us), name))
+    print(f"{'cumulative(ms)':>14} {'self(ms)':>9}  module")
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:limit]:
+        print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {name}")
+
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    report_import_time(limit)
+    print()
+    subprocess.run([sys.executable, '-c', SETUP_SCRIPT], cwd=ROOT, env=ENV, check=True)
+
+
+if __name__ == '__main__':
+    main()
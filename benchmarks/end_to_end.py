@@ -0,0 +1,232 @@
+# 合成したWebhookのイベントをlambda_function.lambda_handlerに流し、モードごとの応答時間と
+# 段階ごとの時間（p50/p95/p99）、アロケーション、外部サービスの呼び出し回数を計測します
+# LINE、OpenAI、DynamoDBはfakes.pyとmotoの代わりを使うため、料金は掛かりません
+# 実行方法: python benchmarks/end_to_end.py [--users N] [--concurrency N] [--openai-latency 秒] [--save-baseline | --check]
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fakes import FAKE_ENV, FakeOpenAIServer, LineRecorder, build_message_event, create_tables
+
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baselines', 'end_to_end.json')
+
+# シナリオ（名前、モードコード、送信するメッセージ）です。完了と分からないの操作も含めます
+SCENARIOS = [
+    # モードを選ばずに自由に送った文章です（モードコード0）
+    ('chat', 0, ['Hello there.', 'How are you?', 'Could you tell me a fun fact?']),
+    ('free_talk', 1, ['【モード:フリートーク】', 'I like soccer.', 'I play it every weekend.', "I don't know.", '【フリートーク:完了】']),
+    ('correction', 2, ['【モード:英文添削】', '{sentence}', '{sentence}', '【英文添削:完了】']),
+    ('presentation', 3, ['【モード:発表練習】', 'I studied machine learning at university.', 'Because it is useful.',
+                         '【発表練習:分からない】', 'It was the math.', 'I want to be an engineer.', '【発表練習:完了】']),
+]
+LECTURE_TOPIC_NAMES = ['日常生活', '気持ち', '天気', '観光', 'レストラン', 'ショッピング', '学校', 'スポーツ', '恋愛', 'ビジネス', '電話', '会議']
+for topic_index, topic_name in enumerate(LECTURE_TOPIC_NAMES):
+    SCENARIOS.append((f'lecture_{topic_index + 5}', topic_index + 5,
+                      ['【モード:会話フレーズ講義】', f'【モード:{topic_name}】', '【会話フレーズ講義:完了】']))
+# 英文添削で送る英文です。同じ英文も送られるようにして、キャッシュの効果も含めて計測します
+SENTENCES = ['I has a pen.', 'She go to school yesterday.', 'He don\'t like apples.', 'We was happy.', 'They is students.']
+
+# 回帰とみなす、ベースラインからの全メッセージの応答時間（p50/p95）の増加率です
+LATENCY_TOLERANCE = 0.5
+# 回帰とみなす、メッセージ1件あたりの外部サービスの呼び出し回数の増加率です
+# 英文添削のキャッシュのヒット数はスレッドの実行順で少し変わるため、わずかな差は許容します
+CALL_COUNT_TOLERANCE = 0.05
+
+
+# 値のリストから百分位数を返します
+def percentile(values, ratio):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 0.50), 3),
+        'p95': round(percentile(values, 0.95), 3),
+        'p99': round(percentile(values, 0.99), 3),
+    }
+
+
+# 環境変数を設定し、外部サービスの代わりを用意してからlambda_functionを読み込みます
+def setup(openai_latency, line_latency):
+    os.environ.update(FAKE_ENV)
+    os.environ.setdefault('TRACE_OUTPUT', 'off')
+    server = FakeOpenAIServer(latency=openai_latency, jitter=openai_latency / 5).start()
+    os.environ['OPENAI_API_URL'] = server.url
+
+    from moto import mock_aws
+    mock = mock_aws()
+    mock.start()
+    create_tables(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+
+    import lambda_function
+    import line_handler
+    recorder = LineRecorder(latency=line_latency)
+    line_handler.LINE_BOT_API = recorder
+    return lambda_function, server, recorder, mock
+
+
+# 1人のユーザーとしてシナリオのメッセージを1件ずつ送信し、呼び出しごとの応答時間を返します
+def run_user(lambda_function, scenario, user_index, rng):
+    name, mode_code, messages = scenario
+    user_id = f'U{name}-{user_index}'
+    latencies = []
+    for message_index, text in enumerate(messages):
+        text = text.format(sentence=rng.choice(SENTENCES))
+        event = build_message_event(f'{user_id}-{message_index}', user_id, text)
+        started_at = time.perf_counter()
+        lambda_function.lambda_handler({'body': json.dumps({'events': [event]})}, None)
+        latencies.append((time.perf_counter() - started_at) * 1000)
+    return name, latencies
+
+
+# すべてのシナリオを指定したユーザー数で実行し、結果を集計します
+def run(lambda_function, server, recorder, users, concurrency, seed):
+    from dynamodb_handler import DYNAMODB_CALL_COUNTER
+    from tracing import TRACE_LISTENERS
+
+    stage_durations = collections.defaultdict(lambda: collections.defaultdict(list))
+    stage_lock = threading.Lock()
+
+    # トレースから、モードごと・段階ごとの時間を集めます
+    def collect(trace):
+        with stage_lock:
+            stages = stage_durations[str(trace.attributes.get('mode_code'))]
+            stages['total'].append(trace.duration_ms)
+            for stage, duration_ms in trace.breakdown().items():
+                stages[stage].append(duration_ms)
+
+    TRACE_LISTENERS.append(collect)
+    rng = random.Random(seed)
+    jobs = [(scenario, user_index, random.Random(rng.random())) for user_index in range(users) for scenario in SCENARIOS]
+    dynamodb_calls_before = sum(DYNAMODB_CALL_COUNTER.values())
+    openai_requests_before = server.request_count
+
+    started_at = time.perf_counter()
+    invocation_latencies = collections.defaultdict(list)
+    # 処理中に出力されるメトリクスのログは集計の邪魔になるため捨てます
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(concurrency) as executor:
+            for name, latencies in executor.map(lambda job: run_user(lambda_function, *job), jobs):
+                invocation_latencies[name].extend(latencies)
+        # 返信の後に行うジョブの呼び出しも数えるため、完了を待ちます
+        lambda_function.wait_for_follow_up_jobs()
+    elapsed = time.perf_counter() - started_at
+    TRACE_LISTENERS.remove(collect)
+
+    invocation_latencies['all'] = [latency for latencies in list(invocation_latencies.values()) for latency in latencies]
+    message_count = len(invocation_latencies['all'])
+    return {
+        'messages': message_count,
+        'throughput_per_second': round(message_count / elapsed, 1),
+        'per_message': {
+            'openai_requests': round((server.request_count - openai_requests_before) / message_count, 3),
+            'dynamodb_calls': round((sum(DYNAMODB_CALL_COUNTER.values()) - dynamodb_calls_before) / message_count, 3),
+            'line_messages': round(len(recorder.messages) / message_count, 3),
+        },
+        'invocation_ms': {name: summarize(latencies) for name, latencies in sorted(invocation_latencies.items())},
+        'stage_ms': {
+            mode_code: {stage: summarize(durations) for stage, durations in sorted(stages.items())}
+            for mode_code, stages in sorted(stage_durations.items(), key=lambda entry: int(entry[0]) if entry[0].isdigit() else -1)
+        },
+    }
+
+
+# 1人分のシナリオをtracemallocで計測し、メッセージ1件あたりの確保ブロック数とピークのメモリを返します
+def measure_allocations(lambda_function):
+    allocations = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for scenario in SCENARIOS[:4]:
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            _, latencies = run_user(lambda_function, scenario, 'alloc', random.Random(0))
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+            allocations[scenario[0]] = {
+                'retained_blocks_per_message': round(blocks / len(latencies), 1),
+                'peak_kib': round(peak / 1024, 1),
+            }
+    return allocations
+
+
+# ベースラインと比較し、回帰の一覧を返します
+def compare_with_baseline(result, baseline):
+    regressions = []
+    for name, value in baseline['per_message'].items():
+        if result['per_message'][name] > value * (1 + CALL_COUNT_TOLERANCE):
+            regressions.append(f"per_message.{name}: {value} -> {result['per_message'][name]}")
+    # シナリオごとの件数は少なくばらつきが大きいため、全メッセージの応答時間で比較します
+    for name in ('p50', 'p95'):
+        expected = baseline['invocation_ms']['all'][name]
+        actual = result['invocation_ms']['all'][name]
+        if actual > expected * (1 + LATENCY_TOLERANCE):
+            regressions.append(f"invocation_ms.all.{name}: {expected} -> {actual}")
+    return regressions
+
+
+def print_report(result):
+    print(f"messages: {result['messages']}, throughput: {result['throughput_per_second']} msg/s")
+    print("per message: " + ", ".join(f"{name} {value}" for name, value in result['per_message'].items()))
+    print(f"\n{'scenario':<14}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in result['invocation_ms'].items():
+        print(f"{name:<14}{stats['count']:>7}{stats['p50']:>10.1f}{stats['p95']:>10.1f}{stats['p99']:>10.1f}")
+    for mode_code, stages in result['stage_ms'].items():
+        print(f"\nmode {mode_code}")
+        for stage, stats in stages.items():
+            print(f"  {stage:<32}{stats['count']:>7}{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['p99']:>10.2f}")
+    print(f"\n{'allocations':<14}{'blocks/msg':>12}{'peak KiB':>10}")
+    for name, stats in result['allocations'].items():
+        print(f"{name:<14}{stats['retained_blocks_per_message']:>12}{stats['peak_kib']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10, help='シナリオごとのユーザー数')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--openai-latency', type=float, default=0.05)
+    parser.add_argument('--line-latency', type=float, default=0.005)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', action='store_true', help='結果をベースラインとして保存します')
+    parser.add_argument('--check', action='store_true', help='ベースラインより悪化した場合は終了コード1で終了します')
+    args = parser.parse_args()
+
+    lambda_function, server, recorder, mock = setup(args.openai_latency, args.line_latency)
+    try:
+        result = run(lambda_function, server, recorder, args.users, args.concurrency, args.seed)
+        result['allocations'] = measure_allocations(lambda_function)
+    finally:
+        mock.stop()
+        server.stop()
+    print_report(result)
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w') as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+        print(f"\nbaseline saved to {os.path.relpath(BASELINE_PATH)}")
+    elif args.check:
+        with open(BASELINE_PATH) as file:
+            regressions = compare_with_baseline(result, json.load(file))
+        if regressions:
+            print("\nREGRESSION:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("\nno regression against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+# ベンチマークで使う外部サービスの代わりです。実際のLINE、OpenAI、DynamoDBには接続しません
+import collections
+import json
+import multiprocessing
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 計測用のダミーの環境変数です
+FAKE_ENV = {
+    'USER_TABLE_NAME': 'users',
+    'LOG_TABLE_NAME': 'logs',
+    'LINE_CHANNEL_ACCESS_TOKEN': 'dummy',
+    'OPENAI_API_KEY': 'dummy',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'dummy',
+    'AWS_SECRET_ACCESS_KEY': 'dummy',
+}
+
+FAKE_ANSWER = (
+    "That sounds interesting! I also enjoy talking about that topic. "
+    "Could you tell me more about why you like it and how you first got into it?"
+)
+
+
+# 多数の同時接続を受け付けられるよう、待ち行列を長くしたHTTPサーバーです
+class BacklogHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+# 決められた遅延の後にChat Completions APIと同じ形式で応答するHTTPサーバーです
+# リトライやヘッジの動作を確かめるため、エラーの応答や応答の停止を差し込めます
+class FakeOpenAIServer:
+    # コンストラクタで遅延（秒）とそのばらつき（秒）、エラーを返す割合、停止する秒数を設定します
+    # slow_promptsには、最後のメッセージに含まれる文字列ごとに、通常の遅延の代わりに使う遅延（秒）を指定します
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, stall_seconds=5.0, slow_prompts=None):
+        self.latency = latency
+        self.slow_prompts = slow_prompts or {}
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.stall_seconds = stall_seconds
+        # 次のリクエストから順に差し込む障害です（'429'などのステータスコード、または応答を止める'stall'）
+        self.faults = collections.deque()
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self.server = BacklogHTTPServer(('127.0.0.1', 0), self.build_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # 次のリクエストから順に障害を差し込みます
+    def inject(self, *faults):
+        with self.lock:
+            self.faults.extend(faults)
+
+    # リクエストに差し込む障害を返します。障害がない場合はNoneを返します
+    def next_fault(self):
+        with self.lock:
+            if self.faults:
+                return self.faults.popleft()
+        if self.error_rate and random.random() < self.error_rate:
+            return random.choice(['429', '500', '503'])
+        return None
+
+    # リクエストの内容に合わせた遅延（秒）を返します
+    def get_latency(self, data):
+        prompt = data['messages'][-1]['content']
+        latency = next((seconds for text, seconds in self.slow_prompts.items() if text in prompt), self.latency)
+        return max(0.0, latency + random.uniform(-self.jitter, self.jitter))
+
+    # リクエストの内容に合わせた応答のテキストを作成します
+    def build_content(self, data):
+        prompt = data['messages'][-1]['content']
+        if '#出力形式' in prompt:
+            # 発表練習の質問をまとめて生成するリクエストにはJSONで応答します
+            return json.dumps({'questions': [
+                {'question': f'What made you choose this topic ({index})?', 'alternate': f'What was the hardest part ({index})?'}
+                for index in range(1, 4)
+            ]})
+        return FAKE_ANSWER
+
+    def build_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with fake.lock:
+                    fake.request_count += 1
+                fault = fake.next_fault()
+                if fault == 'stall':
+                    time.sleep(fake.stall_seconds)
+                elif fault is not None:
+                    self.send_error_status(int(fault))
+                    return
+                time.sleep(fake.get_latency(data))
+                content = fake.build_content(data)
+                usage = {'prompt_tokens': sum(len(m['content']) for m in data['messages']) // 4,
+                         'completion_tokens': len(content) // 4}
+                if data.get('stream'):
+                    events = [{'model': data['model'], 'choices': [{'delta': {'content': piece + ' '}}]}
+                              for piece in content.split(' ')]
+                    # stream_optionsでinclude_usageを指定した場合は、OpenAIと同じく最後にトークン数だけのイベントを送ります
+                    if data.get('stream_options', {}).get('include_usage'):
+                        events.append({'model': data['model'], 'choices': [], 'usage': usage})
+                    body = ''.join('data: ' + json.dumps(event) + '\n\n' for event in events) + 'data: [DONE]\n\n'
+                    self.send_body(body.encode('utf-8'), 'text/event-stream')
+                    return
+                body = json.dumps({
+                    'model': data['model'],
+                    'choices': [{'message': {'role': 'assistant', 'content': content}}],
+                    'usage': usage
+                })
+                self.send_body(body.encode('utf-8'), 'application/json')
+
+            # 429の場合はOpenAIと同じくRetry-Afterを付けて応答します
+            def send_error_status(self, status_code):
+                body = json.dumps({'error': {'message': f'injected {status_code}'}}).encode('utf-8')
+                self.send_response(status_code)
+                if status_code == 429:
+                    self.send_header('Retry-After', '0')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_body(self, body, content_type):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# FakeOpenAIServerを別のプロセスで起動し、プロセスとURLを返します
+# 計測するプロセスのCPUを使わないため、多数の同時リクエストを送るベンチマークで使います
+def start_fake_openai_process(latency=0.05, jitter=0.0):
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_fake_openai, args=(latency, jitter, urls), daemon=True)
+    process.start()
+    return process, urls.get()
+
+
+def serve_fake_openai(latency, jitter, urls):
+    server = FakeOpenAIServer(latency=latency, jitter=jitter)
+    urls.put(server.url)
+    server.server.serve_forever()
+
+
+# LINE Bot APIの代わりに送信したメッセージを記録します
+class LineRecorder:
+    # コンストラクタで送信1回あたりの遅延（秒）を設定します
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def reply_message(self, reply_token, messages):
+        self.record('reply', reply_token, messages)
+
+    def push_message(self, user_id, messages):
+        self.record('push', user_id, messages)
+
+    def record(self, kind, target, messages):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.messages.append((kind, target, messages))
+
+
+# motoで作成したDynamoDBにユーザーとログのテーブルを作成します。mock_awsを開始した後に呼び出します
+# streamを指定すると、変更前後の項目を含むDynamoDB Streamsを有効にします
+def create_tables(user_table_name='users', log_table_name='logs', stream=False):
+    import boto3
+    client = boto3.client('dynamodb')
+    stream_arguments = {'StreamSpecification': {'StreamEnabled': True, 'StreamViewType': 'NEW_AND_OLD_IMAGES'}} if stream else {}
+    client.create_table(
+        TableName=user_table_name,
+        KeySchema=[{'AttributeName': 'line_user_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'line_user_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+        **stream_arguments
+    )
+    client.create_table(
+        TableName=log_table_name,
+        KeySchema=[{'AttributeName': 'line_user_id', 'KeyType': 'HASH'}, {'AttributeName': 'created_at', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'line_user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'created_at', 'AttributeType': 'S'},
+            {'AttributeName': 'session_id', 'AttributeType': 'S'},
+            {'AttributeName': 'log_date_shard', 'AttributeType': 'S'},
+        ],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'session_id-created_at-index',
+            'KeySchema': [{'AttributeName': 'session_id', 'KeyType': 'HASH'}, {'AttributeName': 'created_at', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'}
+        }, {
+            'IndexName': 'log_date_shard-created_at-index',
+            'KeySchema': [{'AttributeName': 'log_date_shard', 'KeyType': 'HASH'}, {'AttributeName': 'created_at', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'}
+        }],
+        BillingMode='PAY_PER_REQUEST',
+        **stream_arguments
+    )
+
+
+# LINEのWebhookと同じ形式のメッセージイベントを作成します
+def build_message_event(event_id, user_id, text):
+    return {
+        'type': 'message',
+        'webhookEventId': event_id,
+        'timestamp': int(time.time() * 1000),
+        'replyToken': f'reply-{event_id}',
+        'source': {'type': 'user', 'userId': user_id},
+        'message': {'type': 'text', 'text': text},
+    }
@@ -0,0 +1,109 @@
+# ログの長いテキストを圧縮した場合の、保存サイズと読み書きのキャパシティユニットの削減量を計測します
+# 実行方法: python benchmarks/log_compression.py [ログの件数]
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from log_codec import encode_log_item
+from mode_registry import LECTURE_TOPICS
+
+FEEDBACK_SENTENCES = [
+    "今回の会話では、自分の経験を具体的な例とともに説明できていた点がとても良かったです。",
+    "例えば「I went to Kyoto with my family last summer.」という文は、時制も正しく自然な英語でした。",
+    "一方で、「I have been to there.」のように前置詞の使い方に誤りが見られました。正しくは「I have been there.」です。",
+    "質問に答える際に、理由を「because」でつなげて説明できていたのは素晴らしいです。",
+    "語彙の幅を広げるために、「good」や「nice」以外の形容詞も使ってみましょう。",
+    "文の最初に「So」や「Well」を使うことで、会話がより自然になります。",
+    "全体として積極的に会話を続けようとする姿勢が伝わってきました。",
+]
+LECTURE_SENTENCES = [
+    "【フレーズ】\nCould you give me a hand?\n\n「手を貸してもらえますか？」という意味で、手伝いをお願いするときに使います。",
+    "【例文】\nA: Could you give me a hand with these boxes?\nB: Sure, where do you want them?",
+    "【練習】\nあなたは引っ越しの準備をしています。友達に荷物を運ぶのを手伝ってもらいましょう。",
+    "カジュアルな場面では「Can you help me out?」も同じ意味でよく使われます。",
+    "丁寧に頼みたい場合は「Would you mind helping me?」と言うこともできます。",
+]
+USER_SENTENCES = [
+    "I went to the park yesterday and played soccer with my friends.",
+    "I think studying English is important for my future career.",
+    "My favorite food is sushi because it is fresh and delicious.",
+    "I don't know.",
+]
+
+
+# 会話フレーズ講義、フィードバック、通常の会話が混ざった現実的なログを作成します
+def build_sample_logs(count, seed=0):
+    rng = random.Random(seed)
+    logs = []
+    for index in range(count):
+        kind = rng.random()
+        if kind < 0.2:
+            mode_code = rng.choice(list(LECTURE_TOPICS))
+            user_message = f"【モード:{LECTURE_TOPICS[mode_code]}】"
+            ai_response = "\n\n".join(rng.choice(LECTURE_SENTENCES) for _ in range(rng.randint(8, 16)))
+        elif kind < 0.35:
+            mode_code = 0
+            user_message = "【フリートーク:完了】"
+            ai_response = "今回の会話を通してのあなたへのフィードバックを行います。\n\nよかった点\n" + "\n".join(
+                rng.choice(FEEDBACK_SENTENCES) for _ in range(rng.randint(10, 24))) + "\n\n以上になります！ありがとうございました！"
+        elif kind < 0.45:
+            mode_code = 3
+            user_message = " ".join(rng.choice(USER_SENTENCES) for _ in range(rng.randint(20, 60)))
+            ai_response = "Q1: What motivated you to choose this topic for your presentation?"
+        else:
+            mode_code = rng.choice([1, 2])
+            user_message = rng.choice(USER_SENTENCES)
+            ai_response = " ".join(rng.choice(USER_SENTENCES) for _ in range(rng.randint(2, 6))) + " 😊"
+        logs.append({
+            'line_user_id': f'U{index % 100:032x}',
+            'user_message': user_message,
+            'ai_response': ai_response,
+            'mode_code': mode_code,
+            'created_at': f'2024-01-01 00:{index // 60 % 60:02d}:{index % 60:02d}',
+            'session_id': f'{index // 10:032x}',
+        })
+    return logs
+
+
+# DynamoDBの項目サイズの計算方法に従って、項目のバイト数を概算します
+def item_size(item):
+    size = 0
+    for name, value in item.items():
+        size += len(name.encode('utf-8'))
+        if isinstance(value, str):
+            size += len(value.encode('utf-8'))
+        elif isinstance(value, bytes):
+            size += len(value)
+        elif isinstance(value, (int, float)):
+            size += len(str(value)) // 2 + 1
+        elif isinstance(value, list):
+            size += 3 + sum(1 + len(element.encode('utf-8')) for element in value)
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    logs = build_sample_logs(count)
+    totals = {}
+    for label, items in (('plain', logs), ('compressed', [encode_log_item(log) for log in logs])):
+        sizes = [item_size(item) for item in items]
+        totals[label] = {
+            'bytes': sum(sizes),
+            'max_bytes': max(sizes),
+            # 書き込みは項目ごとに1KBあたり1WCUです
+            'wcu': sum(math.ceil(size / 1024) for size in sizes),
+            # Queryは取得した項目の合計サイズで計算され、結果整合性の読み込みは4KBあたり0.5RCUです（1セッション10件）
+            'rcu': sum(math.ceil(sum(sizes[start:start + 10]) / 4096) * 0.5 for start in range(0, len(sizes), 10)),
+        }
+    print(f"{count} log items")
+    for key in ('bytes', 'max_bytes', 'wcu', 'rcu'):
+        plain = totals['plain'][key]
+        compressed = totals['compressed'][key]
+        print(f"{key:>10}: {plain:>12,.1f} -> {compressed:>12,.1f} ({(1 - compressed / plain) * 100:5.1f}% saved)")
+
+
+if __name__ == '__main__':
+    main()
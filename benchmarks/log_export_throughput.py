@@ -0,0 +1,155 @@
+# log_export.pyでログテーブルを書き出す速度（items/s）とメモリの使用量を計測します
+# 途中で止めてチェックポイントから再開した場合と、完了後に追加されたログだけを書き出す場合に、
+# 書き出した行が欠けたり重複したりしないことも確認します。完了後の実行では、1回目の終わりより新しいために
+# 書き出さなかったログと、1回目の途中で書き込まれたログも書き出されることを確認します
+# 実行方法: python benchmarks/log_export_throughput.py [項目数] [セグメント数]
+import datetime
+import gzip
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fakes import FAKE_ENV, create_tables
+
+MESSAGES = ['I like soccer.', 'She go to school yesterday.', 'Could you tell me more about it?']
+
+
+BASE_TIME = datetime.datetime(2024, 4, 1)
+
+
+# index番目のログのcreated_atを返します
+def get_created_at(index):
+    created_at = BASE_TIME + datetime.timedelta(minutes=index * 7)
+    return f"{created_at.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}#{index % 0x10000:04x}0000"
+
+
+# テーブルに日付とモードコードがばらばらのログを書き込みます
+def populate(table, count, start, seed):
+    from dynamodb_handler import build_log_date_shard
+    from log_codec import encode_log_item
+    rng = random.Random(seed)
+    with table.batch_writer() as batch:
+        for index in range(start, start + count):
+            batch.put_item(Item=encode_log_item({
+                'line_user_id': f'U{index % 500}',
+                'created_at': get_created_at(index),
+                'log_date_shard': build_log_date_shard(f'U{index % 500}', get_created_at(index)),
+                'session_id': f'S{index // 20}',
+                'mode_code': rng.choice([1, 2, 3, 5, 8]),
+                'user_message': rng.choice(MESSAGES),
+                # 一部のログは圧縮されるように長い応答にします
+                'ai_response': rng.choice(MESSAGES) * rng.choice([1, 1, 1, 100]),
+            }))
+
+
+# 書き出したファイルの行数とキーを数えます
+def read_exported_keys(output_dir):
+    import log_export
+    keys = []
+    for directory, _, names in os.walk(output_dir):
+        for name in names:
+            path = os.path.join(directory, name)
+            if name.endswith('.parquet'):
+                columns = log_export.pyarrow.parquet.read_table(path).to_pydict()
+            elif name.endswith('.columns.json.gz'):
+                with gzip.open(path, 'rt', encoding='utf-8') as file:
+                    columns = json.load(file)
+            else:
+                continue
+            keys.extend(zip(columns['line_user_id'], columns['created_at']))
+    return keys
+
+
+def directory_size(output_dir):
+    return sum(os.path.getsize(os.path.join(directory, name)) for directory, _, names in os.walk(output_dir) for name in names)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    segments = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    os.environ.update(FAKE_ENV)
+    # チェックポイントの動作を確認できるよう、小さいページで読み込みます
+    os.environ.setdefault('EXPORT_PAGE_SIZE', '500')
+    os.environ.setdefault('EXPORT_CHECKPOINT_PAGES', '4')
+    os.environ.setdefault('EXPORT_ROWS_PER_FILE', '5000')
+
+    from moto import mock_aws
+    mock = mock_aws()
+    mock.start()
+    create_tables(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+    import log_export
+    from dynamodb_handler import get_dynamodb_resource
+    table = get_dynamodb_resource().Table(FAKE_ENV['LOG_TABLE_NAME'])
+    populate(table, count, 0, seed=0)
+    # 1回目は最後の5%のログより前までを書き出します。残りは実行を開始した時点で書き込みが遅れうる新しいログの代わりです
+    first_until = get_created_at(count - count // 20)[:23]
+    output_dir = tempfile.mkdtemp(prefix='log_export_')
+    checkpoint_path = os.path.join(output_dir, '_checkpoint.json')
+
+    try:
+        # 1回目: 数ページ読み込んだところで止め、チェックポイントから再開します
+        calls = {'count': 0}
+        exporter = log_export.LogExporter(FAKE_ENV['LOG_TABLE_NAME'], output_dir, checkpoint_path, segments, until=first_until)
+        from botocore.client import BaseClient
+        original_make_api_call = BaseClient._make_api_call
+
+        def interrupting_call(client, operation_name, api_params):
+            if operation_name == 'Scan':
+                calls['count'] += 1
+                if calls['count'] == 7:
+                    raise RuntimeError('simulated interruption')
+            return original_make_api_call(client, operation_name, api_params)
+
+        BaseClient._make_api_call = interrupting_call
+        try:
+            exporter.run()
+        except RuntimeError as e:
+            print(f"first run stopped: {e} (after {exporter.exported_count} items)")
+        finally:
+            BaseClient._make_api_call = original_make_api_call
+
+        tracemalloc.start()
+        started_at = time.perf_counter()
+        # 再開中に書き込まれた、1回目の終わりより新しいログです
+        populate(table, count // 20, count, seed=2)
+        exported, _ = log_export.LogExporter(FAKE_ENV['LOG_TABLE_NAME'], output_dir, checkpoint_path, segments).run()
+        elapsed = time.perf_counter() - started_at
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        keys = read_exported_keys(output_dir)
+        print(f"resumed run      : {exported} items in {elapsed:.2f}s ({exported / elapsed:.0f} items/s), peak {peak / 1024 / 1024:.1f} MiB")
+        print(f"exported rows    : {len(keys)} / {count - count // 20} (unique {len(set(keys))})")
+
+        # 2回目: 1回目の終わりより新しいログだけを書き出します
+        populate(table, count // 10, count + count // 20, seed=1)
+        total = count + count // 20 + count // 10
+        exported, _ = log_export.LogExporter(FAKE_ENV['LOG_TABLE_NAME'], output_dir, checkpoint_path, segments,
+                                             until=get_created_at(total)[:23]).run()
+        keys = read_exported_keys(output_dir)
+        print(f"incremental run  : {exported} new items, total rows {len(keys)} / {total} (unique {len(set(keys))})")
+
+        # チェックポイントなしで全体を書き出した場合の速度です
+        full_dir = tempfile.mkdtemp(prefix='log_export_full_')
+        started_at = time.perf_counter()
+        exported, items_per_second = log_export.LogExporter(
+            FAKE_ENV['LOG_TABLE_NAME'], full_dir, os.path.join(full_dir, '_checkpoint.json'), segments,
+            until=get_created_at(total)[:23]).run()
+        print(f"full export      : {exported} items, {items_per_second:.0f} items/s, {directory_size(full_dir) / 1024:.0f} KiB "
+              f"({'parquet' if log_export.pyarrow is not None else 'columns.json.gz'}, {segments} segment(s))")
+        shutil.rmtree(full_dir)
+    finally:
+        shutil.rmtree(output_dir)
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
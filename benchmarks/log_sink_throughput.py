@@ -0,0 +1,70 @@
+# ログを1件ずつ書き込む場合と、LogSinkでまとめて書き込む場合のDynamoDBの呼び出し回数と速度を比べます
+# motoのDynamoDBに対して実行し、実際に送信したPutItemとBatchWriteItemの回数を数えます
+# 実行方法: python benchmarks/log_sink_throughput.py [メッセージ数] [ユーザー数]
+import collections
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fakes import FAKE_ANSWER, FAKE_ENV, create_tables
+
+
+# 送信したDynamoDBのAPIの呼び出し回数を数えます
+def count_api_calls(calls):
+    from botocore.client import BaseClient
+    original_make_api_call = BaseClient._make_api_call
+
+    def counting_call(client, operation_name, api_params):
+        calls[operation_name] += 1
+        return original_make_api_call(client, operation_name, api_params)
+
+    BaseClient._make_api_call = counting_call
+    return original_make_api_call
+
+
+# メッセージごとにログを保存し、最後にバッファを書き込みます。呼び出し回数と経過時間、保存されたログの件数を返します
+def run(write_behind, messages, users):
+    import log_sink
+    from dynamodb_handler import DynamoDBHandler, get_dynamodb_resource
+    log_sink.LOG_WRITE_BEHIND = write_behind
+    log_sink.LOG_SINKS.clear()
+    handler = DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+    table = get_dynamodb_resource().Table(FAKE_ENV['LOG_TABLE_NAME'])
+    before = table.scan(Select='COUNT')['Count']
+
+    calls = collections.Counter()
+    from botocore.client import BaseClient
+    original_make_api_call = count_api_calls(calls)
+    try:
+        started_at = time.perf_counter()
+        for index in range(messages):
+            handler.save_log(f'U{index % users}', f'message {index}', FAKE_ANSWER, 1, f'S{index % users}', latency_ms=100)
+        log_sink.flush_all_log_sinks()
+        elapsed = time.perf_counter() - started_at
+    finally:
+        BaseClient._make_api_call = original_make_api_call
+    return calls, elapsed, table.scan(Select='COUNT')['Count'] - before
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    os.environ.update(FAKE_ENV)
+
+    from moto import mock_aws
+    with mock_aws():
+        create_tables(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+        print(f"{'mode':<14}{'PutItem':>9}{'BatchWrite':>12}{'calls/msg':>11}{'msgs/s':>9}{'stored':>8}")
+        for label, write_behind in (('put_item', False), ('write_behind', True)):
+            calls, elapsed, stored = run(write_behind, messages, users)
+            total = calls['PutItem'] + calls['BatchWriteItem']
+            print(f"{label:<14}{calls['PutItem']:>9}{calls['BatchWriteItem']:>12}{total / messages:>11.2f}"
+                  f"{messages / elapsed:>9.0f}{stored:>8}")
+
+
+if __name__ == '__main__':
+    main()
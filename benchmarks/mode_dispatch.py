@@ -0,0 +1,64 @@
+# モードのコマンド判定とクイックリプライ作成にかかる、メッセージごとの処理時間を計測します
+# 実行方法: python benchmarks/mode_dispatch.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from linebot.models import QuickReply, QuickReplyButton, MessageAction
+
+from mode_registry import LECTURE_TOPICS, get_command, get_quick_reply
+
+MESSAGES = [
+    "Hello, how are you?",
+    "I don't know.",
+    "【フリートーク:完了】",
+    "【モード:会議】",
+    "【モード:フリートーク】",
+    "【会話フレーズ講義:完了】",
+]
+
+LEGACY_ENTRY_KEYWORDS = ["フリートーク", "英文添削", "発表練習", "会話フレーズ講義"] + list(LECTURE_TOPICS.values())
+
+
+# 以前のif/elifによる部分一致の判定と、毎回のクイックリプライ作成を再現します
+def legacy_dispatch(user_message):
+    mode_code = 1
+    if user_message in ("【英文添削:完了】", "【会話フレーズ講義:完了】"):
+        mode_code = 0
+    elif user_message in ("【フリートーク:完了】", "【発表練習:完了】"):
+        mode_code = 0
+    elif user_message in ("I don't know.", "【発表練習:分からない】"):
+        pass
+    elif user_message.startswith("【モード:"):
+        for index, keyword in enumerate(LEGACY_ENTRY_KEYWORDS):
+            if keyword in user_message:
+                mode_code = index + 1
+                break
+    if mode_code == 4:
+        buttons = [(topic, f"【モード:{topic}】") for topic in LECTURE_TOPICS.values()]
+    elif mode_code == 0:
+        buttons = [(keyword, f"【モード:{keyword}】") for keyword in LEGACY_ENTRY_KEYWORDS[:4]]
+    else:
+        buttons = [("完了", "【フリートーク:完了】"), ("分からない", "I don't know.")]
+    items = [QuickReplyButton(action=MessageAction(label=label, text=text)) for label, text in buttons]
+    return QuickReply(items=items)
+
+
+# 対応表による判定と、作成済みのクイックリプライの参照を行います
+def registry_dispatch(user_message):
+    command = get_command(user_message)
+    mode_code = command.mode_code if command is not None and command.mode_code is not None else 1
+    return get_quick_reply(mode_code)
+
+
+def main():
+    number = 20000
+    for name, dispatch in (("legacy", legacy_dispatch), ("registry", registry_dispatch)):
+        elapsed = timeit.timeit(lambda: [dispatch(message) for message in MESSAGES], number=number)
+        print(f"{name:>8}: {elapsed / (number * len(MESSAGES)) * 1e6:.2f} us/message")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# 多数の同時実行がOpenAI APIを呼び出す状況をシミュレーションし、レートリミッタの有無で
+# 成功したリクエストのスループットと429エラーの数を比較します
+# 実行方法: python benchmarks/rate_limit_simulation.py [秒数] [同時実行数]
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rate_limiter import InMemoryRateLimiter, RateLimited
+
+# シミュレーションでは1分を1秒に縮めます
+WINDOW_SECONDS = 1.0
+RPM_LIMIT = 100
+TPM_LIMIT = 200000
+TOKENS_PER_REQUEST = 1500
+SERVICE_SECONDS = 0.02
+
+
+# 上限を超えたリクエストに429を返すOpenAI APIの代わりです
+class FakeOpenAI:
+    def __init__(self):
+        self.limiter = InMemoryRateLimiter(RPM_LIMIT, TPM_LIMIT, max_wait_seconds=0, window_seconds=WINDOW_SECONDS)
+
+    def call(self):
+        time.sleep(SERVICE_SECONDS)
+        return 200 if self.limiter.try_acquire(1, TOKENS_PER_REQUEST) <= 0 else 429
+
+
+def simulate(duration, concurrency, use_limiter):
+    server = FakeOpenAI()
+    limiter = InMemoryRateLimiter(RPM_LIMIT, TPM_LIMIT, max_wait_seconds=0.5, window_seconds=WINDOW_SECONDS) if use_limiter else None
+    counts = {200: 0, 429: 0, 'shed': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker():
+        while time.monotonic() < deadline:
+            try:
+                if limiter is not None:
+                    limiter.admit(TOKENS_PER_REQUEST)
+                status = server.call()
+            except RateLimited:
+                status = 'shed'
+            with lock:
+                counts[status] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    limit_per_second = min(RPM_LIMIT, TPM_LIMIT / TOKENS_PER_REQUEST) / WINDOW_SECONDS
+    print(f"limit: {limit_per_second:.0f} req/s, concurrency: {concurrency}, duration: {duration}s")
+    for use_limiter in (False, True):
+        counts = simulate(duration, concurrency, use_limiter)
+        print(f"{'with limiter' if use_limiter else 'no limiter':>12}: "
+              f"ok {counts[200] / duration:6.1f} req/s, 429 {counts[429]:6d}, shed {counts['shed']:5d}")
+
+
+if __name__ == '__main__':
+    main()
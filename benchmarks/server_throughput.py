@@ -0,0 +1,126 @@
+# server.pyのWebhookサーバーに多数の会話を同時に送り、1プロセスで処理できる会話数を計測します
+# OpenAIの応答にはgpt-4と同程度の待ち時間を設定し、同じ負荷をLambdaで処理した場合の課金時間と比較します
+# 実行方法: python benchmarks/server_throughput.py [会話数] [OpenAIの待ち時間（秒）]
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fakes import FAKE_ENV, LineRecorder, build_message_event, create_tables, start_fake_openai_process
+
+LAMBDA_SAMPLE_SIZE = 20
+
+
+# OpenAIの応答を同時に待っている会話の数を数えます
+def count_openai_waits(waits):
+    from async_http_client import AsyncRetryingHttpClient
+    original_post = AsyncRetryingHttpClient.post
+
+    async def counting_post(client, *args, **kwargs):
+        waits['current'] += 1
+        waits['peak'] = max(waits['peak'], waits['current'])
+        try:
+            return await original_post(client, *args, **kwargs)
+        finally:
+            waits['current'] -= 1
+
+    AsyncRetryingHttpClient.post = counting_post
+
+
+async def run_server_load(server_module, recorder, conversations):
+    import aiohttp
+    from aiohttp import web
+
+    server = server_module.WebhookServer()
+    runner = web.AppRunner(server.create_app())
+    # 起動時に全ワーカースレッドのハンドラを作成するため、その時間も計測します
+    warm_up_started_at = time.perf_counter()
+    await runner.setup()
+    warm_up_seconds = time.perf_counter() - warm_up_started_at
+    site = web.TCPSite(runner, '127.0.0.1', 0, backlog=server_module.SERVER_BACKLOG)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    started_at = time.perf_counter()
+    peak_pending = 0
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        async def send(index):
+            event = build_message_event(f'server-{index}', f'Userver-{index}', 'I like soccer.')
+            async with session.post(f'http://127.0.0.1:{port}/callback', data=json.dumps({'events': [event]})) as response:
+                await response.read()
+                return (time.perf_counter() - started_at) * 1000, response.status
+
+        acknowledgements = await asyncio.gather(*(send(index) for index in range(conversations)))
+        # すべての返信が送信されるまで待ちます
+        while len(recorder.messages) < conversations:
+            peak_pending = max(peak_pending, len(server.user_tasks))
+            await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started_at
+    await runner.cleanup()
+    return warm_up_seconds, elapsed, peak_pending, acknowledgements
+
+
+# 同じメッセージをlambda_handlerで1件ずつ処理し、1回の呼び出しの平均時間を計測します
+def measure_lambda_invocation(lambda_function):
+    durations = []
+    for index in range(LAMBDA_SAMPLE_SIZE):
+        event = build_message_event(f'lambda-{index}', f'Ulambda-{index}', 'I like soccer.')
+        started_at = time.perf_counter()
+        lambda_function.lambda_handler({'body': json.dumps({'events': [event]})}, None)
+        durations.append(time.perf_counter() - started_at)
+    return sum(durations) / len(durations)
+
+
+def main():
+    conversations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    openai_latency = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+    os.environ.update(FAKE_ENV)
+    os.environ.setdefault('TRACE_OUTPUT', 'off')
+    # OpenAIの代わりは別のプロセスで動かし、計測するプロセスのCPUを使わないようにします
+    fake_openai, os.environ['OPENAI_API_URL'] = start_fake_openai_process(latency=openai_latency)
+
+    from moto import mock_aws
+    mock = mock_aws()
+    mock.start()
+    create_tables(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+    import lambda_function
+    import line_handler
+    import server
+    recorder = LineRecorder()
+    line_handler.LINE_BOT_API = recorder
+    openai_waits = {'current': 0, 'peak': 0}
+    count_openai_waits(openai_waits)
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            warm_up_seconds, elapsed, peak_pending, acknowledgements = asyncio.run(run_server_load(server, recorder, conversations))
+            recorder.messages.clear()
+            invocation_seconds = measure_lambda_invocation(lambda_function)
+    finally:
+        mock.stop()
+        fake_openai.terminate()
+
+    ack_ms = sorted(latency for latency, _ in acknowledgements)
+    statuses = sorted({status for _, status in acknowledgements})
+    max_rss_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"conversations        : {conversations} (OpenAI latency {openai_latency:.1f}s)")
+    print(f"server warm-up       : {warm_up_seconds:8.2f} s ({server.SERVER_WORKER_THREADS} worker threads)")
+    print(f"server wall time     : {elapsed:8.2f} s ({conversations / elapsed:.1f} conversations/s, 1 process)")
+    print(f"peak pending users   : {peak_pending}")
+    print(f"peak OpenAI waits    : {openai_waits['peak']} (in flight on the event loop)")
+    print(f"webhook ack p50/p99  : {ack_ms[len(ack_ms) // 2]:8.1f} / {ack_ms[int(len(ack_ms) * 0.99)]:.1f} ms (status {statuses})")
+    print(f"max RSS              : {max_rss_mib:8.1f} MiB")
+    print(f"lambda per message   : {invocation_seconds:8.2f} s -> {invocation_seconds * conversations:.0f} billed Lambda-seconds for the same load")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+import contextlib
+import threading
+
+
+# 上流のサービスへの同時呼び出し数を制限するためのコンテキストマネージャを作成します
+# 上限が0以下の場合は制限しません
+def create_concurrency_limit(limit):
+    if limit > 0:
+        return threading.BoundedSemaphore(limit)
+    return contextlib.nullcontext()
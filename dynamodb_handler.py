@@ -1,8 +1,159 @@
 import boto3
+import collections
 import datetime
+import itertools
+import os
+import random
+import threading
+import time
+import zlib
 from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from concurrency_limit import create_concurrency_limit
+from log_codec import decode_log_item, encode_log_item
+from log_sink import get_log_sink
+from rate_limiter import RATE_LIMITED_MESSAGE
+from tracing import traced
+from ttl_cache import TTLCache
+
+# boto3のリソースはスレッドセーフではないため、スレッドごとに初めて必要になった時に作成します
+DYNAMODB_RESOURCES = threading.local()
+
+
+# DynamoDBのリソースを取得します
+def get_dynamodb_resource():
+    if not hasattr(DYNAMODB_RESOURCES, 'resource'):
+        DYNAMODB_RESOURCES.resource = boto3.resource('dynamodb')
+    return DYNAMODB_RESOURCES.resource
+
+# ウォームコンテナ内でユーザー情報をキャッシュします（USER_CACHE_TTL_SECONDSが0の場合は無効）
+# 有効にすると読み込みを省けますが、他の実行環境で更新されたモードなどは有効期限まで古いままです
+# 利用回数の上限は条件付きの書き込みで確認するため、古いキャッシュでも超えることはありません
+USER_CACHE = TTLCache(
+    int(os.environ.get('USER_CACHE_SIZE', '1024')),
+    float(os.environ.get('USER_CACHE_TTL_SECONDS', '0'))
+)
+
+# ログテーブルのセッション単位の検索に使うGSIの名前です（パーティションキー: session_id、ソートキー: created_at）
+# 既存のテーブルには、update-tableで次のGSIを追加してから新しいコードを配置します
+#   --attribute-definitions AttributeName=session_id,AttributeType=S
+#   --global-secondary-index-updates '[{"Create": {"IndexName": "session_id-created_at-index",
+#     "KeySchema": [{"AttributeName": "session_id", "KeyType": "HASH"}, {"AttributeName": "created_at", "KeyType": "RANGE"}],
+#     "Projection": {"ProjectionType": "INCLUDE", "NonKeyAttributes": ["user_message", "ai_response"]}}}]'
+# 圧縮したログは値の型で判断して復元するため（log_codec.pyを参照）、射影にformat_versionとcompressed_fieldsは不要です
+# GSIがない場合や作成中の場合は、ユーザーIDで検索してセッションのログを絞り込みます
+LOG_SESSION_INDEX_NAME = os.environ.get('LOG_SESSION_INDEX_NAME', 'session_id-created_at-index')
+# GSIを使えなかった後、再びGSIを試すまでの秒数です
+LOG_SESSION_INDEX_RETRY_SECONDS = 300
+# GSIを使えなかった時刻です（time.monotonic）。Noneの場合はGSIを使います
+LOG_SESSION_INDEX_UNAVAILABLE = {'since': None}
+
+# ログを日付ごとに書き出す（log_export.pyの差分の書き出し）ために使うGSIの名前と、1日のログを分けるシャードの数です
+# パーティションキーはlog_date_shard（"日本時間の日付#シャード番号"）、ソートキーはcreated_atです
+# 書き出しではすべての列を読むため、射影はALLにします。GSIの追加より前に保存したログにはlog_date_shardがないため、
+# GSIを追加した後の最初の書き出しは、log_export.pyの--scanでテーブル全体を読み込みます
+LOG_DATE_INDEX_NAME = os.environ.get('LOG_DATE_INDEX_NAME', 'log_date_shard-created_at-index')
+LOG_DATE_SHARDS = int(os.environ.get('LOG_DATE_SHARDS', '4'))
+
+# DynamoDBの呼び出し回数を操作ごとに記録します
+DYNAMODB_CALL_COUNTER = collections.Counter()
+DYNAMODB_CALL_COUNTER_LOCK = threading.Lock()
+# DynamoDBへの同時呼び出し数の上限です（0の場合は制限しません）
+DYNAMODB_IN_FLIGHT_LIMIT = create_concurrency_limit(int(os.environ.get('DYNAMODB_MAX_IN_FLIGHT', '0')))
+
+# ログのソートキーの接尾辞に使う連番です
+LOG_SEQUENCE = itertools.count()
+
+# 1日あたりのAPI利用回数の上限です
+DAILY_API_LIMIT = 6
+USAGE_LIMIT_MESSAGE = "利用制限に達しました。明日の午前4時にリセットされます。"
+
+
+# 1日の利用上限に達した場合に送出される例外
+class UsageLimitExceeded(Exception):
+    pass
+
+
+# 同時に利用回数を更新するリクエストとの競合が続き、加算できなかった場合に送出される例外
+# 上限に達したわけではないため、混雑している旨のメッセージを返します
+class UsageContention(Exception):
+    pass
+
+
+# 午前4時（日本時間）のリセットを考慮した利用日を取得します。nowを指定した場合は、その日本時間の日時の利用日を返します
+def get_usage_date(now=None):
+    if now is None:
+        now = datetime.datetime.utcnow() + datetime.timedelta(hours=9)
+    if now.hour < 4:
+        now = now - datetime.timedelta(days=1)
+    return now.strftime("%Y-%m-%d")
+
+
+# ログのソートキー（created_at）に使う、日本時間のミリ秒までの日時に短い接尾辞を付けた文字列を返します
+# 同じユーザーのイベントが同じ秒に続けて処理されても、前のログを上書きしないように一意にします
+# 接尾辞はプロセス内の連番と乱数で、同じミリ秒のログもプロセス内では保存した順に並びます
+def build_log_timestamp():
+    now = datetime.datetime.utcnow() + datetime.timedelta(hours=9)
+    return f"{now.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}#{next(LOG_SEQUENCE) % 0x10000:04x}{random.getrandbits(16):04x}"
+
+
+# 属性の辞書から、UpdateExpressionに追加するSET句と値を作成します
+def build_set_clauses(attributes):
+    if not attributes:
+        return "", {}
+    clauses = []
+    values = {}
+    for index, (name, value) in enumerate(attributes.items()):
+        clauses.append(f"{name} = :attr{index}")
+        values[f":attr{index}"] = value
+    return ", " + ", ".join(clauses), values
+
+
+# セッション単位の検索にGSIを使うかどうかを判定します。使えなかった場合も、一定の時間が経てば作成済みか再び試します
+def is_session_index_available():
+    since = LOG_SESSION_INDEX_UNAVAILABLE['since']
+    return since is None or time.monotonic() - since >= LOG_SESSION_INDEX_RETRY_SECONDS
+
+
+# ログの日付とユーザーIDから、日付ごとのGSIのパーティションキーを返します
+# 同じ日のログの書き込みが1つのパーティションに集中しないよう、ユーザーIDでシャードに分けます
+def build_log_date_shard(user_id, created_at):
+    return f"{created_at[:10]}#{zlib.crc32(user_id.encode('utf-8')) % LOG_DATE_SHARDS}"
+
+
+# 条件付き書き込みの条件を満たさなかったエラーかどうかを判定します
+def is_conditional_check_failed(error):
+    return error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+# テーブルへの呼び出し回数を数えるためのラッパークラス
+class CountingTable:
+    COUNTED_OPERATIONS = ('get_item', 'put_item', 'update_item', 'delete_item', 'query', 'scan', 'batch_writer')
+
+    # コンストラクタでラップするテーブルオブジェクトを初期化します
+    def __init__(self, table):
+        self.table = table
+
+    # 呼び出し回数を記録してからテーブルのメソッドを返します
+    # 1回のリクエストで完了する操作は、同時呼び出し数の上限の範囲で実行します
+    def __getattr__(self, name):
+        attribute = getattr(self.table, name)
+        if name in self.COUNTED_OPERATIONS:
+            with DYNAMODB_CALL_COUNTER_LOCK:
+                DYNAMODB_CALL_COUNTER[name] += 1
+            if name != 'batch_writer':
+                return limit_in_flight(attribute)
+        return attribute
+
+
+# 同時呼び出し数の上限の範囲で関数を実行するようにラップします
+def limit_in_flight(function):
+    def wrapper(*args, **kwargs):
+        with DYNAMODB_IN_FLIGHT_LIMIT:
+            return function(*args, **kwargs)
+    return wrapper
 
-dynamodb = boto3.resource('dynamodb')
 
 # DynamoDBに関連する処理を管理するクラス
 class DynamoDBHandler:
@@ -10,100 +161,254 @@ class DynamoDBHandler:
     def __init__(self, user_table_name, log_table_name):
         self.user_table_name = user_table_name
         self.log_table_name = log_table_name
-        self.user_table = dynamodb.Table(self.user_table_name)
-        self.log_table = dynamodb.Table(self.log_table_name)
+        dynamodb = get_dynamodb_resource()
+        self.user_table = CountingTable(dynamodb.Table(self.user_table_name))
+        self.log_table = CountingTable(dynamodb.Table(self.log_table_name))
+        # ログの書き込みを遅延する設定の場合は、LogSinkにまとめて書き込ませます
+        self.log_sink = get_log_sink(self.log_table_name)
 
-    # ユーザーの使用情報を更新します。新しいユーザーであれば新たに項目を作成し、すでに存在するユーザーであれば情報を更新します
-    def update_user_usage(self, user_id, api_count, mode_code):
-        # Determine the date considering the reset at 4:00 AM (Japan time)
-        now = datetime.datetime.utcnow() + datetime.timedelta(hours=9)
-        if now.hour < 4:
-            now = now - datetime.timedelta(days=1)
-        today = now.strftime("%Y-%m-%d")
-
-        user = self.user_table.get_item(Key={'line_user_id': user_id})
-
-        if 'Item' not in user or user['Item']['last_used_date'] != today:
-            if api_count > 6:
-                raise Exception("利用制限に達しました。明日の午前4時にリセットされます。")
-            self.user_table.put_item(
-                Item={
-                    'line_user_id': user_id,
-                    'api_count_total': api_count,
-                    'mode_code': mode_code,
-                    'last_used_date': today
-                }
-            )
-        else:
-            updated_api_count = user['Item']['api_count_total'] + api_count
-            if updated_api_count > 6:
-                raise Exception("利用制限に達しました。明日の午前4時にリセットされます。")
-            self.user_table.update_item(
+    # ユーザー情報を取得します。キャッシュがあればDynamoDBを呼び出さずに返します
+    @traced('dynamodb.get_user')
+    def get_user(self, user_id):
+        item = USER_CACHE.get(user_id)
+        if item is not None:
+            return item
+        response = self.user_table.get_item(Key={'line_user_id': user_id})
+        item = response.get('Item')
+        if item is not None:
+            USER_CACHE.set(user_id, item)
+        return item
+
+    # ユーザーの使用情報を更新します。1日の利用上限を超える場合はUsageLimitExceededを、
+    # 他のリクエストとの競合で3回続けて書き込めなかった場合はUsageContentionを送出します
+    # extra_attributesを指定すると、同じ書き込みでそれらの属性も更新します
+    @traced('dynamodb.update_user_usage')
+    def update_user_usage(self, user_id, api_count, mode_code, extra_attributes=None):
+        today = get_usage_date()
+        extra_expression, extra_values = build_set_clauses(extra_attributes)
+
+        # 同日中の利用であれば、1回の条件付き更新で回数の加算と上限の確認を同時に行います
+        for _ in range(3):
+            try:
+                response = self.user_table.update_item(
+                    Key={'line_user_id': user_id},
+                    UpdateExpression="SET api_count_total = api_count_total + :val, mode_code = :mode" + extra_expression,
+                    ConditionExpression="last_used_date = :date AND api_count_total <= :remaining",
+                    ExpressionAttributeValues={
+                        ':val': api_count,
+                        ':mode': mode_code,
+                        ':date': today,
+                        ':remaining': DAILY_API_LIMIT - api_count,
+                        **extra_values
+                    },
+                    ReturnValues='ALL_NEW',
+                    ReturnValuesOnConditionCheckFailure='ALL_OLD'
+                )
+                USER_CACHE.set(user_id, response['Attributes'])
+                return response['Attributes']
+            except ClientError as e:
+                if not is_conditional_check_failed(e):
+                    raise
+                # 今日すでに利用している場合は上限に達しています
+                item = e.response.get('Item')
+                if item is not None and item.get('last_used_date', {}).get('S') == today:
+                    raise UsageLimitExceeded(USAGE_LIMIT_MESSAGE)
+
+            # 新しいユーザー、または4時をまたいだ最初の利用の場合は回数をリセットします
+            if api_count > DAILY_API_LIMIT:
+                raise UsageLimitExceeded(USAGE_LIMIT_MESSAGE)
+            try:
+                response = self.user_table.update_item(
+                    Key={'line_user_id': user_id},
+                    UpdateExpression="SET api_count_total = :val, mode_code = :mode, last_used_date = :date" + extra_expression,
+                    ConditionExpression="attribute_not_exists(line_user_id) OR last_used_date <> :date",
+                    ExpressionAttributeValues={
+                        ':val': api_count,
+                        ':mode': mode_code,
+                        ':date': today,
+                        **extra_values
+                    },
+                    ReturnValues='ALL_NEW'
+                )
+                USER_CACHE.set(user_id, response['Attributes'])
+                return response['Attributes']
+            except ClientError as e:
+                # 同時に別のリクエストがリセットした場合は、加算からやり直します
+                if not is_conditional_check_failed(e):
+                    raise
+        raise UsageContention(RATE_LIMITED_MESSAGE)
+
+    # 加算した利用回数を戻します。日付が変わっている場合は何もしません
+    @traced('dynamodb.refund_user_usage')
+    def refund_user_usage(self, user_id, api_count):
+        try:
+            response = self.user_table.update_item(
                 Key={'line_user_id': user_id},
-                UpdateExpression="SET api_count_total = api_count_total + :val, mode_code = :mode, last_used_date = :date",
+                UpdateExpression="SET api_count_total = api_count_total - :val",
+                ConditionExpression="last_used_date = :date AND api_count_total >= :val",
                 ExpressionAttributeValues={
                     ':val': api_count,
-                    ':mode': mode_code,
-                    ':date': today
-                }
+                    ':date': get_usage_date()
+                },
+                ReturnValues='ALL_NEW'
             )
+        except ClientError as e:
+            if not is_conditional_check_failed(e):
+                raise
+            return None
+        USER_CACHE.set(user_id, response['Attributes'])
+        return response['Attributes']
 
     # ユーザーのモードコードを更新します
     def update_mode_code(self, user_id, mode_code):
-        today = (datetime.datetime.utcnow() + datetime.timedelta(hours=9)).strftime("%Y-%m-%d")
-        user = self.user_table.get_item(Key={'line_user_id': user_id})
+        return self.update_user_attributes(user_id, {'mode_code': mode_code})
 
-        if 'Item' in user:
-            self.user_table.update_item(
+    # ユーザーの属性をまとめて更新します。新しいユーザーの場合は利用回数0で項目を作成します
+    @traced('dynamodb.update_user_attributes')
+    def update_user_attributes(self, user_id, attributes):
+        expression, values = build_set_clauses(attributes)
+        response = self.user_table.update_item(
+            Key={'line_user_id': user_id},
+            UpdateExpression="SET api_count_total = if_not_exists(api_count_total, :zero), last_used_date = if_not_exists(last_used_date, :date)" + expression,
+            ExpressionAttributeValues={
+                ':zero': 0,
+                ':date': get_usage_date(),
+                **values
+            },
+            ReturnValues='ALL_NEW'
+        )
+        USER_CACHE.set(user_id, response['Attributes'])
+        return response['Attributes']
+
+    # セッションごとのリストの属性の末尾に値を追加します。セッションが変わっている場合は追加せずにNoneを返します
+    # 返信の後のジョブから呼び出すため、同時に処理されたメッセージの書き込みを上書きしないよう、リストへの追加だけを行います
+    @traced('dynamodb.append_session_values')
+    def append_session_values(self, user_id, session_id, name, values):
+        try:
+            response = self.user_table.update_item(
                 Key={'line_user_id': user_id},
-                UpdateExpression="SET mode_code = :mode",
+                UpdateExpression=f"SET {name} = list_append(if_not_exists({name}, :empty), :values)",
+                ConditionExpression="session_id = :session",
                 ExpressionAttributeValues={
-                    ':mode': mode_code,
-                }
-            )
-        else:
-            self.user_table.put_item(
-                Item={
-                    'line_user_id': user_id,
-                    'api_count_total': 0,
-                    'mode_code': mode_code,
-                    'last_used_date': today
-                }
+                    ':empty': [],
+                    ':values': values,
+                    ':session': session_id
+                },
+                ReturnValues='ALL_NEW'
             )
+        except ClientError as e:
+            if not is_conditional_check_failed(e):
+                raise
+            return None
+        USER_CACHE.set(user_id, response['Attributes'])
+        return response['Attributes']
 
     # ユーザーのモードコードを取得します
     def get_mode_code(self, user_id):
-        today = (datetime.datetime.utcnow() + datetime.timedelta(hours=9)).strftime("%Y-%m-%d")
-        user = self.user_table.get_item(Key={'line_user_id': user_id})
-        if 'Item' in user:
-            return user['Item']['mode_code']
+        user = self.get_user(user_id)
+        if user is not None:
+            return user.get('mode_code', 0)
         else:
             return 0
 
     # ユーザーのメッセージとAIのレスポンスをログテーブルに保存します
-    def save_log(self, user_id, user_message, ai_response, mode_code):
-        timestamp = (datetime.datetime.utcnow() + datetime.timedelta(hours=9)).strftime('%Y-%m-%d %H:%M:%S')
+    # latency_msには、メッセージを受け取ってから返信するまでの時間（ミリ秒）を記録します
+    @traced('dynamodb.save_log')
+    def save_log(self, user_id, user_message, ai_response, mode_code, session_id=None, latency_ms=None):
+        timestamp = build_log_timestamp()
 
-        self.log_table.put_item(Item={
+        item = {
             'line_user_id': user_id,
             'user_message': user_message,
             'ai_response': ai_response,
             'mode_code': mode_code,
             'created_at': timestamp,
-        })
+        }
+        # 日付ごとの書き出しに使うインデックスのキーです
+        item['log_date_shard'] = build_log_date_shard(user_id, timestamp)
+        # セッションIDはセッション単位の履歴検索に使うインデックスのキーになります
+        if session_id is not None:
+            item['session_id'] = session_id
+        if latency_ms is not None:
+            item['latency_ms'] = int(latency_ms)
+        # 長いテキストは圧縮して保存します
+        item = encode_log_item(item)
+        if self.log_sink is not None:
+            self.log_sink.add(item)
+        else:
+            self.log_table.put_item(Item=item)
 
-    # ユーザーの会話履歴を取得します
-    def get_conversation_history(self, user_id):
-        response = self.log_table.query(
-            KeyConditionExpression=Key('line_user_id').eq(user_id),
-            Limit=6,
-            ScanIndexForward=False
-        )
+    # ユーザーの最近のログを古い順に取得します
+    # セッションIDを指定した場合は、そのセッションのログだけをインデックスから取得します
+    # afterに取得済みのログのcreated_atを指定した場合は、そのログより後のログだけを取得します
+    @traced('dynamodb.get_recent_logs')
+    def get_recent_logs(self, user_id, limit, session_id=None, after=None):
+        if session_id is not None and is_session_index_available():
+            key_condition = Key('session_id').eq(session_id)
+            if after:
+                key_condition = key_condition & Key('created_at').gt(after)
+            try:
+                response = self.log_table.query(
+                    IndexName=LOG_SESSION_INDEX_NAME,
+                    KeyConditionExpression=key_condition,
+                    ProjectionExpression='user_message, ai_response, created_at, format_version, compressed_fields',
+                    Limit=limit,
+                    ScanIndexForward=False
+                )
+                items = response['Items'][::-1]  # Reverse the list to get the latest items in order
+            except ClientError as e:
+                # GSIがない場合と作成中の場合はValidationException（motoでは
+                # ResourceNotFoundException）になります。テーブルがない場合は次の検索でも失敗します
+                if e.response.get('Error', {}).get('Code') not in ('ValidationException', 'ResourceNotFoundException'):
+                    raise
+                print(f"Warning: {LOG_SESSION_INDEX_NAME} is not available; querying logs by user instead: {e}")
+                LOG_SESSION_INDEX_UNAVAILABLE['since'] = time.monotonic()
+                items = self.query_session_logs_by_user(user_id, limit, session_id, after)
+        elif session_id is not None:
+            items = self.query_session_logs_by_user(user_id, limit, session_id, after)
+        else:
+            key_condition = Key('line_user_id').eq(user_id)
+            if after:
+                key_condition = key_condition & Key('created_at').gt(after)
+            response = self.log_table.query(
+                KeyConditionExpression=key_condition,
+                Limit=limit,
+                ScanIndexForward=False
+            )
+            items = response['Items'][::-1]  # Reverse the list to get the latest items in order
 
-        conversation_history = []
-        items = response['Items'][::-1]  # Reverse the list to get the latest 20 items
+        # まだ書き込まれていないログも履歴に含めます
+        if self.log_sink is not None:
+            pending = [item for item in self.log_sink.get_pending(user_id, session_id) if not after or item['created_at'] > after]
+            if pending:
+                written = {item['created_at'] for item in items}
+                items = sorted(items + [item for item in pending if item['created_at'] not in written],
+                               key=lambda item: item['created_at'])[-limit:]
+        return [decode_log_item(item) for item in items]
 
-        for item in items:
+    # GSIを使えない場合に、ユーザーのログを新しい順に読み、セッションのログを古い順に返します
+    # セッションはユーザーごとに1つずつ順に始まるため、別のセッションのログまで読んだところで終了します
+    def query_session_logs_by_user(self, user_id, limit, session_id, after=None):
+        key_condition = Key('line_user_id').eq(user_id)
+        if after:
+            key_condition = key_condition & Key('created_at').gt(after)
+        arguments = {'KeyConditionExpression': key_condition, 'Limit': limit + 1, 'ScanIndexForward': False}
+        items = []
+        while len(items) < limit:
+            response = self.log_table.query(**arguments)
+            for item in response['Items']:
+                if item.get('session_id') != session_id or len(items) >= limit:
+                    return items[::-1]
+                items.append(item)
+            if 'LastEvaluatedKey' not in response:
+                break
+            arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return items[::-1]
+
+    # ユーザーの会話履歴を取得します
+    def get_conversation_history(self, user_id, session_id=None):
+        conversation_history = []
+        for item in self.get_recent_logs(user_id, 6, session_id):
             conversation_history.append({"role": "user", "content": item['user_message']})
             conversation_history.append({"role": "assistant", "content": item['ai_response']})
         
@@ -0,0 +1,72 @@
+import os
+
+from mode_registry import ANALYSIS_PROFILE, CHUNK_ANALYSIS_PROMPT_TEMPLATE, CHUNK_FINDINGS_HEADING
+from steps import Gather
+from tracing import traced
+
+# 1回の分析にまとめる会話の数です。この数の会話がたまるたびに分析しておきます
+FEEDBACK_CHUNK_SIZE = int(os.environ.get('FEEDBACK_CHUNK_SIZE', '6'))
+# フィードバックのために読み込むセッションのログの最大件数です
+FEEDBACK_MAX_ITEMS = int(os.environ.get('FEEDBACK_MAX_ITEMS', '200'))
+# 会話の分析を並行して行う数です
+FEEDBACK_MAP_WORKERS = int(os.environ.get('FEEDBACK_MAP_WORKERS', '4'))
+
+
+# ログを決められた数ずつに分けます
+def split_into_chunks(logs, chunk_size=FEEDBACK_CHUNK_SIZE):
+    return [logs[index:index + chunk_size] for index in range(0, len(logs), chunk_size)]
+
+
+# セッションの会話を分割して分析し（map）、その結果から終了時のフィードバックを作成する（reduce）クラス
+# 分析した結果はセッションごとの属性としてユーザー情報に保存し、会話の途中で少しずつ進めておきます
+class FeedbackPipeline:
+    # コンストラクタで各ハンドラを初期化します
+    def __init__(self, dynamodb_handler, openai_handler):
+        self.dynamodb_handler = dynamodb_handler
+        self.openai_handler = openai_handler
+
+    # 会話を1回記録します。分析していない会話が決められた数だけたまったら、それを分析しておきます
+    # OpenAIへのリクエストはステップとしてyieldします
+    def record_turn_steps(self, user_id, user_state):
+        turns = int(user_state.get_session_value('feedback_turns')) + 1
+        user_state.set_session_value('feedback_turns', turns)
+        if turns % FEEDBACK_CHUNK_SIZE == 0:
+            yield from self.analyze_new_logs_steps(user_id, user_state, complete_chunks_only=True)
+
+    # 終了時のフィードバックのプロンプトを作成します。まだ分析していない残りの会話もここで分析します
+    # 会話がない場合はプロンプトをそのまま返します。OpenAIへのリクエストはステップとしてyieldします
+    @traced('feedback.build_prompt')
+    def build_prompt_steps(self, prompt, user_id, user_state):
+        chunks = yield from self.analyze_new_logs_steps(user_id, user_state, complete_chunks_only=False)
+        if not chunks:
+            return prompt
+        findings = "\n\n".join(f"（{index + 1}）\n{chunk['findings']}" for index, chunk in enumerate(chunks))
+        return f"{prompt}\n\n{CHUNK_FINDINGS_HEADING}\n{findings}"
+
+    # 前回の分析より後のログを読み込み、分析した結果をこれまでの結果に追加して返します
+    # complete_chunks_onlyがTrueの場合は、決められた数に満たない残りのログは次回に回します
+    def analyze_new_logs_steps(self, user_id, user_state, complete_chunks_only):
+        chunks = list(user_state.get_session_value('feedback_chunks'))
+        after = chunks[-1]['until'] if chunks else None
+        logs = self.dynamodb_handler.get_recent_logs(user_id, FEEDBACK_MAX_ITEMS, user_state.session_id, after)
+        log_chunks = split_into_chunks(logs)
+        if complete_chunks_only and log_chunks and len(log_chunks[-1]) < FEEDBACK_CHUNK_SIZE:
+            log_chunks = log_chunks[:-1]
+        if not log_chunks:
+            return chunks
+
+        # 分割した会話を並行して分析します。失敗した部分とそれより後の部分は分析結果に含めず、次回に回します
+        results = yield Gather([self.analyze_chunk_steps(log_chunk) for log_chunk in log_chunks], FEEDBACK_MAP_WORKERS)
+        for log_chunk, (findings, error) in zip(log_chunks, results):
+            if error is not None:
+                print(f"Error while analyzing the conversation: {error}")
+                break
+            chunks.append({'until': log_chunk[-1]['created_at'], 'findings': findings})
+        user_state.set_session_value('feedback_chunks', chunks)
+        return chunks
+
+    # 会話の一部から、よかった点と改善するべき点を抜き出します。利用回数には数えません
+    def analyze_chunk_steps(self, logs):
+        conversation = "\n".join(f"user: {log['user_message']}\nassistant: {log['ai_response']}" for log in logs)
+        return (yield from self.openai_handler.generate_text_steps(
+            CHUNK_ANALYSIS_PROMPT_TEMPLATE.format(conversation=conversation), ANALYSIS_PROFILE))
@@ -0,0 +1,102 @@
+import os
+
+from tracing import traced
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 会話履歴に使うトークン数の上限です
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', '2000'))
+# 会話履歴として読み込むログの最大件数です
+HISTORY_MAX_ITEMS = int(os.environ.get('HISTORY_MAX_ITEMS', '20'))
+# 要約に畳み込んだ後に要約せずに残す会話の割合です。上限まで余裕を残し、要約を毎回繰り返さないようにします
+HISTORY_FOLD_TARGET = float(os.environ.get('HISTORY_FOLD_TARGET', '0.5'))
+
+ENCODING = tiktoken.get_encoding('cl100k_base') if tiktoken is not None else None
+
+
+# テキストのトークン数を数えます。tiktokenがない場合は文字の種類から概算します
+def count_tokens(text):
+    if not text:
+        return 0
+    if ENCODING is not None:
+        return len(ENCODING.encode(text))
+    # ASCII文字は約4文字で1トークン、日本語などはおよそ1文字で1トークンとして数えます
+    ascii_count = sum(1 for char in text if ord(char) < 128)
+    return (ascii_count + 3) // 4 + (len(text) - ascii_count)
+
+
+# メッセージのリストのトークン数を数えます。メッセージごとのオーバーヘッドも含めます
+def count_message_tokens(messages):
+    return sum(count_tokens(message['content']) + 4 for message in messages)
+
+
+# トークン数の上限に収まるように会話履歴を組み立てるクラス
+class HistoryBuilder:
+    # コンストラクタで各ハンドラとトークン数の上限を初期化します
+    def __init__(self, dynamodb_handler, openai_handler, token_budget=HISTORY_TOKEN_BUDGET, fold_target=HISTORY_FOLD_TARGET):
+        self.dynamodb_handler = dynamodb_handler
+        self.openai_handler = openai_handler
+        self.token_budget = token_budget
+        self.fold_target = fold_target
+
+    # 会話履歴を組み立てます。上限に収まらない古い会話は返信の後にfoldで要約に畳み込みます
+    @traced('history.build')
+    def build(self, user_id, user_state):
+        # 要約はセッションごとの属性なので、新しいセッションでは以前のセッションの要約を使いません
+        summary = user_state.get_session_value('history_summary')
+        summary_until = user_state.get_session_value('history_summary_until')
+
+        # 現在のセッションのログだけを読み込み、要約済みの会話は除きます
+        # created_atはログごとに一意なので、要約した最後のログのcreated_atより後のログが未要約の会話です
+        logs = [log for log in self.dynamodb_handler.get_recent_logs(user_id, HISTORY_MAX_ITEMS, user_state.session_id)
+                if log['created_at'] > summary_until]
+
+        # 新しい会話から順に、上限に収まるだけ残します。収まらなかった会話は返信を待たせないよう後で要約します
+        kept = self.keep_recent(logs, self.token_budget - count_tokens(summary))
+        # 要約する会話はユーザー情報に保留します（要約, 未要約のログ）
+        user_state.pending_history_fold = (summary, logs) if len(kept) < len(logs) else None
+
+        conversation_history = []
+        if summary:
+            conversation_history.append({"role": "system", "content": f"これまでの会話の要約：\n{summary}"})
+        return conversation_history + logs_to_messages(kept)
+
+    # buildで上限に収まらなかった会話を要約に畳み込み、ユーザー情報に保存します
+    # 上限より少ない量まで畳み込むことで、次の数回の会話では要約を作り直さずに済むようにします
+    # OpenAIへのリクエストはステップとしてyieldします
+    @traced('history.fold')
+    def fold_steps(self, user_id, user_state):
+        pending_fold, user_state.pending_history_fold = user_state.pending_history_fold, None
+        if pending_fold is None:
+            return
+        summary, logs = pending_fold
+        kept = self.keep_recent(logs, int(self.token_budget * self.fold_target) - count_tokens(summary))
+        overflow = logs[:len(logs) - len(kept)]
+        if not overflow:
+            return
+        summary = yield from self.openai_handler.summarize_history_steps(summary, logs_to_messages(overflow))
+        user_state.set_history_summary(summary, overflow[-1]['created_at'])
+
+    # 新しい会話から順に、トークン数の上限に収まるだけのログを返します
+    def keep_recent(self, logs, budget):
+        used_tokens = 0
+        kept_count = 0
+        for log in reversed(logs):
+            tokens = count_tokens(log['user_message']) + count_tokens(log['ai_response']) + 8
+            if used_tokens + tokens > budget:
+                break
+            used_tokens += tokens
+            kept_count += 1
+        return logs[len(logs) - kept_count:]
+
+
+# ログの項目をOpenAI APIのメッセージ形式に変換します
+def logs_to_messages(logs):
+    messages = []
+    for log in logs:
+        messages.append({"role": "user", "content": log['user_message']})
+        messages.append({"role": "assistant", "content": log['ai_response']})
+    return messages
@@ -0,0 +1,143 @@
+import collections
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from concurrency_limit import create_concurrency_limit
+
+# リトライ対象とするステータスコードです
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+# コネクションを再利用し、タイムアウトとリトライを備えたHTTPクライアントのクラス
+class RetryingHttpClient:
+    # コンストラクタでセッションとリトライ、ヘッジリクエストの設定を初期化します
+    # total_timeoutはリトライの待ち時間を含めた1回の呼び出し全体の上限（秒）です
+    def __init__(self, connect_timeout=3.05, read_timeout=120, max_retries=3, backoff_base=0.5,
+                 backoff_max=8.0, pool_size=10, hedge=False, hedge_min_delay=1.0, hedge_window=100, max_in_flight=0,
+                 total_timeout=150):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+
+        # Keep-Aliveでコネクションを使い回すためのセッションです
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # 同時に送信するリクエスト数の上限です（0の場合は制限しません）。リトライの待ち時間中は枠を空けます
+        self.max_in_flight = max_in_flight
+        self.in_flight_limit = create_concurrency_limit(max_in_flight)
+
+        # ヘッジリクエストの待ち時間を決めるために、最近のレイテンシを記録します
+        self.latencies = collections.deque(maxlen=hedge_window)
+        self.latencies_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=pool_size) if hedge else None
+
+        # 直近の呼び出しで行ったリトライ回数です。複数のスレッドから呼び出されるため、スレッドごとに記録します
+        self.local = threading.local()
+
+    # このスレッドの直近の呼び出しで行ったリトライ回数です
+    @property
+    def last_retry_count(self):
+        return getattr(self.local, 'retry_count', 0)
+
+    @last_retry_count.setter
+    def last_retry_count(self, retry_count):
+        self.local.retry_count = retry_count
+
+    # POSTリクエストを送信します。429/5xxと通信エラーの場合は指数バックオフでリトライします
+    # リトライを含めた全体がtotal_timeoutを超えないよう、各リクエストの読み込みのタイムアウトを残り時間で切り詰め、
+    # 残り時間内に次のリクエストを送れない場合は最後の応答を返すか、例外を送出します
+    # stream=Trueの場合はレスポンス本文を逐次読み込めるように返します（ヘッジは行いません）
+    # 返すレスポンスのretry_countには、この呼び出しで行ったリトライ回数を設定します
+    # deadline（time.monotonic()の値）を指定した場合は、total_timeoutの代わりにその時刻を全体の期限にします
+    def post(self, url, headers=None, json=None, stream=False, deadline=None):
+        if deadline is None:
+            deadline = time.monotonic() + self.total_timeout
+        retry_count = 0
+        while True:
+            try:
+                timeout = self.get_timeout(deadline)
+                with self.in_flight_limit:
+                    if stream:
+                        response = self.timed_post(url, headers, json, timeout, stream=True)
+                    else:
+                        response = self.send(url, headers, json, timeout, deadline)
+                delay = self.get_retry_delay(retry_count, response)
+                if (response.status_code not in RETRYABLE_STATUS_CODES or retry_count >= self.max_retries
+                        or time.monotonic() + delay >= deadline):
+                    self.last_retry_count = retry_count
+                    response.retry_count = retry_count
+                    return response
+                response.close()
+            except (requests.ConnectionError, requests.Timeout):
+                delay = self.get_retry_delay(retry_count, None)
+                if retry_count >= self.max_retries or time.monotonic() + delay >= deadline:
+                    self.last_retry_count = retry_count
+                    raise
+            retry_count += 1
+            time.sleep(delay)
+
+    # 残り時間に合わせた(接続, 読み込み)のタイムアウトを返します。残り時間がない場合はTimeoutを送出します
+    def get_timeout(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout(f"Exceeded the total timeout of {self.total_timeout} seconds")
+        return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+    # 1回分のリクエストを送信します。ヘッジが有効な場合は遅いリクエストに2本目を重ねます
+    def send(self, url, headers, json, timeout, deadline):
+        if not self.hedge:
+            return self.timed_post(url, headers, json, timeout)
+
+        first = self.executor.submit(self.timed_post, url, headers, json, timeout)
+        done, _ = wait([first], timeout=min(self.get_hedge_delay(), max(0.0, deadline - time.monotonic())))
+        if done:
+            return first.result()
+
+        # 一定時間内に応答がない場合は、2本目のリクエストを送信して早い方を採用します
+        second = self.executor.submit(self.timed_post, url, headers, json, self.get_timeout(deadline))
+        done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+        winner = next(iter(done))
+        if winner.exception() is None:
+            return winner.result()
+        # 先に完了したリクエストが失敗した場合は、もう一方の結果を待ちます
+        other = second if winner is first else first
+        return other.result()
+
+    # レイテンシを記録しながらPOSTリクエストを送信します
+    def timed_post(self, url, headers, json, timeout, stream=False):
+        started_at = time.monotonic()
+        response = self.session.post(url, headers=headers, json=json, timeout=timeout, stream=stream)
+        with self.latencies_lock:
+            self.latencies.append(time.monotonic() - started_at)
+        return response
+
+    # 最近のレイテンシのp95をヘッジリクエストの待ち時間として返します
+    def get_hedge_delay(self):
+        with self.latencies_lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < 20:
+            return max(self.hedge_min_delay, latencies[-1] if latencies else 0)
+        return max(self.hedge_min_delay, latencies[int(len(latencies) * 0.95) - 1])
+
+    # リトライまでの待ち時間をジッター付きの指数バックオフで計算します
+    def get_retry_delay(self, retry_count, response):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** retry_count)))
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from dynamodb_handler import get_dynamodb_resource, is_conditional_check_failed
+
+# 処理済みのイベントIDを記録するテーブルです。未設定の場合はプロセス内のメモリに記録します
+IDEMPOTENCY_TABLE_NAME = os.environ.get('IDEMPOTENCY_TABLE_NAME')
+# 処理済みのイベントIDを保持する秒数です（DynamoDBのTTLで削除されます）
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 60 * 60)))
+# 処理中のイベントが異常終了した場合に、再配信で処理をやり直せるようになるまでの秒数です
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '300'))
+
+STATUS_IN_PROGRESS = 'IN_PROGRESS'
+STATUS_COMPLETED = 'COMPLETED'
+
+
+# 処理済みのイベントIDをDynamoDBに条件付き書き込みで記録するクラス
+class DynamoDBIdempotencyStore:
+    # コンストラクタでテーブル名を設定します
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    # スレッドごとのリソースからテーブルオブジェクトを取得します
+    @property
+    def table(self):
+        return get_dynamodb_resource().Table(self.table_name)
+
+    # イベントの処理を開始します。初めてのイベントであればNoneを、重複したイベントであれば記録済みの項目を返します
+    def begin(self, event_id):
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={
+                    'event_id': event_id,
+                    'status': STATUS_IN_PROGRESS,
+                    'lease_expires_at': now + IDEMPOTENCY_LEASE_SECONDS,
+                    'expires_at': now + IDEMPOTENCY_TTL_SECONDS
+                },
+                ConditionExpression="attribute_not_exists(event_id) OR (#status = :in_progress AND lease_expires_at < :now)",
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':in_progress': STATUS_IN_PROGRESS, ':now': now},
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+            return None
+        except ClientError as e:
+            if not is_conditional_check_failed(e):
+                raise
+            item = e.response.get('Item', {})
+            return {
+                'status': item.get('status', {}).get('S'),
+                'result': item.get('result', {}).get('S')
+            }
+
+    # イベントの処理が完了したことを結果とともに記録します
+    def complete(self, event_id, result):
+        self.table.update_item(
+            Key={'event_id': event_id},
+            UpdateExpression="SET #status = :completed, #result = :result",
+            ExpressionAttributeNames={'#status': 'status', '#result': 'result'},
+            ExpressionAttributeValues={':completed': STATUS_COMPLETED, ':result': result or ''}
+        )
+
+    # 処理に失敗したイベントの記録を削除し、再配信で処理をやり直せるようにします
+    def release(self, event_id):
+        self.table.delete_item(Key={'event_id': event_id})
+
+
+# ローカルテスト用に処理済みのイベントIDをメモリに記録するクラス
+class InMemoryIdempotencyStore:
+    # コンストラクタで空の記録を初期化します
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}
+
+    # イベントの処理を開始します。初めてのイベントであればNoneを、重複したイベントであれば記録済みの項目を返します
+    def begin(self, event_id):
+        now = time.time()
+        with self.lock:
+            item = self.items.get(event_id)
+            if item is not None and item['expires_at'] >= now:
+                if not (item['status'] == STATUS_IN_PROGRESS and item['lease_expires_at'] < now):
+                    return {'status': item['status'], 'result': item.get('result')}
+            self.items[event_id] = {
+                'status': STATUS_IN_PROGRESS,
+                'lease_expires_at': now + IDEMPOTENCY_LEASE_SECONDS,
+                'expires_at': now + IDEMPOTENCY_TTL_SECONDS
+            }
+            return None
+
+    # イベントの処理が完了したことを結果とともに記録します
+    def complete(self, event_id, result):
+        with self.lock:
+            item = self.items.get(event_id)
+            if item is not None:
+                item['status'] = STATUS_COMPLETED
+                item['result'] = result
+
+    # 処理に失敗したイベントの記録を削除し、再配信で処理をやり直せるようにします
+    def release(self, event_id):
+        with self.lock:
+            self.items.pop(event_id, None)
+
+
+# 環境変数の設定に応じた記録先を作成します
+# Lambdaでは再配信が別の実行環境に届くことがあり、メモリへの記録では重複を防げないため、テーブルの設定を必須にします
+def create_idempotency_store():
+    if IDEMPOTENCY_TABLE_NAME:
+        return DynamoDBIdempotencyStore(IDEMPOTENCY_TABLE_NAME)
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        raise ValueError("IDEMPOTENCY_TABLE_NAME is required when running on AWS Lambda")
+    print("Warning: IDEMPOTENCY_TABLE_NAME is not set; duplicate events are only detected within this process")
+    return InMemoryIdempotencyStore()
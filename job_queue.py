@@ -0,0 +1,96 @@
+import collections
+import json
+import os
+import sqlite3
+import threading
+
+# 非同期モードで使うジョブキューのバックエンドを環境変数から取得します（sqs / sqlite / memory）
+JOB_QUEUE_BACKEND = os.environ.get('JOB_QUEUE_BACKEND', 'sqs')
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL')
+JOB_QUEUE_SQLITE_PATH = os.environ.get('JOB_QUEUE_SQLITE_PATH', '/tmp/job_queue.sqlite3')
+
+
+# Amazon SQSをジョブキューとして使うクラス
+class SQSJobQueue:
+    # コンストラクタでSQSクライアントとキューのURLを初期化します
+    def __init__(self, queue_url):
+        import boto3
+        self.queue_url = queue_url
+        self.sqs = boto3.client('sqs')
+        # FIFOキューの場合はユーザーごとに順序を保証します
+        self.is_fifo = queue_url.endswith('.fifo')
+
+    # ジョブをキューに追加します
+    def enqueue(self, job):
+        params = {'QueueUrl': self.queue_url, 'MessageBody': json.dumps(job, ensure_ascii=False)}
+        if self.is_fifo:
+            # 返信の後に行うジョブは、ユーザーのメッセージとは別のグループ（group_id）で順序を保ちます
+            params['MessageGroupId'] = job.get('group_id') or job['user_id'] or 'unknown'
+            params['MessageDeduplicationId'] = job['job_id']
+        self.sqs.send_message(**params)
+
+    # Lambdaのイベントソース経由で受信するため、直接の取り出しはサポートしません
+    def dequeue(self):
+        return None
+
+
+# ローカルテスト用にSQLiteファイルをジョブキューとして使うクラス
+class SQLiteJobQueue:
+    # コンストラクタでデータベースファイルを開き、テーブルを作成します
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL)'
+        )
+        self.connection.commit()
+
+    # ジョブをキューに追加します
+    def enqueue(self, job):
+        with self.lock:
+            self.connection.execute('INSERT INTO jobs (body) VALUES (?)', (json.dumps(job, ensure_ascii=False),))
+            self.connection.commit()
+
+    # 最も古いジョブを取り出します。キューが空の場合はNoneを返します
+    def dequeue(self):
+        with self.lock:
+            row = self.connection.execute('SELECT id, body FROM jobs ORDER BY id LIMIT 1').fetchone()
+            if row is None:
+                return None
+            self.connection.execute('DELETE FROM jobs WHERE id = ?', (row[0],))
+            self.connection.commit()
+        return json.loads(row[1])
+
+
+# ローカルテスト用にプロセス内のメモリをジョブキューとして使うクラス
+class InProcessJobQueue:
+    # コンストラクタで空のキューを初期化します
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = collections.deque()
+
+    # ジョブをキューに追加します
+    def enqueue(self, job):
+        with self.lock:
+            self.jobs.append(job)
+
+    # 最も古いジョブを取り出します。キューが空の場合はNoneを返します
+    def dequeue(self):
+        with self.lock:
+            if not self.jobs:
+                return None
+            return self.jobs.popleft()
+
+
+# 環境変数の設定に応じたジョブキューを作成します
+def create_job_queue(backend=None):
+    backend = backend or JOB_QUEUE_BACKEND
+    if backend == 'sqs':
+        if not JOB_QUEUE_URL:
+            raise ValueError("JOB_QUEUE_URL is required for the sqs job queue backend")
+        return SQSJobQueue(JOB_QUEUE_URL)
+    if backend == 'sqlite':
+        return SQLiteJobQueue(JOB_QUEUE_SQLITE_PATH)
+    if backend == 'memory':
+        return InProcessJobQueue()
+    raise ValueError(f"Unknown job queue backend: {backend}")
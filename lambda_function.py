@@ -1,8 +1,11 @@
 import json
 import os
-from dynamodb_handler import DynamoDBHandler
-from openai_handler import OpenAIHandler
-from line_handler import LineHandler
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# boto3、linebot、requestsなどの重いモジュールはコールドスタートを短くするため、
+# 初めて必要になった時に読み込みます（get_handlersなどを参照）
 
 # AWS Lambda functionの環境変数から必要な情報を取得します
 USER_TABLE_NAME = os.environ['USER_TABLE_NAME']
@@ -10,56 +13,345 @@ LOG_TABLE_NAME = os.environ['LOG_TABLE_NAME']
 CHANNEL_ACCESS_TOKEN = os.environ['LINE_CHANNEL_ACCESS_TOKEN']
 OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
 
+# 1回の配信で同時に処理するイベント数の上限です
+MAX_EVENT_WORKERS = int(os.environ.get('MAX_EVENT_WORKERS', '8'))
+# 非同期モードでは受信したイベントをジョブキューに積んで即座に応答します
+ASYNC_MODE = os.environ.get('ASYNC_MODE', '0') == '1'
+# リプライトークンの有効期限を考慮し、これより古いイベントにはプッシュメッセージで返信します
+REPLY_TOKEN_TTL_SECONDS = int(os.environ.get('REPLY_TOKEN_TTL_SECONDS', '50'))
+# 返信の後に行うジョブ（「分からない」の別の質問の先読み、発表練習の回答の評価）の実行方法です（queue / thread / off）
+# queue: ジョブキューに積み、worker_handlerで実行します。Lambdaで返信を待たせずに実行する場合に使います
+# thread: このプロセスのバックグラウンドのスレッドで実行します。常駐するサーバーとローカルの実行に使います
+#         Lambdaは応答を返すと一時停止するため、Lambdaでは使いません
+# off: 実行しません。先読みは行われず、発表練習のフィードバックは回答の評価のメモなしで作成します
+# 既定では、Lambdaでは非同期モードかJOB_QUEUE_URLを設定している場合にqueue、それ以外はoffとし、Lambda以外ではthreadとします
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+    DEFAULT_FOLLOW_UP_JOBS = 'queue' if ASYNC_MODE or os.environ.get('JOB_QUEUE_URL') else 'off'
+else:
+    DEFAULT_FOLLOW_UP_JOBS = 'thread'
+FOLLOW_UP_JOBS = os.environ.get('FOLLOW_UP_JOBS') or DEFAULT_FOLLOW_UP_JOBS
+# threadの場合に、返信の後に行うジョブを同時に実行する数の上限です
+FOLLOW_UP_THREADS = int(os.environ.get('FOLLOW_UP_THREADS', '4'))
+
+# 以下はウォームスタート時に再利用するため、モジュールスコープに保持します
+JOB_QUEUE = None
+# 再配信されたイベントを重複して処理しないよう、処理済みのイベントIDを記録します
+IDEMPOTENCY_STORE = None
+# イベントを並行して処理するワーカープールです
+EVENT_EXECUTOR = None
+# 返信の後に行うジョブを実行するスレッドプールです
+FOLLOW_UP_EXECUTOR = None
+# ハンドラはスレッドごとに作成して再利用します
+HANDLERS = threading.local()
+INIT_LOCK = threading.Lock()
+
+# ジョブキューを取得します。ウォームスタート時は作成済みのキューを再利用します
+def get_job_queue():
+    global JOB_QUEUE
+    if JOB_QUEUE is None:
+        from job_queue import create_job_queue
+        JOB_QUEUE = create_job_queue()
+    return JOB_QUEUE
+
+# 処理済みのイベントIDの記録先を取得します
+def get_idempotency_store():
+    global IDEMPOTENCY_STORE
+    with INIT_LOCK:
+        if IDEMPOTENCY_STORE is None:
+            from idempotency import create_idempotency_store
+            IDEMPOTENCY_STORE = create_idempotency_store()
+    return IDEMPOTENCY_STORE
+
+# イベントを処理するワーカープールを取得します。スレッドを使い回すことで、スレッドごとのハンドラも再利用されます
+def get_event_executor():
+    global EVENT_EXECUTOR
+    with INIT_LOCK:
+        if EVENT_EXECUTOR is None:
+            EVENT_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_EVENT_WORKERS)
+    return EVENT_EXECUTOR
+
+# 返信の後に行うジョブを実行するスレッドプールを取得します
+def get_follow_up_executor():
+    global FOLLOW_UP_EXECUTOR
+    with INIT_LOCK:
+        if FOLLOW_UP_EXECUTOR is None:
+            FOLLOW_UP_EXECUTOR = ThreadPoolExecutor(max_workers=FOLLOW_UP_THREADS)
+    return FOLLOW_UP_EXECUTOR
+
+# 各ハンドラを取得します。初回の呼び出しで作成し、以降は同じスレッドで再利用します
+def get_handlers():
+    if not hasattr(HANDLERS, 'line_handler'):
+        from dynamodb_handler import DynamoDBHandler
+        from openai_handler import OpenAIHandler
+        from line_handler import LineHandler
+        HANDLERS.dynamodb_handler = DynamoDBHandler(USER_TABLE_NAME, LOG_TABLE_NAME)
+        HANDLERS.openai_handler = OpenAIHandler(OPENAI_API_KEY, HANDLERS.dynamodb_handler)
+        HANDLERS.line_handler = LineHandler(HANDLERS.dynamodb_handler, HANDLERS.openai_handler)
+    return HANDLERS.dynamodb_handler, HANDLERS.openai_handler, HANDLERS.line_handler
+
 def lambda_handler(event, context):
     # eventのbodyをJSONとして読み込みます
     body = json.loads(event['body'])
+    events = body.get('events', [])
+
+    # 非同期モードの場合はイベントをジョブキューに積み、すぐにレスポンスを返します
+    if ASYNC_MODE:
+        enqueue_events(events)
+        return {'statusCode': 200, 'body': json.dumps('Accepted!')}
+
+    # 処理済みのイベントIDの記録先を設定していない場合は、イベントごとの失敗として握りつぶされて返信が止まるため、
+    # イベントを処理する前に呼び出し全体を失敗させます
+    get_idempotency_store()
+
+    # 同じユーザーのイベントは順番通りに処理するため、ユーザーIDごとにまとめます
+    events_by_user = {}
+    for line_event in events:
+        user_id = line_event.get('source', {}).get('userId')
+        events_by_user.setdefault(user_id, []).append(line_event)
+
+    # ユーザーごとのイベント列をワーカープールで並行して処理します
+    executor = get_event_executor()
+    futures = [executor.submit(process_user_events, user_events) for user_events in events_by_user.values()]
+    for future in futures:
+        future.result()
+
+    # 返信の後に、バッファにたまったログをまとめて書き込みます
+    flush_logs()
+
+    # レスポンスを返します
+    return {'statusCode': 200, 'body': json.dumps('Success!')}
+
+
+# イベントをジョブとしてジョブキューに追加します
+def enqueue_events(events):
+    job_queue = get_job_queue()
+    for index, line_event in enumerate(events):
+        job_id = line_event.get('webhookEventId') or f"{line_event.get('replyToken')}:{index}"
+        job_queue.enqueue({
+            'job_id': job_id,
+            'user_id': line_event.get('source', {}).get('userId'),
+            'event': line_event,
+        })
+
+
+# SQSから起動されるワーカーのエントリポイントです
+# 失敗したジョブはbatchItemFailuresとして返し、SQSに再配信させます（イベントソースでReportBatchItemFailuresを有効にします）
+def worker_handler(event, context):
+    # lambda_handlerと同じく、記録先の設定の誤りはジョブごとではなく呼び出し全体の失敗にします
+    get_idempotency_store()
+    failures = []
+    failed_users = set()
+    for record in event.get('Records', []):
+        job = json.loads(record['body'])
+        # FIFOキューでは同じユーザーの順序を保つため、失敗したジョブより後のジョブも再配信させます
+        if job.get('user_id') in failed_users:
+            failures.append({'itemIdentifier': record['messageId']})
+            continue
+        try:
+            process_job(job)
+        except Exception as e:
+            print(f"Error while processing job {job.get('job_id')}: {e}")
+            failed_users.add(job.get('user_id'))
+            failures.append({'itemIdentifier': record['messageId']})
+    flush_logs()
+    return {'batchItemFailures': failures}
+
 
+# 講義のストックを補充するジョブのエントリポイントです。EventBridgeのスケジュールから定期的に起動します
+def lecture_refill_handler(event, context):
+    from lecture_pool import create_lecture_store, refill_lecture_pools
+    store = create_lecture_store()
+    if store is None:
+        return {'statusCode': 200, 'body': json.dumps('Lecture pool is disabled.')}
+    _, openai_handler, _ = get_handlers()
+    refilled = refill_lecture_pools(store, openai_handler)
+    return {'statusCode': 200, 'body': json.dumps(refilled)}
+
+
+# 利用状況の集計を更新するエントリポイントです。ユーザーとログのテーブルのDynamoDB Streamsから起動します
+def usage_stream_handler(event, context):
+    from usage_aggregates import apply_stream_records, create_aggregate_store
+    applied = apply_stream_records(event.get('Records', []), create_aggregate_store())
+    return {'statusCode': 200, 'body': json.dumps({'applied': applied})}
+
+
+# ローカルテスト用に、ジョブキューが空になるまでジョブを処理します
+def drain_job_queue(job_queue=None):
+    job_queue = job_queue or get_job_queue()
+    processed = 0
+    while True:
+        job = job_queue.dequeue()
+        if job is None:
+            flush_logs()
+            return processed
+        try:
+            process_job(job)
+        except Exception as e:
+            print(f"Error while processing job {job.get('job_id')}: {e}")
+        processed += 1
+
+
+# ジョブキューから取り出した1つのジョブを処理します。失敗した場合は再配信できるように例外を送出します
+def process_job(job):
+    # 返信の後に行うジョブは、イベントと同じワーカーで実行します
+    if job.get('type') is not None:
+        run_follow_up_job(job)
+        return
+    line_event = dict(job['event'])
+    # リプライトークンが期限切れに近い場合は、プッシュメッセージで返信するためにトークンを破棄します
+    timestamp = line_event.get('timestamp')
+    if timestamp is not None and time.time() - timestamp / 1000 > REPLY_TOKEN_TTL_SECONDS:
+        line_event['replyToken'] = None
+    dynamodb_handler, openai_handler, line_handler = get_handlers()
+    process_event(line_event, dynamodb_handler, openai_handler, line_handler)
+
+
+# バッファにたまったログを書き込みます
+def flush_logs():
+    from log_sink import flush_all_log_sinks
+    flush_all_log_sinks()
+
+
+# 返信の後に行うジョブを、設定に応じてジョブキューまたはバックグラウンドのスレッドに渡します
+# ジョブを渡せなくても返信は済んでいるので、例外は送出しません
+def submit_follow_up_jobs(jobs):
+    for job in jobs:
+        try:
+            if FOLLOW_UP_JOBS == 'queue':
+                get_job_queue().enqueue(job)
+            elif FOLLOW_UP_JOBS == 'thread':
+                get_follow_up_executor().submit(run_follow_up_job, job)
+        except Exception as e:
+            print(f"Error while submitting follow-up job {job['job_id']}: {e}")
+
+
+# 返信の後に行う1つのジョブを、このスレッドのハンドラで実行します
+def run_follow_up_job(job):
+    _, _, line_handler = get_handlers()
+    line_handler.run_follow_up_job(job)
+
+
+# バックグラウンドのスレッドで実行中のジョブがすべて完了するまで待ちます。常駐するサーバーの終了時などに呼び出します
+def wait_for_follow_up_jobs():
+    global FOLLOW_UP_EXECUTOR
+    with INIT_LOCK:
+        executor, FOLLOW_UP_EXECUTOR = FOLLOW_UP_EXECUTOR, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+# 1ユーザー分のイベントを受信順に処理します
+def process_user_events(user_events):
+    # 各ハンドラを取得します。ウォームスタート時は作成済みのハンドラを再利用します
+    dynamodb_handler, openai_handler, line_handler = get_handlers()
+
+    for line_event in user_events:
+        # 1つのイベントの失敗が他のイベントに影響しないように、イベントごとに例外を捕捉します
+        try:
+            process_event(line_event, dynamodb_handler, openai_handler, line_handler)
+        except Exception as e:
+            print(f"Error while processing event: {e}")
+
+
+# 1つのLINEイベントを処理します
+def process_event(line_event, dynamodb_handler, openai_handler, line_handler):
+    from steps import run_steps
+    return run_steps(process_event_steps(line_event, dynamodb_handler, openai_handler, line_handler))
+
+
+# process_eventと同じ処理を、OpenAIへのリクエストをステップとしてyieldするジェネレータで行います
+# 常駐するサーバーは、このジェネレータを使ってOpenAIの応答をイベントループで待ちます
+def process_event_steps(line_event, dynamodb_handler, openai_handler, line_handler):
     # LINEからのリクエストのトークンとユーザーIDを取得します
-    reply_token = body['events'][0]['replyToken']
-    user_id = body['events'][0]['source']['userId']
-    
-    # 各ハンドラを初期化します
-    dynamodb_handler = DynamoDBHandler(USER_TABLE_NAME, LOG_TABLE_NAME)
-    openai_handler = OpenAIHandler(OPENAI_API_KEY,dynamodb_handler) 
-    line_handler = LineHandler(dynamodb_handler, openai_handler)
+    reply_token = line_event.get('replyToken')
+    user_id = line_event.get('source', {}).get('userId')
+    user_message = None
+
+    # リプライトークンを持たないイベント（フォロー解除など）は処理しません
+    if user_id is None or 'replyToken' not in line_event:
+        return
 
     # イベントがメッセージタイプでない、またはメッセージがテキストタイプでない場合、エラーメッセージを設定します
-    if not body['events'][0]['type'] == 'message':
+    if not line_event['type'] == 'message':
         error_message = "Error: Event is not a message type."
-    elif not body['events'][0]['message']['type'] == 'text':
+    elif not line_event['message']['type'] == 'text':
         error_message = "Error: Message is not a text type."
     else:
         # メッセージを取得します
-        user_message = body['events'][0]['message']['text']
+        user_message = line_event['message']['text']
         error_message = None
 
+    # 再配信されたイベントは、OpenAIの呼び出しや利用回数の加算を行う前に処理を打ち切ります
+    event_id = line_event.get('webhookEventId')
+    if event_id is not None:
+        idempotency_store = get_idempotency_store()
+        previous = idempotency_store.begin(event_id)
+        if previous is not None:
+            print(f"Skipped duplicate event: {event_id} ({previous['status']})")
+            return previous.get('result')
+
     # ユーザーメッセージを処理します
-    handle_user_message(user_message, reply_token, user_id, error_message, dynamodb_handler, openai_handler, line_handler)
+    try:
+        ai_response = yield from handle_user_message_steps(user_message, reply_token, user_id, error_message, dynamodb_handler, openai_handler, line_handler)
+    except Exception:
+        # 処理に失敗した場合は、再配信で処理をやり直せるように記録を削除します
+        if event_id is not None:
+            idempotency_store.release(event_id)
+        raise
+    if event_id is not None:
+        idempotency_store.complete(event_id, ai_response)
+    return ai_response
 
-    # レスポンスを返します
-    return {'statusCode': 200, 'body': json.dumps('Success!')}
+
+def handle_user_message_steps(user_message, reply_token, user_id, error_message, dynamodb_handler, openai_handler, line_handler):
+    # 各段階（DynamoDB、OpenAI、LINE）にかかった時間をトレースとして記録します
+    from tracing import start_trace
+    with start_trace('handle_user_message'):
+        return (yield from handle_traced_user_message_steps(user_message, reply_token, user_id, error_message, dynamodb_handler, openai_handler, line_handler))
 
 
-def handle_user_message(user_message, reply_token, user_id, error_message, dynamodb_handler, openai_handler, line_handler):
+# トレースの中でユーザーメッセージを処理します
+def handle_traced_user_message_steps(user_message, reply_token, user_id, error_message, dynamodb_handler, openai_handler, line_handler):
     DEFAULT_MODE_CODE = 0
     # エラーメッセージがある場合、それを返します
     if error_message:
-        line_handler.reply_message(reply_token, error_message,DEFAULT_MODE_CODE)
-        return
+        line_handler.reply_message(reply_token, error_message,DEFAULT_MODE_CODE, user_id)
+        return error_message
 
-    # 現在のモードコードを取得します
-    mode_code = dynamodb_handler.get_mode_code(user_id)
+    # ユーザー情報を1回だけ読み込み、現在のモードコードを取得します
+    from tracing import get_current_trace, set_trace_attributes
+    from user_state import UserState
+    user_state = UserState(dynamodb_handler, user_id)
+    mode_code = user_state.mode_code
+    set_trace_attributes(mode_code=mode_code)
 
     # ユーザーメッセージを処理し、新たなプロンプトとモードコードを取得します
-    prompt, new_mode_code, ai_response = line_handler.process_user_message(user_message, reply_token, user_id)
+    prompt, new_mode_code, ai_response = yield from line_handler.process_user_message_steps(user_message, reply_token, user_id, user_state)
 
     # 新しいモードコードがある場合、それを更新します
     if new_mode_code is not None:
         mode_code = new_mode_code
-        dynamodb_handler.update_mode_code(user_id, mode_code)
+        user_state.set_mode_code(mode_code)
+    set_trace_attributes(mode_code=mode_code)
+
+    # ログを保存します。返信までにかかった時間も記録し、利用状況の集計に使います
+    dynamodb_handler.save_log(user_id, user_message, ai_response, mode_code, user_state.session_id,
+                              latency_ms=get_current_trace().elapsed_ms())
+
+    # 終了時のフィードバックに備えて、たまった会話を分析しておきます
+    yield from line_handler.record_turn_steps(user_id, user_state, mode_code)
 
-    # ログを保存します
-    dynamodb_handler.save_log(user_id, user_message, ai_response, mode_code)
+    # 返信の後に、上限に収まらなかった会話履歴を要約しておきます
+    yield from line_handler.fold_history_steps(user_id, user_state)
+
+    # 書き込まれていないユーザー情報の変更をまとめてDynamoDBに反映します
+    user_state.flush()
+
+    # 書き込みの後に、先読みなどの返信の後に行うジョブを渡します
+    submit_follow_up_jobs(user_state.pending_jobs)
+    user_state.pending_jobs = []
 
     # クイックリプライ項目を生成します
     quick_reply_items = line_handler.generate_quick_reply_items(mode_code)
+
+    return ai_response
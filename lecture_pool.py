@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from mode_registry import LECTURE_TOPICS, build_lecture_prompt
+
+
+# 講義のストックの保存先です（dynamodb / file）。未設定の場合はストックを使いません
+LECTURE_POOL_BACKEND = os.environ.get('LECTURE_POOL_BACKEND', '')
+LECTURE_TABLE_NAME = os.environ.get('LECTURE_TABLE_NAME')
+LECTURE_POOL_DIR = os.environ.get('LECTURE_POOL_DIR', '/tmp/lecture_pool')
+# テーマごとに用意しておく講義の数と、保存しておく講義の最大数です
+LECTURE_POOL_SIZE = int(os.environ.get('LECTURE_POOL_SIZE', '20'))
+LECTURE_POOL_MAX = int(os.environ.get('LECTURE_POOL_MAX', '50'))
+
+
+# 講義のストックをDynamoDBに保存するクラス。テーマごとに1つの項目にまとめ、1回の読み込みで取得できるようにします
+class DynamoDBLectureStore:
+    # コンストラクタでテーブル名を設定します
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    # スレッドごとのリソースからテーブルオブジェクトを取得します
+    @property
+    def table(self):
+        from dynamodb_handler import get_dynamodb_resource
+        return get_dynamodb_resource().Table(self.table_name)
+
+    # テーマの講義のリストを取得します
+    def get_lectures(self, mode_code):
+        response = self.table.get_item(Key={'mode_code': mode_code})
+        return response.get('Item', {}).get('lectures', [])
+
+    # テーマの講義のリストの末尾に講義を追加します。最大数を超えた場合は古い講義を削除し、項目が大きくなり続けないようにします
+    def add_lectures(self, mode_code, lectures, pool_max=LECTURE_POOL_MAX):
+        response = self.table.update_item(
+            Key={'mode_code': mode_code},
+            UpdateExpression="SET lectures = list_append(if_not_exists(lectures, :empty), :lectures)",
+            ExpressionAttributeValues={':empty': [], ':lectures': lectures},
+            ReturnValues='UPDATED_NEW'
+        )
+        size = len(response['Attributes']['lectures'])
+        if size <= pool_max:
+            return
+        # 同時に追加された場合に二重に削除しないよう、読み込んだ時の件数のままであれば削除します
+        from botocore.exceptions import ClientError
+        from dynamodb_handler import is_conditional_check_failed
+        try:
+            self.table.update_item(
+                Key={'mode_code': mode_code},
+                UpdateExpression="REMOVE " + ", ".join(f"lectures[{index}]" for index in range(size - pool_max)),
+                ConditionExpression="size(lectures) = :size",
+                ExpressionAttributeValues={':size': size}
+            )
+        except ClientError as e:
+            if not is_conditional_check_failed(e):
+                raise
+
+
+# ローカルテスト用に講義のストックをJSONファイルに保存するクラス
+class FileLectureStore:
+    # コンストラクタで保存先のディレクトリを作成します
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # テーマの講義のリストを取得します
+    def get_lectures(self, mode_code):
+        path = self.get_path(mode_code)
+        if not os.path.exists(path):
+            return []
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    # テーマの講義のリストの末尾に講義を追加します。最大数を超えた場合は古い講義を削除します
+    # 読み込みから書き込みまでをロックし、同時に追加する他のスレッドやプロセス（補充のジョブなど）の講義を失わないようにします
+    def add_lectures(self, mode_code, lectures, pool_max=LECTURE_POOL_MAX):
+        path = self.get_path(mode_code)
+        with self.lock, open(path + '.lock', 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            lectures = (self.get_lectures(mode_code) + lectures)[-pool_max:]
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(lectures, f, ensure_ascii=False)
+            os.replace(path + '.tmp', path)
+
+    # テーマのファイルのパスを返します
+    def get_path(self, mode_code):
+        return os.path.join(self.directory, f'lectures_{mode_code}.json')
+
+
+# 環境変数の設定に応じた講義のストックの保存先を作成します。未設定の場合はNoneを返します
+def create_lecture_store(backend=None):
+    backend = backend if backend is not None else LECTURE_POOL_BACKEND
+    if backend == 'dynamodb':
+        return DynamoDBLectureStore(LECTURE_TABLE_NAME)
+    if backend == 'file':
+        return FileLectureStore(LECTURE_POOL_DIR)
+    if backend == '':
+        return None
+    raise ValueError(f"Unknown lecture pool backend: {backend}")
+
+
+# 生成済みの講義をユーザーに重複なく配るクラス
+class LecturePool:
+    # コンストラクタで保存先を初期化します
+    def __init__(self, store):
+        self.store = store
+
+    # ユーザーがまだ受けていない講義を1つ取り出します。ない場合はNoneを返します
+    def take(self, mode_code, user_state):
+        served_ids = set(user_state.get_served_lectures(mode_code))
+        for lecture in self.store.get_lectures(mode_code):
+            if lecture['id'] not in served_ids:
+                user_state.mark_lecture_served(mode_code, lecture['id'])
+                return lecture['text']
+        return None
+
+    # その場で生成した講義をストックに追加し、ユーザーが受けた講義として記録します
+    def add(self, mode_code, text, user_state):
+        lecture = {'id': uuid.uuid4().hex, 'text': text}
+        self.store.add_lectures(mode_code, [lecture])
+        user_state.mark_lecture_served(mode_code, lecture['id'])
+
+
+# 講義のストックが少ないテーマに講義を補充します。定期実行のジョブから呼び出します
+def refill_lecture_pools(store, openai_handler, pool_size=LECTURE_POOL_SIZE, pool_max=LECTURE_POOL_MAX):
+    refilled = {}
+    for mode_code in LECTURE_TOPICS:
+        lectures = store.get_lectures(mode_code)
+        new_lectures = []
+        for _ in range(max(0, pool_size - len(lectures))):
+            try:
+                text = openai_handler.generate_text(build_lecture_prompt(mode_code))
+            except Exception as e:
+                print(f"Error while generating a lecture: {e}")
+                break
+            new_lectures.append({'id': uuid.uuid4().hex, 'text': text})
+        # 生成している間にユーザーへの返信で追加された講義を上書きしないよう、置き換えずに追加します
+        # 最大数を超えた古い講義は追加の時に削除されます
+        if new_lectures or len(lectures) > pool_max:
+            store.add_lectures(mode_code, new_lectures, pool_max)
+        refilled[mode_code] = len(new_lectures)
+    return refilled
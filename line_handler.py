@@ -1,498 +1,305 @@
 from linebot import LineBotApi
-from linebot.models import TextSendMessage, QuickReply, QuickReplyButton, MessageAction
+from linebot.models import TextSendMessage
 import os
+import time
+from concurrency_limit import create_concurrency_limit
+from dynamodb_handler import DAILY_API_LIMIT, USAGE_LIMIT_MESSAGE, UsageContention, UsageLimitExceeded
+from feedback_pipeline import FeedbackPipeline
+from history_builder import HistoryBuilder
+from lecture_pool import LecturePool, create_lecture_store
+from metrics import log_metrics
+from mode_registry import ACTION_END, ACTION_ENTER, ACTION_FEEDBACK, ACTION_ALTERNATE, LECTURE_TOPICS, MODES, PRESENTATION_MODE_CODE, get_command, get_model_profile, get_quick_reply
+from openai_handler import SYSTEM_PROMPT
+from presentation_practice import EVALUATION_JOB, PresentationPractice
+from rate_limiter import RATE_LIMITED_MESSAGE, RateLimited
+from response_cache import ResponseCache, build_cache_key
+from speculation import SPECULATION_JOB, SPECULATIVE_ALTERNATES, AlternateSpeculator
+from steps import run_steps
+from tracing import set_span_attributes, traced
 
 # LINE Botのアクセストークンを環境変数から取得します
 CHANNEL_ACCESS_TOKEN = os.environ['LINE_CHANNEL_ACCESS_TOKEN']
-# LINE Bot APIのインスタンスを作成します
-LINE_BOT_API = LineBotApi(CHANNEL_ACCESS_TOKEN)
+# LINE Bot APIのインスタンスです。初めて必要になった時に作成し、ウォームスタート時に再利用します
+LINE_BOT_API = None
+# 講義のストックの保存先です。ウォームスタート時にも再利用します
+LECTURE_STORE = create_lecture_store()
+# ストリーミングモードではAIのレスポンスを文の区切りごとに分けて送信します
+OPENAI_STREAMING = os.environ.get('OPENAI_STREAMING', '0') == '1'
+# 英文添削などの応答のキャッシュです。ウォームスタート時にも再利用します
+RESPONSE_CACHE = ResponseCache()
+# LINE APIへの同時呼び出し数の上限です（0の場合は制限しません）
+LINE_IN_FLIGHT_LIMIT = create_concurrency_limit(int(os.environ.get('LINE_MAX_IN_FLIGHT', '0')))
+# 1回の応答で送信するメッセージ数の上限です（LINEの1回の返信の上限に合わせます）
+MAX_STREAM_MESSAGES = 5
+# 利用回数の上限や混雑で応答を生成できなかった場合に、例外の種類ごとにユーザーへ返信するメッセージです
+REFUSAL_MESSAGES = {
+    UsageLimitExceeded: USAGE_LIMIT_MESSAGE,
+    UsageContention: RATE_LIMITED_MESSAGE,
+    RateLimited: RATE_LIMITED_MESSAGE,
+}
+
+# LINE Bot APIのインスタンスを取得します
+def get_line_bot_api():
+    global LINE_BOT_API
+    if LINE_BOT_API is None:
+        LINE_BOT_API = LineBotApi(CHANNEL_ACCESS_TOKEN)
+    return LINE_BOT_API
+
+
 # LINE Botを制御するためのクラス
 class LineHandler:
     # コンストラクタでLINE Bot APIと他のハンドラを初期化します
     def __init__(self, dynamodb_handler, openai_handler):
-        self.line_bot_api = LINE_BOT_API
+        self.line_bot_api = get_line_bot_api()
         self.dynamodb_handler = dynamodb_handler
         self.openai_handler = openai_handler
-        
-        # モードごとのメッセージを辞書で定義
-        self.mode_messages = {
-            0: "モードを終了しました。",
-            1: "Alright,I'm ready to help you with your. English conversation practice!\n Please let me know the topic you'd like to talk about.\n\n話したいトピックを英語で送ってください！フリートークを完了したい場合は下の「完了」ボタンを押してください。「完了」が押されるとこれまでの会話を踏まえてのフィードバックが行われます。フリートーク中に質問が分からない場合は下の「分からない」ボタンを押してください。\n\n「完了」を押した後に会話を通してのフィードバックが送信されます。※フィードバックが生成されるのには時間が掛かります。",
-            2: "添削して欲しい英文を送ってください。※添削には時間が掛かります。",
-            3: "練習したい発表原稿を送ってください！この原稿を元に想定される質問を考えます。質問に答えると次の質問をします。\n\n練習を完了したい場合は下の「完了」ボタンを押してください。発表中の質問で分からない質問は下の「分からない」ボタンを押してください。\n\n「完了」を押した後に発表練習を通してのフィードバックが送信されます。※フィードバックが生成されるのには時間が掛かります。",
-            4: "習いたい講義内容を以下から選択してください！講義が始まります。講義生成には時間が掛かります。",
-        }
-
-    # LINE Bot APIを使ってメッセージを返信します
-    def reply_message(self, reply_token, ai_response, mode_code):
-         # 返信メッセージに含めるためのクイックリプライアイテムを生成します
-        quick_reply_items = self.generate_quick_reply_items(mode_code)
+        self.history_builder = HistoryBuilder(dynamodb_handler, openai_handler)
+        self.lecture_pool = LecturePool(LECTURE_STORE) if LECTURE_STORE is not None else None
+        self.presentation_practice = PresentationPractice(dynamodb_handler, openai_handler)
+        self.speculator = AlternateSpeculator(dynamodb_handler, openai_handler)
+        self.feedback_pipeline = FeedbackPipeline(dynamodb_handler, openai_handler)
+
+    # LINE Bot APIを使ってメッセージを返信します。リプライトークンがない場合はプッシュメッセージで送信します
+    @traced('line.reply_message')
+    def reply_message(self, reply_token, ai_response, mode_code, user_id=None):
+        # 返信メッセージには作成済みのクイックリプライを含めます
+        message = TextSendMessage(
+            text=ai_response,
+            quick_reply=get_quick_reply(mode_code)
+        )
         try:
-            # 返信メッセージを送信します
-            self.line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(
-                    text=ai_response,
-                    quick_reply=QuickReply(items=quick_reply_items)
-                ))
+            with LINE_IN_FLIGHT_LIMIT:
+                if reply_token is None and user_id is not None:
+                    # リプライトークンが期限切れの場合はプッシュメッセージを送信します
+                    self.line_bot_api.push_message(user_id, message)
+                else:
+                    # 返信メッセージを送信します
+                    self.line_bot_api.reply_message(reply_token, message)
         except Exception as e:
+            set_span_attributes(error=type(e).__name__)
             print(f"Error while replying to message: {e}")
 
-    
+    # ストリーミングで受信したテキストを順次送信します。最初はリプライ、以降はプッシュメッセージで送信します
+    # 送信したテキストの全文を返します
+    @traced('line.stream_reply')
+    def stream_reply(self, reply_token, chunks, mode_code, user_id):
+        pieces = []
+        remaining = ""
+        sent_count = 0
+        for chunk in chunks:
+            pieces.append(chunk)
+            # 上限の1つ手前までは受信した順に送信し、残りは最後のメッセージにまとめます
+            if sent_count < MAX_STREAM_MESSAGES - 1:
+                text = chunk.strip()
+                if text:
+                    self.reply_message(reply_token if sent_count == 0 else None, text, mode_code, user_id)
+                    sent_count += 1
+            else:
+                remaining += chunk
+        if remaining.strip():
+            self.reply_message(reply_token if sent_count == 0 else None, remaining.strip(), mode_code, user_id)
+        return "".join(pieces).strip()
 
     # ユーザーからのメッセージを処理します
-    def process_user_message(self,user_message, reply_token, user_id):
-        # DynamoDBからユーザーのモードコードを取得します
-        old_mode_code = self.dynamodb_handler.get_mode_code(user_id)
-        mode_code = old_mode_code
-        prompt = None  # OpenAI APIに送信するプロンプトを初期化します
-        
-        # 終了メッセージの場合はAPIを通さずにレスポンスを返します。
-        if user_message == "【英文添削:完了】" or user_message == "【会話フレーズ講義:完了】":
-            mode_code = 0
-            self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-            ai_response = self.mode_messages[0]
-            self.reply_message(reply_token, ai_response, mode_code)
-            return None, mode_code, ai_response  # これ以降の処理をスキップします
+    def process_user_message(self, user_message, reply_token, user_id, user_state):
+        return run_steps(self.process_user_message_steps(user_message, reply_token, user_id, user_state))
 
-        elif user_message == "【フリートーク:完了】":
-            mode_code = 0
-            self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-            prompt = '''#これまでの私の英文から私へのフィードバックをしてください。また、以下の要件を守ってください。
-    
-              # フィードバックの作り方
-              ・適切なタイミングで改行して、読みやすさを確保してください。
-              
-              # あなたのルール
-              ・日本語で私にフィードバックしてください。
-              ・これまでの会話を踏まえて、私のよかった点と私の改善した方がよい点をこれまでの英語の文章を取り上げながら具体的にフィードバックしてください。
-              
-              # フォーマット
-              今回の会話を通してのあなたへのフィードバックを行います。
-              
-              よかった点
-              
-              
-              
-              改善するべき点
-              
-              
-              
+    # process_user_messageと同じ処理を、OpenAIへのリクエストをステップとしてyieldするジェネレータで行います
+    # 応答を生成できなかった場合は、例外の種類に応じたメッセージをここで返信します
+    def process_user_message_steps(self, user_message, reply_token, user_id, user_state):
+        try:
+            return (yield from self.respond_steps(user_message, reply_token, user_id, user_state))
+        except tuple(REFUSAL_MESSAGES) as e:
+            # 応答を生成できなかった場合は、会話履歴の要約も行いません
+            user_state.pending_history_fold = None
+            ai_response = REFUSAL_MESSAGES[type(e)]
+            self.reply_message(reply_token, ai_response, user_state.mode_code, user_id)
+            return None, user_state.mode_code, ai_response
+
+    # メッセージに応じた応答を返信し、(プロンプト, モードコード, 返信したテキスト)を返します
+    def respond_steps(self, user_message, reply_token, user_id, user_state):
+        # 読み込み済みのユーザー情報からモードコードを取得します
+        old_mode_code = user_state.mode_code
+        mode_code = old_mode_code
+        use_history = True
 
-              以上になります！ありがとうございました！
-              '''
-        elif user_message == "I don't know.":
-            prompt = "同じ話題で別の質問を英語でしてください。"
+        # メッセージに完全一致するコマンドを対応表から取得します
+        command = get_command(user_message)
+        if command is None:
+            # コマンドでない場合は、現在のモードで会話を続けます
+            prompt = f'ユーザー：{user_message}\nAI：'
 
-        elif user_message == "【発表練習:完了】":
-            mode_code = 0
-            self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-            prompt = '''#聞き手としてこれまでの会話から私へのフィードバックをしてください。また、以下の要件を守ってください。
+        elif command.action == ACTION_END:
+            # 終了メッセージの場合はAPIを通さずにレスポンスを返します。
+            mode_code = command.mode_code
+            user_state.set_mode_code(mode_code)
+            ai_response = MODES[mode_code].entry_message
+            self.reply_message(reply_token, ai_response, mode_code, user_id)
+            return None, mode_code, ai_response  # これ以降の処理をスキップします
 
-              # フィードバックの作り方
-              ・適切なタイミングで改行して、読みやすさを確保してください。
-              
-              # あなたのルール
-              ・日本語でフィードバックしてください。
-              ・これまでの会話を踏まえて、発表の内容として私のよかった点と改善した方がよい点をこれまでの英語の文章を取り上げながら、具体的にフィードバックしてください。
-        
-              # フォーマット
-              今回の会話を通してのあなたへのフィードバックを行います。
-              
-              よかった点
-              
-              
-              
-              改善するべき点
-              
-              
-              
-              
-              以上になります！ありがとうございました！
-              '''
-        elif user_message == "【発表練習:分からない】":
+        elif command.action == ACTION_FEEDBACK:
+            mode_code = command.mode_code
+            user_state.set_mode_code(mode_code)
+            prompt = command.prompt
+            # 会話を分割して分析しておくモードでは、会話履歴の代わりに分析した結果からフィードバックを作成します
+            if MODES[old_mode_code].chunked_feedback:
+                prompt = yield from self.feedback_pipeline.build_prompt_steps(prompt, user_id, user_state)
+                use_history = False
+            # 発表練習の回答の評価メモがあれば、フィードバックに使います
+            if old_mode_code == PRESENTATION_MODE_CODE:
+                prompt = self.presentation_practice.build_feedback_prompt(prompt, user_state)
+
+        elif command.action == ACTION_ALTERNATE:
             # mode_code remains the same
-            prompt = "同じ話題で別の質問を英語でしてください。"
-            
-        elif user_message.startswith("【モード:"):
-            if "フリートーク" in user_message:
-                mode_code = 1
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話講師です。これから私が送る話したいトピックについて英語で話してください。
-                
-                #あなたのルール
-                ・英文は数行の文章を送ってください。
-                ・毎回１個だけ質問をしてください。
-                ・丁寧で文法的に正しい英語を使ってください。
-                ・絵文字をたくさん使用して会話を続けてください。
-                ・適切なタイミングで改行して、読みやすさを確保してください。
-                
-                '''
-                        
-            elif "英文添削" in user_message:
-                mode_code = 2
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = "#あなたは英文添削のプロです。私が送る英文を、文法的に丁寧で正しい英語に修正してください。"
-                      
-            elif "発表練習" in user_message:
-                mode_code = 3
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは就職活動支援のプロです。これから私が練習したい英文を送るので、その英文から面接官が質問してくるであろう質問をしてください。\n\n#あなたのルール\n・あなたが文章を送る時は、１つだけ英語で質問をしてください。\n・質問は合計で3回してください。\n\n#質問形式の例\n私：I am interested in soccer.\nあなた：Q1:How did you become interested in soccer?\n私：I went to see a game with my father.\nあなた：Q2:What did you find interesting about soccer?'''
-                
-
-            elif "会話フレーズ講義" in user_message:
-                mode_code = 4
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                ai_response = self.mode_messages[4]
-                self.reply_message(reply_token, ai_response, mode_code)
-                return None, mode_code, ai_response
-
-            elif "日常生活" in user_message:
-                mode_code = 5
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これから日常生活について、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-            elif "気持ち" in user_message:
-                mode_code = 6
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これから気持ちについて、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-
-            elif "天気" in user_message:
-                mode_code = 7
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これから天気について、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-
-            elif "観光" in user_message:
-                mode_code = 8
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これから観光について、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-
-            elif "レストラン" in user_message:
-                mode_code = 9
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これからレストランについて、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-
-            elif "ショッピング" in user_message:
-                mode_code = 10
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これからショッピングについて、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-
-            elif "学校" in user_message:
-                mode_code = 11
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これから学校について、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-
-            elif "スポーツ" in user_message:
-                mode_code = 12
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これからスポーツについて、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-
-            elif "恋愛" in user_message:
-                mode_code = 13
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これから恋愛について、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-
-            elif "ビジネス" in user_message:
-                mode_code = 14
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これからビジネスについて、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-
-            elif "電話" in user_message:
-                mode_code = 15
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これから電話について、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-
-            elif "会議" in user_message:
-                mode_code = 16
-                self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
-                prompt = '''#あなたは英会話の講師です。これから会議について、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
-
-                            ＃講義フォーマット
-                            【講義内容】
-                            
-                            
-                            
-                            【フレーズ】
-                            
-                            
-                            【例文】
-                            
-                            
-                            【練習】
-                            
-                            
-                            
-                            上記のシナリオのように、メッセージを送って練習してみましょう！
-                '''
-
-            if mode_code != old_mode_code and 0 <= mode_code <= 4:
-                ai_response = self.mode_messages[mode_code]
-                self.reply_message(reply_token, ai_response, mode_code)
-                # Update the user mode_code in DynamoDB
-                self.dynamodb_handler.update_mode_code(user_id, mode_code)
-                return None, mode_code, ai_response  
-                
+            prompt = command.prompt
 
         else:
-            prompt = f'ユーザー：{user_message}\nAI：'
-            self.dynamodb_handler.update_user_usage(user_id, 0, mode_code)
+            # モードに入るたびに新しいセッションを開始し、以前のモードの会話履歴を引き継がないようにします
+            user_state.start_session()
+            mode_code = command.mode_code
+            user_state.set_mode_code(mode_code)
+            prompt = command.prompt
+
+            # 会話フレーズ講義のメニュー、または別のモードから入った場合は開始時のメッセージを返します
+            entry_message = MODES[mode_code].entry_message
+            if entry_message is not None and (prompt is None or mode_code != old_mode_code):
+                self.reply_message(reply_token, entry_message, mode_code, user_id)
+                return None, mode_code, entry_message
+
+        # 発表練習では、最初にまとめて生成した質問を順に返信します
+        if mode_code == PRESENTATION_MODE_CODE:
+            ai_response = yield from self.reply_presentation_steps(command, user_message, reply_token, user_id, user_state)
+            if ai_response is not None:
+                return prompt, mode_code, ai_response
+
+        # 先に生成しておいた別の質問があれば、それをすぐに返信します。質問に回答した場合は不要になるので削除します
+        speculate = SPECULATIVE_ALTERNATES and MODES[mode_code].speculate_alternates and (command is None or command.action == ACTION_ALTERNATE)
+        if speculate and command is None:
+            self.speculator.discard(user_state)
+        elif speculate:
+            ai_response = self.speculator.take(user_state)
+            if ai_response is not None:
+                # 先読みした質問もこのユーザーのために生成したものなので、その場で生成した場合と同じく利用回数に数えます
+                self.openai_handler.add_usage(user_id, mode_code, user_state)
+                self.reply_message(reply_token, ai_response, mode_code, user_id)
+                return prompt, mode_code, ai_response
+
+        # 会話フレーズ講義に入る場合は、生成済みの講義があればそれをすぐに返信します
+        # ストックの講義は特定のユーザーのために生成したものではないため、キャッシュと同じく利用回数に数えません
+        is_lecture_entry = command is not None and command.action == ACTION_ENTER and mode_code in LECTURE_TOPICS
+        if is_lecture_entry and self.lecture_pool is not None:
+            ai_response = self.lecture_pool.take(mode_code, user_state)
+            if ai_response is not None:
+                self.reply_message(reply_token, ai_response, mode_code, user_id)
+                return prompt, mode_code, ai_response
 
         # プロンプトとユーザーの会話履歴を使ってOpenAIからAIのレスポンスを取得します
-        conversation_history = self.dynamodb_handler.get_conversation_history(user_id)
-        ai_response = self.openai_handler.get_ai_response(prompt, user_id, conversation_history,mode_code)
-        # 取得したAIのレスポンスをユーザーに返信します
-        self.reply_message(reply_token, ai_response, mode_code)
+        # モデルと生成パラメータはコマンドとモードの設定から選びます
+        model_profile = get_model_profile(command, mode_code)
+
+        # 応答をキャッシュするモードでは、同じ入力に対する応答があればOpenAIを呼ばずに返信します
+        # キャッシュから返した応答は利用回数に数えません
+        cache_key = None
+        if command is None and MODES[mode_code].cache_responses:
+            # ユーザーごとの会話履歴の代わりにモードのプロンプトだけを文脈にして生成し、送信する文脈をすべてキーに含めます
+            # 応答はキーの入力だけで決まるため、別のユーザーの応答を返しても同じ文脈に対する応答になります
+            conversation_history = [{"role": "system", "content": MODES[mode_code].prompt}]
+            cache_key = build_cache_key(model_profile.model, user_message,
+                                        [{"role": "system", "content": SYSTEM_PROMPT}] + conversation_history, mode_code)
+            cached = RESPONSE_CACHE.get(cache_key)
+            log_metrics('response_cache', mode_code=mode_code, hit=cached is not None,
+                        latency_saved_ms=cached[1] if cached is not None else 0)
+            if cached is not None:
+                self.reply_message(reply_token, cached[0], mode_code, user_id)
+                return prompt, mode_code, cached[0]
+
+        started_at = time.monotonic()
+        if cache_key is None:
+            # 読み込み済みの回数で上限に達している場合は、応答を生成しないので会話履歴も組み立てません
+            if user_state.get_api_count() >= DAILY_API_LIMIT:
+                use_history = False
+            conversation_history = self.history_builder.build(user_id, user_state) if use_history else []
+        if OPENAI_STREAMING:
+            # 受信したテキストを文の区切りごとに順次返信します
+            def consume(chunks):
+                return self.stream_reply(reply_token, chunks, mode_code, user_id)
+            ai_response = yield from self.openai_handler.stream_ai_response_steps(
+                prompt, user_id, conversation_history, mode_code, consume, user_state, model_profile)
+        else:
+            ai_response = yield from self.openai_handler.get_ai_response_steps(prompt, user_id, conversation_history,mode_code, user_state, model_profile)
+            # 取得したAIのレスポンスをユーザーに返信します
+            self.reply_message(reply_token, ai_response, mode_code, user_id)
+        if cache_key is not None:
+            RESPONSE_CACHE.set(cache_key, ai_response, round((time.monotonic() - started_at) * 1000, 1))
+        # 返信した質問への別の質問を、ユーザー情報を書き込んだ後にジョブとして先読みします
+        if speculate:
+            user_state.pending_jobs.append(self.speculator.plan(user_id, user_state.session_id, conversation_history + [
+                {"role": "user", "content": prompt},
+                {"role": "assistant", "content": ai_response}
+            ]))
+        # その場で生成した講義は次のユーザーのためにストックに追加します
+        # 追加に失敗しても返信済みなので、ログの保存などの後の処理は続けます
+        if is_lecture_entry and self.lecture_pool is not None:
+            try:
+                self.lecture_pool.add(mode_code, ai_response, user_state)
+            except Exception as e:
+                print(f"Error while adding a lecture to the pool: {e}")
         return prompt, mode_code, ai_response
 
-        
+    # 発表練習のメッセージに返信し、返信したテキストを返します。OpenAIへのリクエストはステップとしてyieldします
+    # 生成済みの質問を使えない場合はNoneを返し、その都度生成する通常の処理に任せます
+    def reply_presentation_steps(self, command, user_message, reply_token, user_id, user_state):
+        practice = self.presentation_practice
+        if command is not None:
+            if command.action != ACTION_ALTERNATE:
+                return None
+            ai_response = practice.alternate_question(user_state)
+            if ai_response is not None:
+                self.reply_message(reply_token, ai_response, PRESENTATION_MODE_CODE, user_id)
+            return ai_response
+
+        plan = user_state.get_session_value('presentation_plan')
+        if plan is None:
+            # 最初のメッセージは発表原稿として、すべての質問をまとめて生成します
+            ai_response = yield from practice.start_steps(user_message, user_id, user_state)
+            self.reply_message(reply_token, ai_response, PRESENTATION_MODE_CODE, user_id)
+            return ai_response
+        if not plan:
+            return None
+
+        # 次の質問をすぐに返信し、回答の評価は返信の後のジョブで行います
+        question = practice.current_question(user_state)
+        ai_response = practice.next_question(user_state)
+        self.reply_message(reply_token, ai_response, PRESENTATION_MODE_CODE, user_id)
+        if question is not None:
+            user_state.pending_jobs.append(practice.plan_evaluation(user_id, user_state.session_id, question, user_message))
+        return ai_response
+
+    # 会話を分割して分析しておくモードでは、会話の数を記録し、たまった会話を分析しておきます
+    def record_turn_steps(self, user_id, user_state, mode_code):
+        if not MODES[mode_code].chunked_feedback:
+            return
+        try:
+            yield from self.feedback_pipeline.record_turn_steps(user_id, user_state)
+        except Exception as e:
+            print(f"Error while recording the conversation for feedback: {e}")
+
+    # 返信の後に、上限に収まらなかった会話履歴を要約に畳み込みます
+    def fold_history_steps(self, user_id, user_state):
+        try:
+            yield from self.history_builder.fold_steps(user_id, user_state)
+        except Exception as e:
+            print(f"Error while summarizing conversation history: {e}")
+
+    # 返信の後に行うジョブを種類に応じて実行します
+    def run_follow_up_job(self, job):
+        if job['type'] == SPECULATION_JOB:
+            self.speculator.generate(job)
+        elif job['type'] == EVALUATION_JOB:
+            self.presentation_practice.evaluate_answer(job)
+        else:
+            print(f"Unknown follow-up job type: {job['type']}")
+
     # クイックリプライアイテムを生成します
     def generate_quick_reply_items(self, mode_code):
-        if mode_code == 1:
-            quick_reply_items = [
-                QuickReplyButton(action=MessageAction(label="完了", text="【フリートーク:完了】")),
-                QuickReplyButton(action=MessageAction(label="分からない", text="I don't know."))
-            ]
-        elif mode_code == 2:
-            quick_reply_items = [
-                QuickReplyButton(action=MessageAction(label="完了", text="【英文添削:完了】"))
-            ]
-        elif mode_code == 3:
-            quick_reply_items = [
-                QuickReplyButton(action=MessageAction(label="完了", text="【発表練習:完了】")),
-                QuickReplyButton(action=MessageAction(label="分からない", text="I don't know."))
-            ]
-        elif mode_code == 4:
-            quick_reply_items = [
-                QuickReplyButton(action=MessageAction(label="日常生活", text="【モード:日常生活】")),
-                QuickReplyButton(action=MessageAction(label="気持ち", text="【モード:気持ち】")),
-                QuickReplyButton(action=MessageAction(label="天気", text="【モード:天気】")),
-                QuickReplyButton(action=MessageAction(label="観光", text="【モード:観光】")),
-                QuickReplyButton(action=MessageAction(label="レストラン", text="【モード:レストラン】")),
-                QuickReplyButton(action=MessageAction(label="ショッピング", text="【モード:ショッピング】")),
-                QuickReplyButton(action=MessageAction(label="学校", text="【モード:学校】")),
-                QuickReplyButton(action=MessageAction(label="スポーツ", text="【モード:スポーツ】")),
-                QuickReplyButton(action=MessageAction(label="恋愛", text="【モード:恋愛】")),
-                QuickReplyButton(action=MessageAction(label="ビジネス", text="【モード:ビジネス】")),
-                QuickReplyButton(action=MessageAction(label="電話", text="【モード:電話】")),
-                QuickReplyButton(action=MessageAction(label="会議", text="【モード:会議】"))
-            ]
-        elif mode_code in range(5, 17):
-            quick_reply_items = [
-                QuickReplyButton(action=MessageAction(label="完了", text="【会話フレーズ講義:完了】"))
-            ]
-        else:
-            quick_reply_items = [
-                QuickReplyButton(action=MessageAction(label="フリートーク", text="【モード:フリートーク】")),
-                QuickReplyButton(action=MessageAction(label="英文添削", text="【モード:英文添削】")),
-                QuickReplyButton(action=MessageAction(label="発表練習", text="【モード:発表練習】")),
-                QuickReplyButton(action=MessageAction(label="会話フレーズ講義", text="【モード:会話フレーズ講義】"))
-            ]
-        return quick_reply_items
\ No newline at end of file
+        return get_quick_reply(mode_code).items
@@ -0,0 +1,53 @@
+import os
+import zlib
+
+# ログの項目の形式のバージョンです。1は非圧縮、2は長いテキストを圧縮した形式です
+FORMAT_VERSION_PLAIN = 1
+FORMAT_VERSION_COMPRESSED = 2
+# 圧縮の対象とするテキストの属性です
+COMPRESSIBLE_FIELDS = ('user_message', 'ai_response')
+# このバイト数以上のテキストを圧縮します。0の場合は圧縮しません
+LOG_COMPRESS_THRESHOLD = int(os.environ.get('LOG_COMPRESS_THRESHOLD', '1024'))
+LOG_COMPRESS_LEVEL = int(os.environ.get('LOG_COMPRESS_LEVEL', '6'))
+
+
+# ログの項目の長いテキストを圧縮します。圧縮した場合は形式のバージョンと圧縮した属性を記録します
+def encode_log_item(item, threshold=None):
+    threshold = LOG_COMPRESS_THRESHOLD if threshold is None else threshold
+    if threshold <= 0:
+        return item
+    compressed_fields = []
+    encoded = dict(item)
+    for field in COMPRESSIBLE_FIELDS:
+        value = item.get(field)
+        if not isinstance(value, str):
+            continue
+        raw = value.encode('utf-8')
+        if len(raw) < threshold:
+            continue
+        compressed = zlib.compress(raw, LOG_COMPRESS_LEVEL)
+        # 圧縮しても小さくならない場合はそのまま保存します
+        if len(compressed) < len(raw):
+            encoded[field] = compressed
+            compressed_fields.append(field)
+    if compressed_fields:
+        encoded['format_version'] = FORMAT_VERSION_COMPRESSED
+        encoded['compressed_fields'] = compressed_fields
+    return encoded
+
+
+# 圧縮されたログの項目を元のテキストに戻します
+# 圧縮した属性だけがBinary型になるため、形式のバージョンではなく値の型で判断します。形式のバージョンがない古い項目や、
+# format_versionとcompressed_fieldsを射影しないGSIから読み込んだ項目も復元できます
+def decode_log_item(item):
+    decoded = dict(item)
+    for field in COMPRESSIBLE_FIELDS:
+        value = item.get(field)
+        if value is None or isinstance(value, str):
+            continue
+        # boto3のBinary型の場合はbytesを取り出します
+        raw = value.value if hasattr(value, 'value') else bytes(value)
+        decoded[field] = zlib.decompress(raw).decode('utf-8')
+    decoded.pop('format_version', None)
+    decoded.pop('compressed_fields', None)
+    return decoded
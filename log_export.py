@@ -0,0 +1,289 @@
+# ログテーブルを分析用のファイルに書き出すツールです。1ページずつ読み込み、日付とモードコードで
+# 分割した圧縮済みの列指向のファイル（pyarrowがある場合はParquet）に書き込みます
+# 途中で止まってもチェックポイントから再開でき、完了後の実行では前回より新しいログだけを書き出します
+# 前回より新しいログは、日付ごとのGSI（dynamodb_handler.LOG_DATE_INDEX_NAME）を日付とシャードごとにQueryして読み込み、
+# テーブル全体はScanしません。最初の書き出しと、GSIがない場合はScanで読み込みます
+# 実行方法: python log_export.py 出力先 [--checkpoint ファイル] [--segments 並列数] [--scan]
+import argparse
+import datetime
+import decimal
+import gzip
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+
+from log_codec import decode_log_item
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+LOG_TABLE_NAME = os.environ.get('LOG_TABLE_NAME')
+# 書き出す列です
+EXPORT_COLUMNS = ('line_user_id', 'created_at', 'session_id', 'mode_code', 'user_message', 'ai_response', 'latency_ms')
+# 1回のScanまたはQueryで読み込む項目数です
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', '1000'))
+# 1つのファイルに書き込む最大の行数と、メモリに保持する最大の行数です
+EXPORT_ROWS_PER_FILE = int(os.environ.get('EXPORT_ROWS_PER_FILE', '100000'))
+EXPORT_MAX_BUFFERED_ROWS = int(os.environ.get('EXPORT_MAX_BUFFERED_ROWS', '200000'))
+# チェックポイントを保存するページの間隔です。保存の前にメモリ上の行をすべて書き込みます
+EXPORT_CHECKPOINT_PAGES = int(os.environ.get('EXPORT_CHECKPOINT_PAGES', '50'))
+# 実行を開始した時刻からこの秒数より前に作成されたログだけを書き出します（秒）
+# 書き込みが遅れるログ（LogSinkのバッファや処理中のリクエスト）を取りこぼさないよう、書き込みの遅れより長くします
+EXPORT_SAFETY_LAG_SECONDS = float(os.environ.get('EXPORT_SAFETY_LAG_SECONDS', '300'))
+
+
+# ログのcreated_atと比べられる、日本時間の現在時刻からsafety_lag秒前の日時を返します
+def get_export_until(safety_lag=EXPORT_SAFETY_LAG_SECONDS):
+    until = datetime.datetime.utcnow() + datetime.timedelta(hours=9) - datetime.timedelta(seconds=safety_lag)
+    return until.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+# DynamoDBから読み込んだ値を書き出す値に変換します
+def to_export_value(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+# ログの項目を書き出す行に変換します。圧縮されたテキストは元に戻します
+def to_row(item):
+    item = decode_log_item(item)
+    return {column: to_export_value(item.get(column)) for column in EXPORT_COLUMNS}
+
+
+# sinceの日付からuntilの日付までの、日付ごとのGSIのパーティションキーのリストを返します
+def get_date_shards(since, until):
+    from dynamodb_handler import LOG_DATE_SHARDS
+    day = datetime.date.fromisoformat(since[:10])
+    last_day = datetime.date.fromisoformat(until[:10])
+    shards = []
+    while day <= last_day:
+        shards.extend(f"{day.isoformat()}#{shard}" for shard in range(LOG_DATE_SHARDS))
+        day += datetime.timedelta(days=1)
+    return shards
+
+
+# 行の日付とモードコードから、書き込むパーティションのディレクトリ名を返します
+def get_partition(row):
+    return f"date={(row['created_at'] or 'unknown')[:10]}/mode_code={row['mode_code']}"
+
+
+# 列ごとの値のリストを圧縮したファイルに書き込みます。書き込んだファイルのパスを返します
+def write_columns(directory, name, columns):
+    os.makedirs(directory, exist_ok=True)
+    if pyarrow is not None:
+        path = os.path.join(directory, f'{name}.parquet')
+        pyarrow.parquet.write_table(pyarrow.table(columns), path + '.tmp', compression='zstd')
+    else:
+        # pyarrowがない場合は、列ごとの値のリストをgzipで圧縮したJSONとして書き込みます
+        path = os.path.join(directory, f'{name}.columns.json.gz')
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as file:
+            json.dump(columns, file, ensure_ascii=False)
+    # 書き込みの途中で止まった場合に不完全なファイルが残らないよう、最後に名前を変更します
+    os.replace(path + '.tmp', path)
+    return path
+
+
+# 1つのScanのセグメント分の行をパーティションごとにためて、ファイルに書き込むクラス
+class PartitionWriter:
+    # コンストラクタで出力先とファイル名の接頭辞を初期化します
+    def __init__(self, output_dir, prefix):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.file_count = 0
+
+    # 行を追加します。パーティションの行がファイルの上限に達した場合や、メモリの上限を超えた場合は書き込みます
+    def add(self, row):
+        partition = get_partition(row)
+        rows = self.buffers.setdefault(partition, [])
+        rows.append(row)
+        self.buffered_rows += 1
+        if len(rows) >= EXPORT_ROWS_PER_FILE:
+            self.flush_partition(partition)
+        elif self.buffered_rows >= EXPORT_MAX_BUFFERED_ROWS:
+            self.flush_partition(max(self.buffers, key=lambda name: len(self.buffers[name])))
+
+    # パーティションの行をファイルに書き込みます
+    def flush_partition(self, partition):
+        rows = self.buffers.pop(partition)
+        self.buffered_rows -= len(rows)
+        columns = {column: [row[column] for row in rows] for column in EXPORT_COLUMNS}
+        write_columns(os.path.join(self.output_dir, partition), f'{self.prefix}-{self.file_count:05d}', columns)
+        self.file_count += 1
+
+    # すべてのパーティションの行をファイルに書き込みます
+    def flush(self):
+        for partition in list(self.buffers):
+            self.flush_partition(partition)
+
+
+# ログテーブルを単位（Scanのセグメント、または日付ごとのGSIのパーティション）に分けて並行して読み込み、
+# ファイルに書き出すクラス
+class LogExporter:
+    # コンストラクタでテーブル名と出力先、チェックポイントのファイルを初期化します
+    # untilを指定した場合は、実行を開始した時刻の代わりにその日時までのログを書き出します
+    # scanをTrueにした場合は、前回より新しいログもGSIを使わずにScanで読み込みます
+    def __init__(self, table_name, output_dir, checkpoint_path, segments=1, until=None, scan=False):
+        self.table_name = table_name
+        self.output_dir = output_dir
+        self.checkpoint_path = checkpoint_path
+        self.segments = segments
+        self.until = until
+        self.scan = scan
+        self.checkpoint_lock = threading.Lock()
+        self.exported_count = 0
+
+    # チェックポイントを読み込みます。ない場合は最初から書き出す状態を返します
+    def load_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as file:
+                return json.load(file)
+        return {'high_water': None, 'run': None}
+
+    # チェックポイントを保存します。途中で止まっても壊れたファイルが残らないよう、書き込んでから名前を変更します
+    def save_checkpoint(self, checkpoint):
+        with open(self.checkpoint_path + '.tmp', 'w') as file:
+            json.dump(checkpoint, file, default=to_export_value)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    # 書き出しを実行し、書き出した項目数と1秒あたりの項目数を返します
+    def run(self):
+        checkpoint = self.load_checkpoint()
+        run = checkpoint.get('run')
+        if run is not None and 'units' not in run and 'until' in run:
+            # 単位を記録する前の形式のチェックポイントは、Scanのセグメントを単位として再開します
+            run.update(method='scan', units=[str(segment) for segment in range(run['segments'])],
+                       finished=[str(segment) for segment in run['finished']])
+        if run is None or run['segments'] != self.segments or 'until' not in run:
+            # 前回の書き出しが完了している場合は、前回の終わりから今回の終わりまでに作成されたログを書き出します
+            # 今回の終わりは読み込んだログの日時ではなく実行を開始した時刻から決めるため、読み込み中に書き込まれたログや
+            # 遅れて書き込まれたログも、終わりより新しければ次回の範囲に入ります
+            since = checkpoint.get('high_water')
+            until = self.until or get_export_until()
+            if since and not self.scan and self.has_date_index():
+                method, units = 'query', get_date_shards(since, until)
+            else:
+                method, units = 'scan', [str(segment) for segment in range(self.segments)]
+            run = {
+                'id': uuid.uuid4().hex[:8],
+                'segments': self.segments,
+                'since': since,
+                'until': until,
+                'method': method,
+                'units': units,
+                'positions': {unit: None for unit in units},
+                'chunks': {unit: 0 for unit in units},
+                'finished': [],
+            }
+            checkpoint['run'] = run
+            self.save_checkpoint(checkpoint)
+
+        started_at = time.perf_counter()
+        pending = [unit for unit in run['units'] if unit not in run['finished']]
+        # 日付ごとのパーティションは数が多いため、同時に読み込む数はセグメント数までにします
+        with ThreadPoolExecutor(max_workers=max(1, min(len(pending), self.segments))) as executor:
+            for future in [executor.submit(self.export_unit, checkpoint, unit) for unit in pending]:
+                future.result()
+        elapsed = time.perf_counter() - started_at
+
+        # すべてのセグメントが完了したら、次回の書き出しの起点を記録します
+        checkpoint['high_water'] = run['until']
+        checkpoint['run'] = None
+        self.save_checkpoint(checkpoint)
+        return self.exported_count, self.exported_count / elapsed if elapsed > 0 else 0.0
+
+    # ログテーブルに日付ごとのGSIがあるかどうかを返します
+    def has_date_index(self):
+        from dynamodb_handler import LOG_DATE_INDEX_NAME, get_dynamodb_resource
+        try:
+            indexes = get_dynamodb_resource().Table(self.table_name).global_secondary_indexes or []
+        except ClientError as e:
+            print(f"Warning: could not describe {self.table_name}; scanning the whole table instead: {e}")
+            return False
+        if not any(index['IndexName'] == LOG_DATE_INDEX_NAME and index.get('IndexStatus', 'ACTIVE') == 'ACTIVE' for index in indexes):
+            print(f"Warning: {LOG_DATE_INDEX_NAME} is not available; scanning the whole table instead")
+            return False
+        return True
+
+    # 1つの単位を読み込み、ファイルに書き出します
+    # ファイル名はチェックポイントの区切りごとに決まるため、再開して同じ範囲を読み直した場合は同じファイルを上書きします
+    def export_unit(self, checkpoint, unit):
+        from dynamodb_handler import LOG_DATE_INDEX_NAME, get_dynamodb_resource
+        table = get_dynamodb_resource().Table(self.table_name)
+        run = checkpoint['run']
+        arguments = {'Limit': EXPORT_PAGE_SIZE}
+        if run['method'] == 'query':
+            # 日時だけのuntilは、同じミリ秒に接尾辞付きで作成されたログより小さいため、それらのログは次回に書き出します
+            # betweenは両端を含むため、sinceと同じ日時のログ（前回書き出したログ）は読み込んだ後で除きます
+            read = table.query
+            arguments.update(IndexName=LOG_DATE_INDEX_NAME, KeyConditionExpression=(
+                Key('log_date_shard').eq(unit) & Key('created_at').between(run['since'], run['until'])))
+        else:
+            read = table.scan
+            if self.segments > 1:
+                arguments.update(Segment=int(unit), TotalSegments=self.segments)
+            filter_expression = Attr('created_at').lte(run['until'])
+            if run['since']:
+                filter_expression = filter_expression & Attr('created_at').gt(run['since'])
+            arguments['FilterExpression'] = filter_expression
+        index = run['units'].index(unit)
+        position = run['positions'][unit]
+        chunk = run['chunks'][unit]
+        writer = PartitionWriter(self.output_dir, f"part-{run['id']}-{index:03d}-{chunk:05d}")
+        pages = 0
+
+        while True:
+            if position is not None:
+                arguments['ExclusiveStartKey'] = position
+            response = read(**arguments)
+            items = [item for item in response['Items'] if item['created_at'] != run['since']]
+            for item in items:
+                writer.add(to_row(item))
+            with self.checkpoint_lock:
+                self.exported_count += len(items)
+            position = response.get('LastEvaluatedKey')
+            pages += 1
+
+            # 書き込んでいない行がない状態で、読み込んだ位置を記録します
+            if position is None or pages % EXPORT_CHECKPOINT_PAGES == 0:
+                writer.flush()
+                chunk += 1
+                writer = PartitionWriter(self.output_dir, f"part-{run['id']}-{index:03d}-{chunk:05d}")
+                with self.checkpoint_lock:
+                    run['positions'][unit] = position
+                    run['chunks'][unit] = chunk
+                    if position is None:
+                        run['finished'].append(unit)
+                    self.save_checkpoint(checkpoint)
+            if position is None:
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_dir')
+    parser.add_argument('--table', default=LOG_TABLE_NAME)
+    parser.add_argument('--checkpoint', default=None, help='チェックポイントのファイル（既定は出力先の_checkpoint.json）')
+    parser.add_argument('--segments', type=int, default=1, help='並行して読み込むScanのセグメント数（Queryでは同時に読み込む日付とシャードの数）')
+    parser.add_argument('--scan', action='store_true', help='前回より新しいログもGSIを使わずにScanで読み込みます（GSIを追加した後の最初の書き出しなど）')
+    args = parser.parse_args()
+
+    checkpoint_path = args.checkpoint or os.path.join(args.output_dir, '_checkpoint.json')
+    os.makedirs(args.output_dir, exist_ok=True)
+    count, items_per_second = LogExporter(args.table, args.output_dir, checkpoint_path, args.segments, scan=args.scan).run()
+    print(f"exported {count} items ({items_per_second:.0f} items/s, format: {'parquet' if pyarrow is not None else 'columns.json.gz'})")
+
+
+if __name__ == '__main__':
+    main()
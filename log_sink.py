@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+
+# ログをバッファにためてまとめて書き込むかどうかです
+LOG_WRITE_BEHIND = os.environ.get('LOG_WRITE_BEHIND', '0') == '1'
+# バッファの件数、または最も古いログの経過秒数がこれを超えたら書き込みます
+LOG_FLUSH_SIZE = int(os.environ.get('LOG_FLUSH_SIZE', '25'))
+LOG_FLUSH_AGE_SECONDS = float(os.environ.get('LOG_FLUSH_AGE_SECONDS', '5'))
+# 書き込みに失敗したログをバッファに残しておく最大件数です
+LOG_MAX_BUFFERED = int(os.environ.get('LOG_MAX_BUFFERED', '1000'))
+# BatchWriteItemで1回に書き込める最大件数です
+BATCH_WRITE_LIMIT = 25
+
+LOG_SINKS = {}
+LOG_SINKS_LOCK = threading.Lock()
+
+
+# ログをバッファにため、batch_writerでまとめて書き込むクラス
+class LogSink:
+    # コンストラクタでログテーブルの名前とバッファを初期化します
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.buffer = []
+        self.oldest_at = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    # ログをバッファに追加し、しきい値を超えた場合は書き込みます
+    def add(self, item):
+        with self.lock:
+            if not self.buffer:
+                self.oldest_at = time.monotonic()
+            self.buffer.append(item)
+            should_flush = (len(self.buffer) >= LOG_FLUSH_SIZE
+                            or time.monotonic() - self.oldest_at >= LOG_FLUSH_AGE_SECONDS)
+        if should_flush:
+            self.flush()
+
+    # まだ書き込まれていないログのうち、条件に合うものを返します
+    def get_pending(self, user_id, session_id=None):
+        with self.lock:
+            return [item for item in self.buffer
+                    if item['line_user_id'] == user_id and (session_id is None or item.get('session_id') == session_id)]
+
+    # バッファのログをまとめて書き込みます。失敗した場合は次の書き込みで再送します
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                items = self.buffer
+                self.buffer = []
+                self.oldest_at = None
+            if not items:
+                return 0
+            try:
+                from dynamodb_handler import DYNAMODB_CALL_COUNTER, DYNAMODB_CALL_COUNTER_LOCK, get_dynamodb_resource
+                table = get_dynamodb_resource().Table(self.table_name)
+                # batch_writerは処理されなかった項目（UnprocessedItems）を自動的に再送します
+                with table.batch_writer(overwrite_by_pkeys=['line_user_id', 'created_at']) as batch:
+                    for item in items:
+                        batch.put_item(Item=item)
+                with DYNAMODB_CALL_COUNTER_LOCK:
+                    DYNAMODB_CALL_COUNTER['batch_write_item'] += (len(items) + BATCH_WRITE_LIMIT - 1) // BATCH_WRITE_LIMIT
+                return len(items)
+            except Exception as e:
+                # ログの保存に失敗してもユーザーへの返信には影響させず、バッファに戻して再送します
+                print(f"Error while flushing logs: {e}")
+                with self.lock:
+                    self.buffer = (items + self.buffer)[-LOG_MAX_BUFFERED:]
+                    if self.oldest_at is None:
+                        self.oldest_at = time.monotonic()
+                return 0
+
+
+# ログテーブルごとのLogSinkを取得します。書き込みを遅延しない設定の場合はNoneを返します
+def get_log_sink(table_name):
+    if not LOG_WRITE_BEHIND:
+        return None
+    with LOG_SINKS_LOCK:
+        if table_name not in LOG_SINKS:
+            LOG_SINKS[table_name] = LogSink(table_name)
+        return LOG_SINKS[table_name]
+
+
+# すべてのLogSinkのバッファを書き込みます。呼び出しの終了時に実行します
+def flush_all_log_sinks():
+    with LOG_SINKS_LOCK:
+        sinks = list(LOG_SINKS.values())
+    for sink in sinks:
+        sink.flush()
@@ -0,0 +1,17 @@
+import decimal
+import json
+import time
+
+
+# JSONに変換できない値を変換します。DynamoDBから読み込んだDecimalは数値として出力します
+def to_json_value(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return str(value)
+
+
+# メトリクスを1行のJSONとして出力します。CloudWatch Logsのメトリクスフィルタで集計できます
+def log_metrics(name, **values):
+    record = {'metric': name, 'timestamp': int(time.time() * 1000)}
+    record.update(values)
+    print(json.dumps(record, ensure_ascii=False, default=to_json_value))
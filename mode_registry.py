@@ -0,0 +1,270 @@
+import collections
+import os
+
+from linebot.models import QuickReply, QuickReplyButton, MessageAction
+
+# モードの設定とコマンドの対応表です。モジュールの読み込み時に1回だけ作成し、
+# メッセージごとの処理は辞書の参照だけで済むようにします
+
+# モードの設定（モードコード、名前、開始時のメッセージ、プロンプト、クイックリプライ、モデルの設定）
+# cache_responsesがTrueのモードでは、同じ入力に対する応答をキャッシュから返します
+# このモードでは会話履歴を使わず、モードのプロンプトだけを文脈にして生成するため、1回のメッセージで完結するモードにだけ使います
+# speculate_alternatesがTrueのモードでは、「分からない」の別の質問を先に生成しておきます
+# chunked_feedbackがTrueのモードでは、会話をいくつかに分けて分析しておき、終了時のフィードバックにまとめます
+ModeConfig = collections.namedtuple(
+    'ModeConfig',
+    ['mode_code', 'name', 'entry_message', 'prompt', 'quick_reply', 'model_profile', 'cache_responses', 'speculate_alternates', 'chunked_feedback'],
+    defaults=(False, False, False)
+)
+# コマンドの設定（動作、モードコード、プロンプト、モデルの設定）。モデルの設定がNoneの場合はモードの設定を使います
+Command = collections.namedtuple('Command', ['action', 'mode_code', 'prompt', 'model_profile'])
+# 生成に使うモデルとパラメータ（モデル、最大トークン数、temperature、失敗時に使うモデル）
+ModelProfile = collections.namedtuple('ModelProfile', ['model', 'max_tokens', 'temperature', 'fallback_model'])
+
+DEFAULT_MODE_CODE = 0
+PRESENTATION_MODE_CODE = 3
+
+# 短い会話には速くて安いモデルを使い、フィードバックや講義には高品質なモデルを使います
+FAST_MODEL = os.environ.get('FAST_MODEL', 'gpt-3.5-turbo')
+QUALITY_MODEL = os.environ.get('QUALITY_MODEL', 'gpt-4')
+
+QUALITY_PROFILE = ModelProfile(QUALITY_MODEL, 3000, 0.0, FAST_MODEL)
+CONVERSATION_PROFILE = ModelProfile(FAST_MODEL, 800, 0.0, QUALITY_MODEL)
+CORRECTION_PROFILE = ModelProfile(FAST_MODEL, 1000, 0.0, QUALITY_MODEL)
+QUESTION_PROFILE = ModelProfile(FAST_MODEL, 300, 0.0, QUALITY_MODEL)
+# 発表練習の質問をまとめて生成する時と、回答を簡単に評価する時の設定です
+PRESENTATION_PLAN_PROFILE = ModelProfile(FAST_MODEL, 600, 0.0, QUALITY_MODEL)
+EVALUATION_PROFILE = ModelProfile(FAST_MODEL, 150, 0.0, None)
+# 終了時のフィードバックのために会話の一部を分析する時の設定です
+ANALYSIS_PROFILE = ModelProfile(FAST_MODEL, 400, 0.0, QUALITY_MODEL)
+
+# モードに入ります
+ACTION_ENTER = 'enter'
+# モードを終了し、APIを通さずに終了メッセージを返します
+ACTION_END = 'end'
+# モードを終了し、これまでの会話へのフィードバックを生成します
+ACTION_FEEDBACK = 'feedback'
+# 同じ話題で別の質問を生成します
+ACTION_ALTERNATE = 'alternate'
+
+FREE_TALK_PROMPT = '''#あなたは英会話講師です。これから私が送る話したいトピックについて英語で話してください。
+
+#あなたのルール
+・英文は数行の文章を送ってください。
+・毎回１個だけ質問をしてください。
+・丁寧で文法的に正しい英語を使ってください。
+・絵文字をたくさん使用して会話を続けてください。
+・適切なタイミングで改行して、読みやすさを確保してください。
+'''
+
+CORRECTION_PROMPT = "#あなたは英文添削のプロです。私が送る英文を、文法的に丁寧で正しい英語に修正してください。"
+
+PRESENTATION_PROMPT = '''#あなたは就職活動支援のプロです。これから私が練習したい英文を送るので、その英文から面接官が質問してくるであろう質問をしてください。\n\n#あなたのルール\n・あなたが文章を送る時は、１つだけ英語で質問をしてください。\n・質問は合計で3回してください。\n\n#質問形式の例\n私：I am interested in soccer.\nあなた：Q1:How did you become interested in soccer?\n私：I went to see a game with my father.\nあなた：Q2:What did you find interesting about soccer?'''
+
+FREE_TALK_FEEDBACK_PROMPT = '''#これまでの私の英文から私へのフィードバックをしてください。また、以下の要件を守ってください。
+
+# フィードバックの作り方
+・適切なタイミングで改行して、読みやすさを確保してください。
+
+# あなたのルール
+・日本語で私にフィードバックしてください。
+・これまでの会話を踏まえて、私のよかった点と私の改善した方がよい点をこれまでの英語の文章を取り上げながら具体的にフィードバックしてください。
+
+# フォーマット
+今回の会話を通してのあなたへのフィードバックを行います。
+
+よかった点
+
+
+
+改善するべき点
+
+
+
+以上になります！ありがとうございました！
+'''
+
+PRESENTATION_FEEDBACK_PROMPT = '''#聞き手としてこれまでの会話から私へのフィードバックをしてください。また、以下の要件を守ってください。
+
+# フィードバックの作り方
+・適切なタイミングで改行して、読みやすさを確保してください。
+
+# あなたのルール
+・日本語でフィードバックしてください。
+・これまでの会話を踏まえて、発表の内容として私のよかった点と改善した方がよい点をこれまでの英語の文章を取り上げながら、具体的にフィードバックしてください。
+
+# フォーマット
+今回の会話を通してのあなたへのフィードバックを行います。
+
+よかった点
+
+
+
+改善するべき点
+
+
+
+以上になります！ありがとうございました！
+'''
+
+ALTERNATE_QUESTION_PROMPT = "同じ話題で別の質問を英語でしてください。"
+
+# 発表練習の質問と、「分からない」が押された時の別の質問を1回でまとめて生成するプロンプトです
+PRESENTATION_PLAN_PROMPT_TEMPLATE = '''#あなたは就職活動支援のプロです。以下の発表原稿から、面接官が質問してくるであろう質問を英語で{count}個考えてください。また、それぞれの質問について、同じ話題で別の質問を1つずつ考えてください。
+
+#出力形式
+以下のJSONだけを出力してください。
+{{"questions": [{{"question": "質問", "alternate": "同じ話題の別の質問"}}]}}
+
+#発表原稿
+{script}'''
+
+# 終了時のフィードバックのために、会話の一部から私の英語のよかった点と改善するべき点を抜き出すプロンプトです
+CHUNK_ANALYSIS_PROMPT_TEMPLATE = '''#以下の英会話の一部について、私（user）の英語のよかった点と改善するべき点を、私の英文を引用しながら日本語の箇条書きで簡潔にまとめてください。
+
+#会話
+{conversation}'''
+
+# 分析した結果を、フィードバックのプロンプトに追加する時の見出しです
+CHUNK_FINDINGS_HEADING = "#会話全体を分割して分析した結果（古い順）"
+
+# 発表練習の回答を簡単に評価するプロンプトです
+EVALUATION_PROMPT_TEMPLATE = '''#以下の質問への英語の回答について、よかった点と改善した方がよい点を日本語で1〜2文にまとめてください。
+
+#質問
+{question}
+
+#回答
+{answer}'''
+
+LECTURE_PROMPT_TEMPLATE = '''#あなたは英会話の講師です。これから{topic}について、英会話でよく使われるフレーズをランダムで１つ題材にして講義を行なってください。講義ではフレーズの説明や例をあげてください。練習ではシナリオを作成して、会話練習してください。
+
+＃講義フォーマット
+【講義内容】
+
+
+
+【フレーズ】
+
+
+【例文】
+
+
+【練習】
+
+
+
+上記のシナリオのように、メッセージを送って練習してみましょう！
+'''
+
+# 会話フレーズ講義のモードコードと講義のテーマです
+LECTURE_TOPICS = {
+    5: "日常生活",
+    6: "気持ち",
+    7: "天気",
+    8: "観光",
+    9: "レストラン",
+    10: "ショッピング",
+    11: "学校",
+    12: "スポーツ",
+    13: "恋愛",
+    14: "ビジネス",
+    15: "電話",
+    16: "会議",
+}
+
+
+# 講義のテーマから講義用のプロンプトを作成します
+def build_lecture_prompt(mode_code):
+    return LECTURE_PROMPT_TEMPLATE.format(topic=LECTURE_TOPICS[mode_code])
+
+
+# ラベルと送信するテキストの組からクイックリプライを作成します
+def build_quick_reply(buttons):
+    return QuickReply(items=[QuickReplyButton(action=MessageAction(label=label, text=text)) for label, text in buttons])
+
+
+MENU_QUICK_REPLY = build_quick_reply([
+    ("フリートーク", "【モード:フリートーク】"),
+    ("英文添削", "【モード:英文添削】"),
+    ("発表練習", "【モード:発表練習】"),
+    ("会話フレーズ講義", "【モード:会話フレーズ講義】"),
+])
+LECTURE_QUICK_REPLY = build_quick_reply([("完了", "【会話フレーズ講義:完了】")])
+
+MODES = {
+    0: ModeConfig(0, None, "モードを終了しました。", None, MENU_QUICK_REPLY, QUALITY_PROFILE),
+    1: ModeConfig(
+        1, "フリートーク",
+        "Alright,I'm ready to help you with your. English conversation practice!\n Please let me know the topic you'd like to talk about.\n\n話したいトピックを英語で送ってください！フリートークを完了したい場合は下の「完了」ボタンを押してください。「完了」が押されるとこれまでの会話を踏まえてのフィードバックが行われます。フリートーク中に質問が分からない場合は下の「分からない」ボタンを押してください。\n\n「完了」を押した後に会話を通してのフィードバックが送信されます。※フィードバックが生成されるのには時間が掛かります。",
+        FREE_TALK_PROMPT,
+        build_quick_reply([("完了", "【フリートーク:完了】"), ("分からない", "I don't know.")]),
+        CONVERSATION_PROFILE,
+        speculate_alternates=True,
+        chunked_feedback=True
+    ),
+    2: ModeConfig(
+        2, "英文添削",
+        "添削して欲しい英文を送ってください。※添削には時間が掛かります。",
+        CORRECTION_PROMPT,
+        build_quick_reply([("完了", "【英文添削:完了】")]),
+        CORRECTION_PROFILE,
+        cache_responses=True
+    ),
+    3: ModeConfig(
+        3, "発表練習",
+        "練習したい発表原稿を送ってください！この原稿を元に想定される質問を考えます。質問に答えると次の質問をします。\n\n練習を完了したい場合は下の「完了」ボタンを押してください。発表中の質問で分からない質問は下の「分からない」ボタンを押してください。\n\n「完了」を押した後に発表練習を通してのフィードバックが送信されます。※フィードバックが生成されるのには時間が掛かります。",
+        PRESENTATION_PROMPT,
+        build_quick_reply([("完了", "【発表練習:完了】"), ("分からない", "I don't know.")]),
+        QUESTION_PROFILE,
+        speculate_alternates=True,
+        chunked_feedback=True
+    ),
+    4: ModeConfig(
+        4, "会話フレーズ講義",
+        "習いたい講義内容を以下から選択してください！講義が始まります。講義生成には時間が掛かります。",
+        None,
+        build_quick_reply([(topic, f"【モード:{topic}】") for topic in LECTURE_TOPICS.values()]),
+        QUALITY_PROFILE
+    ),
+}
+for lecture_mode_code, lecture_topic in LECTURE_TOPICS.items():
+    MODES[lecture_mode_code] = ModeConfig(
+        lecture_mode_code, lecture_topic, None, build_lecture_prompt(lecture_mode_code), LECTURE_QUICK_REPLY, QUALITY_PROFILE
+    )
+
+# 完全一致するメッセージとコマンドの対応表です
+COMMANDS = {
+    "【英文添削:完了】": Command(ACTION_END, DEFAULT_MODE_CODE, None, None),
+    "【会話フレーズ講義:完了】": Command(ACTION_END, DEFAULT_MODE_CODE, None, None),
+    "【フリートーク:完了】": Command(ACTION_FEEDBACK, DEFAULT_MODE_CODE, FREE_TALK_FEEDBACK_PROMPT, QUALITY_PROFILE),
+    "【発表練習:完了】": Command(ACTION_FEEDBACK, DEFAULT_MODE_CODE, PRESENTATION_FEEDBACK_PROMPT, QUALITY_PROFILE),
+    "I don't know.": Command(ACTION_ALTERNATE, None, ALTERNATE_QUESTION_PROMPT, QUESTION_PROFILE),
+    "【発表練習:分からない】": Command(ACTION_ALTERNATE, None, ALTERNATE_QUESTION_PROMPT, QUESTION_PROFILE),
+}
+for mode_config in MODES.values():
+    if mode_config.name is not None:
+        COMMANDS[f"【モード:{mode_config.name}】"] = Command(ACTION_ENTER, mode_config.mode_code, mode_config.prompt, None)
+
+
+# メッセージに対応するコマンドを返します。コマンドでない場合はNoneを返します
+def get_command(user_message):
+    return COMMANDS.get(user_message)
+
+
+# コマンドとモードコードから、生成に使うモデルの設定を返します
+def get_model_profile(command, mode_code):
+    if command is not None and command.model_profile is not None:
+        return command.model_profile
+    mode_config = MODES.get(mode_code)
+    if mode_config is None:
+        return QUALITY_PROFILE
+    return mode_config.model_profile
+
+
+# モードコードに対応する作成済みのクイックリプライを返します
+def get_quick_reply(mode_code):
+    mode_config = MODES.get(mode_code)
+    if mode_config is None:
+        return MENU_QUICK_REPLY
+    return mode_config.quick_reply
@@ -1,39 +1,321 @@
-import openai
+import json
+import os
+import time
+
 import requests
 
+from history_builder import count_message_tokens
+from http_client import RetryingHttpClient
+from metrics import log_metrics
+from mode_registry import QUALITY_PROFILE
+from rate_limiter import get_rate_limiter
+from steps import Call, PostRequest, run_steps
+from tracing import set_span_attributes, traced
+
+# ウォームスタート時にもコネクションを再利用できるよう、HTTPクライアントはモジュールスコープで作成します
+HTTP_CLIENT = RetryingHttpClient(
+    connect_timeout=float(os.environ.get('OPENAI_CONNECT_TIMEOUT', '3.05')),
+    read_timeout=float(os.environ.get('OPENAI_READ_TIMEOUT', '120')),
+    max_retries=int(os.environ.get('OPENAI_MAX_RETRIES', '3')),
+    hedge=os.environ.get('OPENAI_HEDGE', '0') == '1',
+    pool_size=int(os.environ.get('OPENAI_POOL_SIZE', '10')),
+    max_in_flight=int(os.environ.get('OPENAI_MAX_IN_FLIGHT', '0')),
+    # リトライを含めた1回の呼び出し全体の上限（秒）です。Lambdaのタイムアウトより短くします
+    total_timeout=float(os.environ.get('OPENAI_TOTAL_TIMEOUT', '150')),
+)
+OPENAI_API_URL = os.environ.get('OPENAI_API_URL', 'https://api.openai.com/v1/chat/completions')
+# ストリーミングで受信したテキストを区切る最小の文字数です
+STREAM_MIN_CHUNK_CHARS = int(os.environ.get('STREAM_MIN_CHUNK_CHARS', '80'))
+# すべてのリクエストの先頭に付けるシステムプロンプトです
+SYSTEM_PROMPT = "あなたは英会話をサポートするアシスタントです。"
+# 会話履歴の要約に使うモデルと最大トークン数です
+SUMMARY_MODEL = os.environ.get('SUMMARY_MODEL', 'gpt-3.5-turbo')
+SUMMARY_MAX_TOKENS = int(os.environ.get('SUMMARY_MAX_TOKENS', '500'))
+# 文や段落の区切りとみなす文字列です
+SENTENCE_BOUNDARIES = ('\n\n', '。', '！', '？', '. ', '! ', '? ', '.\n', '!\n', '?\n')
+# コストの概算に使う、モデルごとの1,000トークンあたりの料金（USD、プロンプト/生成）です
+MODEL_PRICES = {
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-turbo': (0.01, 0.03),
+    'gpt-4o': (0.005, 0.015),
+    'gpt-4o-mini': (0.00015, 0.0006),
+    'gpt-3.5-turbo': (0.0005, 0.0015),
+}
+
+# OpenAIがエラーの応答を返した場合の例外です。status_codeに応答のステータスコードを保持します
+class OpenAIError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
 # OpenAI APIを管理するクラス
 class OpenAIHandler:
-    # コンストラクタでAPIキーを初期化します
+    # コンストラクタでAPIキーを初期化します。APIの呼び出しにはopenaiパッケージを使わずHTTP_CLIENTを使います
     def __init__(self, api_key,dynamodb_handler):
         self.api_key = api_key
         self.dynamodb_handler = dynamodb_handler
-        openai.api_key = self.api_key
 
-    # OpenAI APIを使ってAIのレスポンスを取得します
-    def get_ai_response(self, prompt, user_id, conversation_history, mode_code):
+    # OpenAI APIを使ってAIのレスポンスを取得します。model_profileでモデルと生成パラメータを指定します
+    def get_ai_response(self, prompt, user_id, conversation_history, mode_code, user_state=None, model_profile=None):
+        return run_steps(self.get_ai_response_steps(prompt, user_id, conversation_history, mode_code, user_state, model_profile))
+
+    # get_ai_responseと同じ処理を、OpenAIへのリクエストをステップとしてyieldするジェネレータで行います
+    # 利用回数の上限や混雑で応答を生成できない場合は、UsageLimitExceeded、UsageContention、RateLimitedを送出します
+    @traced('openai.get_ai_response')
+    def get_ai_response_steps(self, prompt, user_id, conversation_history, mode_code, user_state=None, model_profile=None):
+        self.add_usage(user_id, mode_code, user_state)
+        model_profile = model_profile or QUALITY_PROFILE
+        data = self.build_request_data(prompt, conversation_history, model_profile)
+        started_at = time.monotonic()
         try:
-            self.dynamodb_handler.update_user_usage(user_id, 1, mode_code)
-        except Exception as e:
-            return str(e)
-        # リクエストデータを作成します。会話履歴とユーザーからのプロンプトを含めます
+            response_data = yield from self.post_with_fallback_steps(data, model_profile)
+        except Exception:
+            # 混雑で受け付けられなかった呼び出しや、失敗した呼び出しは利用回数に数えません
+            self.refund_usage(user_id, user_state)
+            raise
+        self.log_call(mode_code, data, response_data.get('model', data['model']), response_data.get('usage', {}), started_at)
+
+        # レスポンスデータからAIのメッセージを取り出し、前後の空白を削除します
+        return response_data['choices'][0]['message']['content'].strip()
+
+    # リクエストを送信し、5xxの応答か通信エラーで失敗した場合は代わりのモデルで再度送信します
+    # 4xxの応答（リクエストの誤りや429）と、全体のタイムアウトを使い切った場合は代わりのモデルを使いません
+    # 代わりのモデルへの送信も最初の送信と同じ期限の中で行い、合わせてtotal_timeoutを超えないようにします
+    def post_with_fallback_steps(self, data, model_profile):
+        deadline = time.monotonic() + HTTP_CLIENT.total_timeout
+        try:
+            return (yield from self.post_chat_completion_steps(data, deadline))
+        except (OpenAIError, requests.ConnectionError) as e:
+            fallback_model = get_fallback_model(e, data, model_profile, deadline)
+            if fallback_model is None:
+                raise
+            print(f"Falling back to {fallback_model} after error: {e}")
+            return (yield from self.post_chat_completion_steps(dict(data, model=fallback_model), deadline))
+
+    # 利用回数を加算せずにプロンプトからテキストを生成します。講義のストックの補充や発表練習の回答の評価などに使います
+    def generate_text(self, prompt, model_profile=QUALITY_PROFILE, conversation_history=None):
+        return run_steps(self.generate_text_steps(prompt, model_profile, conversation_history))
+
+    # generate_textと同じ処理を、OpenAIへのリクエストをステップとしてyieldするジェネレータで行います
+    def generate_text_steps(self, prompt, model_profile=QUALITY_PROFILE, conversation_history=None):
+        response_data = yield from self.post_chat_completion_steps(self.build_request_data(prompt, conversation_history or [], model_profile))
+        return response_data['choices'][0]['message']['content'].strip()
+
+    # これまでの要約と新しい会話から、会話履歴の要約を作成します。OpenAIへのリクエストはステップとしてyieldします
+    def summarize_history_steps(self, summary, messages):
+        conversation = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        prompt = (
+            "#以下のこれまでの要約と新しい会話をまとめて、英会話の練習を続けるために必要な情報を残した短い要約を日本語で作成してください。\n\n"
+            f"#これまでの要約\n{summary}\n\n#新しい会話\n{conversation}"
+        )
         data = {
-            "model": "gpt-4",
-            "messages": [{"role": "system", "content": "あなたは英会話をサポートするアシスタントです。"}]
-            + conversation_history
-            + [{"role": "user", "content": prompt}],
-            "max_tokens": 3000,
-            "temperature":0.0,
-            "frequency_penalty": 0,
-            "presence_penalty": 0
+            "model": SUMMARY_MODEL,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": SUMMARY_MAX_TOKENS,
+            "temperature": 0.0
         }
+        response_data = yield from self.post_chat_completion_steps(data)
+        return response_data['choices'][0]['message']['content'].strip()
+
+    # Chat Completions APIにリクエストを送信し、レスポンスデータを返します。リクエストの送信はステップとしてyieldします
+    # deadline（time.monotonic()の値）を指定した場合は、リトライを含めてその時刻までに送信を終えます
+    @traced('openai.post_chat_completion')
+    def post_chat_completion_steps(self, data, deadline=None):
+        yield from self.admit_steps(data)
         headers = {"Authorization": f"Bearer {self.api_key}"}
         # POSTリクエストを送信し、AIからのレスポンスを取得します
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=data)
+        response = yield PostRequest(HTTP_CLIENT, OPENAI_API_URL, headers, data, deadline)
+        set_span_attributes(model=data['model'], retries=response.retry_count, status_code=response.status_code)
         
         # レスポンスのステータスコードが200以外の場合はエラーをスローします
         if response.status_code != 200:
-            raise Exception(f"Failed to get a response from OpenAI: {response.text}")
+            raise OpenAIError(f"Failed to get a response from OpenAI: {response.text}", response.status_code)
+        return response.json()
 
-        # レスポンスデータからAIのメッセージを取り出し、前後の空白を削除します
-        response_data = response.json()
-        return response_data['choices'][0]['message']['content'].strip()
+    # ストリーミングモードでAIのレスポンスを取得し、文や段落の区切りごとのテキストを順に返すイテレータをconsumeに渡します
+    # consumeの戻り値を返します。受信とconsumeの呼び出しはCallのステップとして、会話を処理するスレッドの外で行います
+    # 利用回数の加算と返金はこのジェネレータで行います。送出する例外はget_ai_response_stepsと同じです
+    def stream_ai_response_steps(self, prompt, user_id, conversation_history, mode_code, consume, user_state=None, model_profile=None):
+        self.add_usage(user_id, mode_code, user_state)
+        try:
+            return (yield Call(consume, (self.stream_text(prompt, conversation_history, mode_code, model_profile),)))
+        except Exception:
+            # 混雑で受け付けられなかった呼び出しや、途中で失敗した呼び出しは利用回数に数えません
+            self.refund_usage(user_id, user_state)
+            raise
+
+    # ストリーミングモードでAIのレスポンスを取得し、文や段落の区切りごとにテキストを返します。利用回数は加算しません
+    # 返されたテキストをすべて連結するとget_ai_responseと同じ全文になります。代わりのモデルへの切り替えと
+    # 出力するメトリクスもget_ai_responseと同じです（メトリクスには最初のテキストを受信するまでの時間も含めます）
+    def stream_text(self, prompt, conversation_history, mode_code, model_profile=None):
+        model_profile = model_profile or QUALITY_PROFILE
+        data = self.build_request_data(prompt, conversation_history, model_profile)
+        data["stream"] = True
+        # 最後のイベントでトークン数を受け取ります
+        data["stream_options"] = {"include_usage": True}
+        started_at = time.monotonic()
+        summary = {'model': data['model'], 'usage': {}, 'first_chunk_ms': None}
+        yield from split_at_boundaries(self.stream_chat_completion(data, model_profile, summary, started_at))
+        self.log_call(mode_code, data, summary['model'], summary['usage'], started_at, stream=True,
+                      first_chunk_ms=summary['first_chunk_ms'])
+
+    # ストリーミングモードでChat Completions APIにリクエストを送信し、受信したテキストを順に返します
+    # 5xxの応答か通信エラーで送信に失敗した場合は、post_with_fallback_stepsと同じく代わりのモデルで送信します
+    # 応答したモデル、トークン数、最初のテキストを受信するまでの時間はsummaryに設定します
+    def stream_chat_completion(self, data, model_profile, summary, started_at):
+        deadline = time.monotonic() + HTTP_CLIENT.total_timeout
+        try:
+            response = self.open_stream(data, deadline)
+        except (OpenAIError, requests.ConnectionError) as e:
+            fallback_model = get_fallback_model(e, data, model_profile, deadline)
+            if fallback_model is None:
+                raise
+            print(f"Falling back to {fallback_model} after error: {e}")
+            summary['model'] = fallback_model
+            response = self.open_stream(dict(data, model=fallback_model), deadline)
+
+        with response:
+            for event in parse_sse_lines(response.iter_lines(decode_unicode=True)):
+                summary['model'] = event.get('model') or summary['model']
+                if event.get('usage'):
+                    summary['usage'] = event['usage']
+                # トークン数だけを含む最後のイベントにはchoicesがありません
+                if not event.get('choices'):
+                    continue
+                text = event['choices'][0].get('delta', {}).get('content') or ""
+                if text and summary['first_chunk_ms'] is None:
+                    summary['first_chunk_ms'] = round((time.monotonic() - started_at) * 1000, 1)
+                yield text
+
+    # ストリーミングのリクエストを送信し、本文を読み込む前のレスポンスを返します
+    # ステータスコードが200以外の場合は、コネクションをプールに戻せるようにレスポンスを閉じてから例外を送出します
+    def open_stream(self, data, deadline):
+        self.admit(data)
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        response = HTTP_CLIENT.post(OPENAI_API_URL, headers=headers, json=data, stream=True, deadline=deadline)
+        set_span_attributes(model=data['model'], retries=response.retry_count, status_code=response.status_code)
+        if response.status_code != 200:
+            try:
+                message = f"Failed to get a response from OpenAI: {response.text}"
+            finally:
+                response.close()
+            raise OpenAIError(message, response.status_code)
+        return response
+
+    # OpenAIの呼び出しのメトリクスを出力し、トレースのスパンにモデルとトークン数を記録します
+    def log_call(self, mode_code, data, model, usage, started_at, **values):
+        set_span_attributes(mode_code=mode_code, model=model, prompt_tokens=usage.get('prompt_tokens'),
+                            completion_tokens=usage.get('completion_tokens'))
+        log_metrics(
+            'openai_call',
+            mode_code=mode_code,
+            model=model,
+            latency_ms=round((time.monotonic() - started_at) * 1000, 1),
+            estimated_prompt_tokens=count_message_tokens(data['messages']),
+            prompt_tokens=usage.get('prompt_tokens'),
+            completion_tokens=usage.get('completion_tokens'),
+            cost_usd=estimate_cost(model, usage.get('prompt_tokens'), usage.get('completion_tokens')),
+            **values
+        )
+
+    # 利用回数を加算します。リクエスト単位のユーザー情報がある場合は、そこから加算します
+    def add_usage(self, user_id, mode_code, user_state):
+        if user_state is not None:
+            user_state.add_usage(1)
+        else:
+            self.dynamodb_handler.update_user_usage(user_id, 1, mode_code)
+
+    # 失敗した呼び出しの分の利用回数を戻します
+    def refund_usage(self, user_id, user_state):
+        try:
+            if user_state is not None:
+                user_state.refund_usage(1)
+            else:
+                self.dynamodb_handler.refund_user_usage(user_id, 1)
+        except Exception as e:
+            print(f"Error while refunding usage: {e}")
+
+    # レートリミッタが有効な場合は、リクエスト数とトークン数の枠が空くまで待ちます
+    # OpenAIと同じく、プロンプトのトークン数とmax_tokensの合計を見積もりとして使います
+    def admit(self, data):
+        run_steps(self.admit_steps(data))
+
+    # admitと同じ処理を、待機をステップとしてyieldするジェネレータで行います
+    def admit_steps(self, data):
+        rate_limiter = get_rate_limiter()
+        if rate_limiter is not None:
+            yield from rate_limiter.admit_steps(count_message_tokens(data['messages']) + data.get('max_tokens', 0))
+
+    # リクエストデータを作成します。会話履歴とユーザーからのプロンプトを含めます
+    def build_request_data(self, prompt, conversation_history, model_profile=QUALITY_PROFILE):
+        return {
+            "model": model_profile.model,
+            "messages": [{"role": "system", "content": SYSTEM_PROMPT}]
+            + conversation_history
+            + [{"role": "user", "content": prompt}],
+            "max_tokens": model_profile.max_tokens,
+            "temperature": model_profile.temperature,
+            "frequency_penalty": 0,
+            "presence_penalty": 0
+        }
+
+
+# モデルとトークン数から料金（USD）を概算します。料金が分からない場合はNoneを返します
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        # 日付付きのモデル名（例: gpt-4-0613）は元のモデルの料金を使います
+        prices = next((price for name, price in sorted(MODEL_PRICES.items(), key=lambda entry: -len(entry[0]))
+                       if model.startswith(name)), None)
+    if prices is None or prompt_tokens is None or completion_tokens is None:
+        return None
+    return round(prompt_tokens / 1000 * prices[0] + completion_tokens / 1000 * prices[1], 6)
+
+
+# 送信に失敗した後に使う代わりのモデルを返します。代わりのモデルを使わない場合はNoneを返します
+# 5xxの応答か通信エラーで失敗し、期限までに時間が残っている場合だけ代わりのモデルを使います
+def get_fallback_model(error, data, model_profile, deadline):
+    fallback_model = model_profile.fallback_model
+    if not fallback_model or fallback_model == data['model'] or time.monotonic() >= deadline:
+        return None
+    if isinstance(error, OpenAIError) and error.status_code < 500:
+        return None
+    return fallback_model
+
+
+# Server-Sent Eventsの行から、data行のJSONを順に返します。[DONE]を受信したら終了します
+def parse_sse_lines(lines):
+    for line in lines:
+        if not line or not line.startswith("data: "):
+            continue
+        payload = line[len("data: "):]
+        if payload == "[DONE]":
+            return
+        yield json.loads(payload)
+
+
+# 受信したテキストを連結し、一定の長さがたまるたびに最後の文や段落の区切りまでのテキストを返します
+# 返したテキストをすべて連結すると、受信したテキストの全文になります
+def split_at_boundaries(texts, min_chars=None):
+    min_chars = STREAM_MIN_CHUNK_CHARS if min_chars is None else min_chars
+    buffer = ""
+    for text in texts:
+        buffer += text
+        if len(buffer) >= min_chars:
+            split_at = find_last_boundary(buffer)
+            if split_at > 0:
+                yield buffer[:split_at]
+                buffer = buffer[split_at:]
+    if buffer:
+        yield buffer
+
+
+# テキスト中の最後の文や段落の区切りの位置（区切り文字の直後）を返します。見つからない場合は0を返します
+def find_last_boundary(text):
+    split_at = 0
+    for boundary in SENTENCE_BOUNDARIES:
+        index = text.rfind(boundary)
+        if index >= 0:
+            split_at = max(split_at, index + len(boundary))
+    return split_at
@@ -0,0 +1,112 @@
+import json
+import uuid
+
+from mode_registry import EVALUATION_PROFILE, EVALUATION_PROMPT_TEMPLATE, PRESENTATION_PLAN_PROFILE, PRESENTATION_PLAN_PROMPT_TEMPLATE
+
+# 発表練習で行う質問の数です
+PRESENTATION_QUESTION_COUNT = 3
+# 回答を評価するジョブの種類です
+EVALUATION_JOB = 'evaluation'
+# すべての質問が終わった後のメッセージです
+PRESENTATION_DONE_MESSAGE = "質問は以上です。「完了」を押すと発表練習を通してのフィードバックが送信されます。"
+
+
+# 発表練習の質問を最初にまとめて生成し、以降の質問をOpenAIを呼ばずに返すクラス
+# 生成した質問はセッションごとの属性としてユーザー情報に保存します
+class PresentationPractice:
+    # コンストラクタで各ハンドラを初期化します
+    def __init__(self, dynamodb_handler, openai_handler):
+        self.dynamodb_handler = dynamodb_handler
+        self.openai_handler = openai_handler
+
+    # 発表原稿から質問をまとめて生成し、最初の質問を返します
+    # 質問を取り出せなかった場合は、生成されたテキストをそのまま返します。OpenAIへのリクエストはステップとしてyieldします
+    def start_steps(self, script, user_id, user_state):
+        prompt = PRESENTATION_PLAN_PROMPT_TEMPLATE.format(count=PRESENTATION_QUESTION_COUNT, script=script)
+        ai_response = yield from self.openai_handler.get_ai_response_steps(
+            prompt, user_id, [], user_state.mode_code, user_state, PRESENTATION_PLAN_PROFILE)
+        plan = parse_plan(ai_response)
+        # 質問を取り出せなかった場合は、以降の質問をその都度生成します
+        user_state.set_session_value('presentation_plan', plan)
+        if not plan:
+            return ai_response
+        return self.next_question(user_state)
+
+    # 次の質問を返します。すべての質問が終わった場合は終了のメッセージを返します
+    def next_question(self, user_state):
+        plan = user_state.get_session_value('presentation_plan')
+        index = int(user_state.get_session_value('presentation_index'))
+        if index < len(plan) + 1:
+            user_state.set_session_value('presentation_index', index + 1)
+        if index >= len(plan):
+            return PRESENTATION_DONE_MESSAGE
+        return f"Q{index + 1}:{plan[index]['question']}"
+
+    # ユーザーが回答している質問を返します。質問の前後ではNoneを返します
+    def current_question(self, user_state):
+        plan = user_state.get_session_value('presentation_plan')
+        index = int(user_state.get_session_value('presentation_index'))
+        if not plan or not 1 <= index <= len(plan):
+            return None
+        return plan[index - 1]['question']
+
+    # 現在の質問の代わりの質問を返します。代わりの質問がない場合はNoneを返します
+    def alternate_question(self, user_state):
+        plan = user_state.get_session_value('presentation_plan')
+        index = int(user_state.get_session_value('presentation_index'))
+        if not plan or not 1 <= index <= len(plan) or not plan[index - 1].get('alternate'):
+            return None
+        # 同じ代わりの質問を2回使わないよう、使った質問を現在の質問に置き換えます
+        plan = list(plan)
+        plan[index - 1] = {'question': plan[index - 1]['alternate'], 'alternate': ''}
+        user_state.set_session_value('presentation_plan', plan)
+        return f"Q{index}:{plan[index - 1]['question']}"
+
+    # 質問への回答を評価するジョブを作成します
+    # ジョブは次の質問を返信した後に、lambda_function.submit_follow_up_jobsで実行します
+    def plan_evaluation(self, user_id, session_id, question, answer):
+        return {
+            'type': EVALUATION_JOB,
+            'job_id': uuid.uuid4().hex,
+            'user_id': user_id,
+            'group_id': f'{user_id}:follow-up',
+            'session_id': session_id,
+            'question': question,
+            'answer': answer,
+        }
+
+    # ジョブとして回答を安いモデルで評価し、フィードバックのためのメモとしてセッションの属性に追加します
+    # フィードバックを作成するまでに完了しなかった評価と、セッションが変わった後の評価はメモに含まれません
+    def evaluate_answer(self, job):
+        question = job['question']
+        try:
+            note = self.openai_handler.generate_text(
+                EVALUATION_PROMPT_TEMPLATE.format(question=question, answer=job['answer']), EVALUATION_PROFILE)
+            self.dynamodb_handler.append_session_values(
+                job['user_id'], job['session_id'], 'presentation_notes', [f"{question}: {note}"])
+        except Exception as e:
+            print(f"Error while evaluating the answer: {e}")
+
+    # 保存した評価のメモをフィードバックのプロンプトに追加します
+    def build_feedback_prompt(self, prompt, user_state):
+        notes = user_state.get_session_value('presentation_notes')
+        if not notes:
+            return prompt
+        return prompt + "\n\n#各回答の評価メモ\n" + "\n".join(notes)
+
+
+# 生成されたテキストから質問のリストを取り出します。取り出せない場合は空のリストを返します
+def parse_plan(text):
+    start = text.find('{')
+    end = text.rfind('}')
+    if start < 0 or end < start:
+        return []
+    try:
+        questions = json.loads(text[start:end + 1]).get('questions', [])
+    except ValueError:
+        return []
+    plan = []
+    for entry in questions:
+        if isinstance(entry, dict) and entry.get('question'):
+            plan.append({'question': str(entry['question']).strip(), 'alternate': str(entry.get('alternate') or '').strip()})
+    return plan[:PRESENTATION_QUESTION_COUNT]
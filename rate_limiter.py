@@ -0,0 +1,156 @@
+import decimal
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from steps import Delay, run_steps
+
+# OpenAI APIの1分あたりのリクエスト数とトークン数の上限です。0の場合は制限しません
+OPENAI_RPM_LIMIT = int(os.environ.get('OPENAI_RPM_LIMIT', '0'))
+OPENAI_TPM_LIMIT = int(os.environ.get('OPENAI_TPM_LIMIT', '0'))
+# 全インスタンスで共有するトークンバケットの状態を保存するテーブルです。未設定の場合はプロセス内のメモリで管理します
+RATE_LIMIT_TABLE_NAME = os.environ.get('RATE_LIMIT_TABLE_NAME')
+RATE_LIMIT_KEY = os.environ.get('RATE_LIMIT_KEY', 'openai')
+# 枠が空くまで待つ最大の秒数です。これを超える場合はリクエストを受け付けずに打ち切ります
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.environ.get('RATE_LIMIT_MAX_WAIT_SECONDS', '10'))
+# 共有のバケットの更新が他のインスタンスと競合した場合に、やり直すまでの待ち時間の基準と上限（秒）です
+RATE_LIMIT_CONFLICT_BACKOFF = float(os.environ.get('RATE_LIMIT_CONFLICT_BACKOFF', '0.02'))
+RATE_LIMIT_CONFLICT_BACKOFF_MAX = float(os.environ.get('RATE_LIMIT_CONFLICT_BACKOFF_MAX', '0.5'))
+
+RATE_LIMITED_MESSAGE = "ただいま混み合っています。しばらくしてからもう一度お試しください。"
+
+
+# 待ち時間の上限までに枠が空かない場合に送出される例外
+class RateLimited(Exception):
+    pass
+
+
+# リクエスト数とトークン数の2つのトークンバケットを補充し、取得できるかどうかを判定します
+# 取得できる場合は新しい残量を、できない場合は枠が空くまでの秒数を返します
+# window_secondsは上限の単位となる時間です（通常は60秒、シミュレーションでは短くできます）
+def take_from_buckets(state, now, requests, tokens, rpm, tpm, window_seconds=60):
+    elapsed = max(0.0, now - state['updated_at'])
+    request_tokens = min(rpm, state['request_tokens'] + elapsed * rpm / window_seconds)
+    token_tokens = min(tpm, state['token_tokens'] + elapsed * tpm / window_seconds)
+    # バケットの容量を超える要求は、容量いっぱいまで待てば受け付けます
+    requests = min(requests, rpm)
+    tokens = min(tokens, tpm)
+    wait = max(
+        (requests - request_tokens) * window_seconds / rpm if request_tokens < requests else 0.0,
+        (tokens - token_tokens) * window_seconds / tpm if token_tokens < tokens else 0.0
+    )
+    if wait > 0:
+        return None, wait
+    return {'request_tokens': request_tokens - requests, 'token_tokens': token_tokens - tokens, 'updated_at': now}, 0.0
+
+
+# リクエストを受け付けるか、待たせるか、打ち切るかを判定する共通の処理を持つクラス
+class RateLimiter:
+    # コンストラクタで上限を初期化します
+    def __init__(self, rpm, tpm, max_wait_seconds=RATE_LIMIT_MAX_WAIT_SECONDS, window_seconds=60):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_wait_seconds = max_wait_seconds
+        self.window_seconds = window_seconds
+
+    # リクエストの実行を許可します。枠が空くまで待ち、上限を超える場合はRateLimitedを送出します
+    def admit(self, tokens, requests=1):
+        run_steps(self.admit_steps(tokens, requests))
+
+    # admitと同じ処理を、枠が空くまでの待機をDelayのステップとしてyieldするジェネレータで行います
+    def admit_steps(self, tokens, requests=1):
+        deadline = time.monotonic() + self.max_wait_seconds
+        while True:
+            wait = self.try_acquire(requests, tokens, deadline)
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimited(RATE_LIMITED_MESSAGE)
+            yield Delay(wait)
+
+
+# トークンバケットの状態をプロセス内のメモリで管理するクラス
+class InMemoryRateLimiter(RateLimiter):
+    # コンストラクタで満杯のバケットを初期化します
+    def __init__(self, rpm, tpm, max_wait_seconds=RATE_LIMIT_MAX_WAIT_SECONDS, window_seconds=60):
+        super().__init__(rpm, tpm, max_wait_seconds, window_seconds)
+        self.lock = threading.Lock()
+        self.state = {'request_tokens': rpm, 'token_tokens': tpm, 'updated_at': time.time()}
+
+    # バケットから取得します。取得できた場合は0を、できない場合は待つべき秒数を返します
+    def try_acquire(self, requests, tokens, deadline=None):
+        with self.lock:
+            new_state, wait = take_from_buckets(self.state, time.time(), requests, tokens, self.rpm, self.tpm, self.window_seconds)
+            if new_state is not None:
+                self.state = new_state
+            return wait
+
+
+# トークンバケットの状態をDynamoDBに保存し、全インスタンスで共有するクラス
+class DynamoDBRateLimiter(RateLimiter):
+    # コンストラクタでテーブルオブジェクトを取得します
+    def __init__(self, table_name, key, rpm, tpm, max_wait_seconds=RATE_LIMIT_MAX_WAIT_SECONDS):
+        super().__init__(rpm, tpm, max_wait_seconds)
+        self.table_name = table_name
+        self.key = key
+
+    # バケットから取得します。他のインスタンスと同時に更新した場合は、ジッター付きの指数バックオフで待ってから読み直します
+    # 待ち時間がdeadline（time.monotonic()の値）を超える場合はRateLimitedを送出します
+    def try_acquire(self, requests, tokens, deadline=None):
+        from dynamodb_handler import get_dynamodb_resource, is_conditional_check_failed
+        table = get_dynamodb_resource().Table(self.table_name)
+        if deadline is None:
+            deadline = time.monotonic() + self.max_wait_seconds
+        conflicts = 0
+        while True:
+            item = table.get_item(Key={'limiter_id': self.key}, ConsistentRead=True).get('Item')
+            now = time.time()
+            if item is None:
+                state = {'request_tokens': self.rpm, 'token_tokens': self.tpm, 'updated_at': now}
+            else:
+                state = {name: float(item[name]) for name in ('request_tokens', 'token_tokens', 'updated_at')}
+            new_state, wait = take_from_buckets(state, now, requests, tokens, self.rpm, self.tpm, self.window_seconds)
+            if new_state is None:
+                return wait
+            try:
+                # 読み込んだ後に他のインスタンスが更新していない場合だけ書き込みます
+                table.put_item(
+                    Item={'limiter_id': self.key, **{name: to_decimal(value) for name, value in new_state.items()}},
+                    ConditionExpression="attribute_not_exists(limiter_id) OR updated_at = :updated_at",
+                    ExpressionAttributeValues={':updated_at': item['updated_at'] if item is not None else decimal.Decimal(0)}
+                )
+                return 0.0
+            except ClientError as e:
+                if not is_conditional_check_failed(e):
+                    raise
+            delay = random.uniform(0, min(RATE_LIMIT_CONFLICT_BACKOFF_MAX, RATE_LIMIT_CONFLICT_BACKOFF * (2 ** conflicts)))
+            if time.monotonic() + delay > deadline:
+                raise RateLimited(RATE_LIMITED_MESSAGE)
+            conflicts += 1
+            time.sleep(delay)
+
+
+# floatをDynamoDBに保存できるDecimalに変換します
+def to_decimal(value):
+    return decimal.Decimal(str(round(value, 6)))
+
+
+RATE_LIMITER = None
+RATE_LIMITER_LOCK = threading.Lock()
+
+
+# 環境変数の設定に応じたレートリミッタを取得します。制限しない設定の場合はNoneを返します
+def get_rate_limiter():
+    global RATE_LIMITER
+    if OPENAI_RPM_LIMIT <= 0 or OPENAI_TPM_LIMIT <= 0:
+        return None
+    with RATE_LIMITER_LOCK:
+        if RATE_LIMITER is None:
+            if RATE_LIMIT_TABLE_NAME:
+                RATE_LIMITER = DynamoDBRateLimiter(RATE_LIMIT_TABLE_NAME, RATE_LIMIT_KEY, OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+            else:
+                RATE_LIMITER = InMemoryRateLimiter(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+    return RATE_LIMITER
@@ -0,0 +1,95 @@
+import collections
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from ttl_cache import TTLCache
+
+# 応答キャッシュの永続化に使うテーブルです。未設定の場合はウォームコンテナ内のメモリだけを使います
+RESPONSE_CACHE_TABLE_NAME = os.environ.get('RESPONSE_CACHE_TABLE_NAME')
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', str(7 * 24 * 60 * 60)))
+RESPONSE_CACHE_MEMORY_SIZE = int(os.environ.get('RESPONSE_CACHE_MEMORY_SIZE', '1024'))
+RESPONSE_CACHE_MEMORY_TTL_SECONDS = float(os.environ.get('RESPONSE_CACHE_MEMORY_TTL_SECONDS', '3600'))
+
+# キャッシュのヒット数、ミス数と、ヒットによって短縮できた生成時間の合計です
+RESPONSE_CACHE_STATS = collections.Counter()
+RESPONSE_CACHE_STATS_LOCK = threading.Lock()
+
+
+# キャッシュのキーに使うために、表記の揺れ（全角半角、空白）をそろえます
+# 英文添削では大文字小文字の誤りも指摘の対象になるため、大文字小文字は区別します
+def normalize_prompt(text):
+    text = unicodedata.normalize('NFKC', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+# モデル、正規化したプロンプト、プロンプトの前に送信するメッセージ（システムプロンプトと会話履歴）、モードコードから
+# キャッシュのキーを作成します。送信する文脈をすべてキーに含めるため、文脈が異なる会話の応答は返しません
+def build_cache_key(model, prompt, context_messages, mode_code):
+    context = json.dumps(context_messages, ensure_ascii=False, sort_keys=True)
+    material = '\x1f'.join([model, normalize_prompt(prompt), context, str(int(mode_code))])
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+# 統計を記録します
+def record_stat(name, value=1):
+    with RESPONSE_CACHE_STATS_LOCK:
+        RESPONSE_CACHE_STATS[name] += value
+
+
+# メモリとDynamoDBの2段階で生成結果をキャッシュするクラス
+class ResponseCache:
+    # コンストラクタでメモリのキャッシュとテーブルを初期化します
+    def __init__(self, table_name=RESPONSE_CACHE_TABLE_NAME):
+        self.memory = TTLCache(RESPONSE_CACHE_MEMORY_SIZE, RESPONSE_CACHE_MEMORY_TTL_SECONDS)
+        self.table_name = table_name
+
+    # キャッシュされた応答を取得します。見つかった場合は(応答, 短縮できた生成時間)を、見つからない場合はNoneを返します
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.record_hit('hit_memory', entry)
+            return entry['response'], entry['latency_ms']
+        if self.table_name:
+            try:
+                item = self.get_table().get_item(Key={'cache_key': key}).get('Item')
+            except Exception as e:
+                print(f"Error while reading the response cache: {e}")
+                item = None
+            # TTLによる削除は遅れることがあるため、期限切れの項目は無視します
+            if item is not None and int(item['expires_at']) > time.time():
+                entry = {'response': item['response'], 'latency_ms': float(item.get('latency_ms', 0))}
+                self.memory.set(key, entry)
+                self.record_hit('hit_dynamodb', entry)
+                return entry['response'], entry['latency_ms']
+        record_stat('miss')
+        return None
+
+    # 生成した応答と生成にかかった時間をキャッシュします
+    def set(self, key, response, latency_ms):
+        entry = {'response': response, 'latency_ms': latency_ms}
+        self.memory.set(key, entry)
+        if self.table_name:
+            try:
+                self.get_table().put_item(Item={
+                    'cache_key': key,
+                    'response': response,
+                    'latency_ms': int(latency_ms),
+                    'expires_at': int(time.time()) + RESPONSE_CACHE_TTL_SECONDS
+                })
+            except Exception as e:
+                print(f"Error while writing the response cache: {e}")
+
+    # ヒットした統計を記録します
+    def record_hit(self, name, entry):
+        record_stat(name)
+        record_stat('latency_saved_ms', entry['latency_ms'])
+
+    # キャッシュのテーブルを取得します
+    def get_table(self):
+        from dynamodb_handler import get_dynamodb_resource
+        return get_dynamodb_resource().Table(self.table_name)
@@ -0,0 +1,333 @@
+# Lambdaの代わりに常駐して動かすWebhookサーバーです。asyncioでリクエストを受け付けてすぐに応答し、
+# メッセージの処理はlambda_functionと同じハンドラをワーカースレッドで実行します
+# OpenAIの応答はaiohttpのクライアントでイベントループで待つため、応答を待っている会話はスレッドを占有しません
+# 複数のワーカープロセスで動かす場合は、受け付けたプロセスがユーザーIDごとに決まったワーカーへイベントを振り分けます
+# 実行方法: python server.py [--host 0.0.0.0] [--port 8080] [--workers プロセス数]
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import lambda_function
+from async_http_client import AsyncRetryingHttpClient
+from steps import Call, Gather, PostRequest
+from tracing import get_current_trace, set_current_trace
+
+# Webhookのパスと、署名の検証に使うチャネルシークレットです（未設定の場合は検証しません）
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/callback')
+CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET')
+# 1プロセスでメッセージを処理するスレッド数です。DynamoDBやLINEの呼び出しを行い、OpenAIの応答を待つ間は他の会話を処理します
+SERVER_WORKER_THREADS = int(os.environ.get('SERVER_WORKER_THREADS', '64'))
+# ストリーミングの受信のように、ステップに分けられないブロックする処理（Callのステップ）を実行するスレッド数です
+SERVER_BLOCKING_THREADS = int(os.environ.get('SERVER_BLOCKING_THREADS', '32'))
+# 1プロセスからOpenAIへ張るコネクション数の上限です。応答を待つ会話の数だけ必要になるため、スレッド数より多くします
+SERVER_OPENAI_CONNECTIONS = int(os.environ.get('SERVER_OPENAI_CONNECTIONS', '1000'))
+# 1プロセスで受け付けて処理を待っているユーザーの上限です。超えた場合は503を返してLINEに再送させます
+SERVER_MAX_PENDING = int(os.environ.get('SERVER_MAX_PENDING', '10000'))
+# 接続の待ち行列の長さです。多数のWebhookが同時に届いても接続を拒否しないようにします
+SERVER_BACKLOG = int(os.environ.get('SERVER_BACKLOG', '1024'))
+# 遅延書き込みのログを書き込む間隔（秒）です
+LOG_FLUSH_INTERVAL_SECONDS = float(os.environ.get('LOG_FLUSH_INTERVAL_SECONDS', '1'))
+
+
+# LINEの署名を検証します
+def is_valid_signature(body, signature):
+    digest = hmac.new(CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode('utf-8'), signature or '')
+
+
+# Webhookの本文のイベントをユーザーIDごとに受信順でまとめます
+def group_events_by_user(body):
+    events_by_user = {}
+    for line_event in json.loads(body).get('events', []):
+        user_id = line_event.get('source', {}).get('userId')
+        events_by_user.setdefault(user_id, []).append(line_event)
+    return events_by_user
+
+
+# ユーザーIDからイベントを処理するワーカーの番号を決めます。プロセスを再起動しても同じワーカーになるようにします
+def get_worker_index(user_id, workers):
+    return zlib.crc32((user_id or '').encode('utf-8')) % workers
+
+
+# ワーカースレッドで、ステップをyieldするジェネレータを次のステップまで進めます
+# トレースはスレッドごとに保持されるため、前のステップまでのトレースを設定してから進め、進めた後は外します
+# 完了した場合は(True, 戻り値, None)を、ステップをyieldした場合は(False, ステップ, トレース)を返します
+def advance_steps(steps, result, error, trace):
+    set_current_trace(trace)
+    try:
+        step = steps.throw(error) if error is not None else steps.send(result)
+        return False, step, get_current_trace()
+    except StopIteration as e:
+        return True, e.value, None
+    finally:
+        set_current_trace(None)
+
+
+# Callのステップの関数を、前のステップまでのトレースを設定したスレッドで呼び出します
+def call_with_trace(step, trace):
+    set_current_trace(trace)
+    try:
+        return step.function(*step.args)
+    finally:
+        set_current_trace(None)
+
+
+# Webhookを受け付け、ユーザーごとに受信順でイベントを処理するサーバー
+class WebhookServer:
+    # コンストラクタでワーカースレッドと処理中のタスクを初期化します
+    def __init__(self, worker_threads=SERVER_WORKER_THREADS, max_pending=SERVER_MAX_PENDING):
+        self.worker_threads = worker_threads
+        # ユーザーごとに決まったスレッドで処理します。1つの会話のステップは常に同じスレッドのハンドラで実行され、
+        # OpenAIの応答を待つ間は同じスレッドで他の会話のステップを実行します
+        self.lanes = [ThreadPoolExecutor(max_workers=1) for _ in range(worker_threads)]
+        # ブロックする処理は会話を処理するスレッドとは別のスレッドで実行し、同じスレッドの他の会話を待たせないようにします
+        self.blocking_executor = ThreadPoolExecutor(max_workers=SERVER_BLOCKING_THREADS)
+        self.max_pending = max_pending
+        # 同期のHTTPクライアントと同じ設定で、イベントループで応答を待つクライアントです
+        self.http_clients = {}
+        # ユーザーごとの最後のタスクです。同じユーザーのイベントは前のタスクが終わってから処理します
+        self.user_tasks = {}
+        self.processed_count = 0
+
+    # aiohttpのアプリケーションを作成します
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_webhook)
+        app.router.add_get('/health', self.handle_health)
+        app.on_startup.append(self.warm_up)
+        app.on_startup.append(self.start_background_tasks)
+        app.on_shutdown.append(self.shutdown)
+        return app
+
+    # Webhookを受け付けます。処理の完了を待たずに応答します
+    async def handle_webhook(self, request):
+        body = await request.read()
+        if CHANNEL_SECRET and not is_valid_signature(body, request.headers.get('X-Line-Signature')):
+            return web.Response(status=400, text='Invalid signature')
+        if len(self.user_tasks) >= self.max_pending:
+            return web.Response(status=503, text='Busy')
+
+        for user_id, user_events in group_events_by_user(body).items():
+            self.schedule(user_id, user_events)
+        return web.Response(text='OK')
+
+    # 処理中のユーザー数を返します
+    async def handle_health(self, request):
+        return web.json_response({'pending_users': len(self.user_tasks), 'processed': self.processed_count})
+
+    # ユーザーのイベントの処理を、同じユーザーの前のタスクの後に予約します
+    # on_doneを指定した場合は、イベントの処理が終わった時に呼び出します
+    def schedule(self, user_id, user_events, on_done=None):
+        previous = self.user_tasks.get(user_id)
+        task = asyncio.ensure_future(self.process_user_events(previous, user_id, user_events))
+        self.user_tasks[user_id] = task
+
+        def forget(finished):
+            if self.user_tasks.get(user_id) is finished:
+                del self.user_tasks[user_id]
+            if on_done is not None:
+                on_done()
+        task.add_done_callback(forget)
+
+    # 前のタスクの完了を待ってから、ユーザーのスレッドでイベントを処理します
+    async def process_user_events(self, previous, user_id, user_events):
+        if previous is not None:
+            await asyncio.wait([previous])
+        lane = self.lanes[get_worker_index(user_id, len(self.lanes))]
+        handlers = await asyncio.get_running_loop().run_in_executor(lane, lambda_function.get_handlers)
+        for line_event in user_events:
+            # 1つのイベントの失敗が他のイベントに影響しないように、イベントごとに例外を捕捉します
+            try:
+                await self.run_steps(lane, lambda_function.process_event_steps(line_event, *handlers))
+            except Exception as e:
+                print(f"Error while processing event: {e}")
+        self.processed_count += len(user_events)
+
+    # ジェネレータのステップの間の処理をスレッドで実行し、yieldされた通信と待機をイベントループで待ちます
+    # 並行して実行するジェネレータ（Gather）も同じスレッドで進め、ブロックする処理（Call）は別のスレッドで実行します
+    async def run_steps(self, lane, steps):
+        loop = asyncio.get_running_loop()
+        result, error, trace = None, None, None
+        while True:
+            done, step, trace = await loop.run_in_executor(lane, advance_steps, steps, result, error, trace)
+            if done:
+                return step
+            result, error = None, None
+            try:
+                if isinstance(step, PostRequest):
+                    result = await self.get_http_client(step.client).post(step.url, headers=step.headers, json=step.json,
+                                                                          deadline=step.deadline)
+                elif isinstance(step, Gather):
+                    limit = asyncio.Semaphore(max(1, step.max_parallel))
+                    result = await asyncio.gather(*(self.run_gathered_steps(lane, gathered, limit) for gathered in step.steps))
+                elif isinstance(step, Call):
+                    result = await loop.run_in_executor(self.blocking_executor, call_with_trace, step, trace)
+                else:
+                    await asyncio.sleep(step.seconds)
+            except Exception as e:
+                error = e
+
+    # Gatherの1つのジェネレータを実行し、(戻り値, 送出した例外)を返します
+    async def run_gathered_steps(self, lane, steps, limit):
+        async with limit:
+            try:
+                return await self.run_steps(lane, steps), None
+            except Exception as e:
+                return None, e
+
+    # 同期のHTTPクライアントと同じ設定で、イベントループで応答を待つクライアントを取得します
+    def get_http_client(self, client):
+        if id(client) not in self.http_clients:
+            self.http_clients[id(client)] = AsyncRetryingHttpClient(client, SERVER_OPENAI_CONNECTIONS, client.max_in_flight)
+        return self.http_clients[id(client)]
+
+    # 受け付けを始める前に、すべてのワーカースレッドでハンドラを作成しておきます
+    # boto3のリソースの作成はCPUを使うため、リクエストの処理中に作成するとイベントループの応答が遅れます
+    async def warm_up(self, app):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(lane, lambda_function.get_handlers) for lane in self.lanes))
+
+    async def start_background_tasks(self, app):
+        self.flush_task = asyncio.ensure_future(self.flush_logs_periodically())
+
+    # 遅延書き込みのログを定期的に書き込みます。常駐するため、先読みの完了は待ちません
+    async def flush_logs_periodically(self):
+        from log_sink import flush_all_log_sinks
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(LOG_FLUSH_INTERVAL_SECONDS)
+            try:
+                await loop.run_in_executor(None, flush_all_log_sinks)
+            except Exception as e:
+                print(f"Error while flushing logs: {e}")
+
+    # 終了時は処理中のイベントと返信の後に行うジョブを最後まで処理し、ログを書き込みます
+    async def shutdown(self, app):
+        self.flush_task.cancel()
+        if self.user_tasks:
+            await asyncio.wait(list(self.user_tasks.values()))
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, lambda_function.wait_for_follow_up_jobs)
+        await loop.run_in_executor(None, lambda_function.flush_logs)
+        for lane in self.lanes:
+            lane.shutdown()
+        self.blocking_executor.shutdown()
+        for http_client in self.http_clients.values():
+            await http_client.close()
+
+
+# Webhookを受け付け、ユーザーIDごとに決まったワーカープロセスへイベントを振り分けるサーバー
+# 同じユーザーのイベントは常に同じワーカーで受信順に処理されるため、ユーザー情報の書き込みが互いに上書きされず、
+# 再配信されたイベントも同じワーカーの記録で重複を検出できます
+class WebhookDispatcher:
+    # コンストラクタでワーカーごとのキューと、処理を待っているイベント列の数を設定します
+    def __init__(self, queues, pending_counts, max_pending=SERVER_MAX_PENDING):
+        self.queues = queues
+        self.pending_counts = pending_counts
+        self.max_pending = max_pending
+
+    # aiohttpのアプリケーションを作成します
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_webhook)
+        app.router.add_get('/health', self.handle_health)
+        return app
+
+    # Webhookを受け付けます。イベントをワーカーのキューに入れ、処理の完了を待たずに応答します
+    async def handle_webhook(self, request):
+        body = await request.read()
+        if CHANNEL_SECRET and not is_valid_signature(body, request.headers.get('X-Line-Signature')):
+            return web.Response(status=400, text='Invalid signature')
+        events_by_user = group_events_by_user(body)
+        indexes = {user_id: get_worker_index(user_id, len(self.queues)) for user_id in events_by_user}
+        if any(self.pending_counts[index].value >= self.max_pending for index in indexes.values()):
+            return web.Response(status=503, text='Busy')
+        for user_id, user_events in events_by_user.items():
+            index = indexes[user_id]
+            with self.pending_counts[index].get_lock():
+                self.pending_counts[index].value += 1
+            self.queues[index].put((user_id, user_events))
+        return web.Response(text='OK')
+
+    # ワーカーごとの処理を待っているイベント列の数を返します
+    async def handle_health(self, request):
+        return web.json_response({'pending': [count.value for count in self.pending_counts]})
+
+
+# 1つのプロセスでWebhookを受け付け、イベントを処理します
+def run_server(host, port):
+    web.run_app(WebhookServer().create_app(), host=host, port=port, backlog=SERVER_BACKLOG, print=None)
+
+
+# ワーカープロセスでキューからイベントを受け取り、ユーザーごとに受信順で処理します。Noneを受け取ったら終了します
+def run_worker(queue, pending_count):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_queue(WebhookServer(), queue, pending_count))
+
+
+async def serve_queue(server, queue, pending_count):
+    app = web.Application()
+    await server.warm_up(app)
+    await server.start_background_tasks(app)
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+
+    def release():
+        with pending_count.get_lock():
+            pending_count.value -= 1
+
+    # キューからの受信はブロックするため、専用のスレッドで受け取ってイベントループに渡します
+    def receive():
+        while True:
+            item = queue.get()
+            if item is None:
+                loop.call_soon_threadsafe(stopped.set_result, None)
+                return
+            user_id, user_events = item
+            loop.call_soon_threadsafe(server.schedule, user_id, user_events, release)
+
+    threading.Thread(target=receive, daemon=True).start()
+    await stopped
+    await server.shutdown(app)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', '8080')))
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        run_server(args.host, args.port)
+        return
+    queues = [multiprocessing.Queue() for _ in range(args.workers)]
+    pending_counts = [multiprocessing.Value('i', 0) for _ in range(args.workers)]
+    processes = [multiprocessing.Process(target=run_worker, args=(queue, pending_count))
+                 for queue, pending_count in zip(queues, pending_counts)]
+    for process in processes:
+        process.start()
+    try:
+        web.run_app(WebhookDispatcher(queues, pending_counts).create_app(), host=args.host, port=args.port,
+                    backlog=SERVER_BACKLOG, print=None)
+    finally:
+        # 受け付けを止めたら、各ワーカーにキューに残ったイベントを処理させてから終了させます
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import collections
+import os
+import threading
+import time
+import uuid
+
+from history_builder import count_message_tokens, count_tokens
+from metrics import log_metrics
+from mode_registry import ALTERNATE_QUESTION_PROMPT, QUESTION_PROFILE
+
+# 質問を返信した後に「分からない」の別の質問を先に生成しておきます（1で有効）
+SPECULATIVE_ALTERNATES = os.environ.get('SPECULATIVE_ALTERNATES', '0') == '1'
+# 先に生成した質問を使える時間です
+SPECULATION_TTL_SECONDS = int(os.environ.get('SPECULATION_TTL_SECONDS', '300'))
+# 先読みに使えるトークン数の1時間あたりの上限です。予算はジョブを実行するプロセスごとに数えます
+# 同時に生成する数は、ジョブを実行するスレッド数（lambda_function.FOLLOW_UP_THREADS）またはワーカーの数で制限されます
+SPECULATION_TOKEN_BUDGET = int(os.environ.get('SPECULATION_TOKEN_BUDGET', '20000'))
+SPECULATION_BUDGET_WINDOW_SECONDS = 3600
+# 先読みのジョブの種類です
+SPECULATION_JOB = 'speculation'
+
+# 先読みの統計です（launched / generated / skipped / hit / miss / wasted / used_tokens / wasted_tokens）
+SPECULATION_STATS = collections.Counter()
+SPECULATION_LOCK = threading.Lock()
+# 現在の時間枠の開始時刻と、その時間枠で使ったトークン数です
+SPECULATION_BUDGET = {'window_started_at': 0.0, 'tokens': 0}
+
+
+# 統計を記録し、メトリクスとして出力します
+def record_speculation(event, tokens=0, **values):
+    with SPECULATION_LOCK:
+        SPECULATION_STATS[event] += 1
+        if event == 'wasted':
+            SPECULATION_STATS['wasted_tokens'] += tokens
+        elif event == 'generated':
+            SPECULATION_STATS['used_tokens'] += tokens
+    log_metrics('speculation', event=event, tokens=tokens, **values)
+
+
+# 予算の範囲内であれば見積もったトークン数を予約します。予約できない場合はFalseを返します
+def reserve_budget(tokens):
+    with SPECULATION_LOCK:
+        now = time.monotonic()
+        if now - SPECULATION_BUDGET['window_started_at'] >= SPECULATION_BUDGET_WINDOW_SECONDS:
+            SPECULATION_BUDGET['window_started_at'] = now
+            SPECULATION_BUDGET['tokens'] = 0
+        if SPECULATION_BUDGET['tokens'] + tokens > SPECULATION_TOKEN_BUDGET:
+            return False
+        SPECULATION_BUDGET['tokens'] += tokens
+        return True
+
+
+# 「分からない」が押された時の別の質問を先に生成し、ユーザー情報に保存しておくクラス
+class AlternateSpeculator:
+    # コンストラクタで各ハンドラを初期化します
+    def __init__(self, dynamodb_handler, openai_handler):
+        self.dynamodb_handler = dynamodb_handler
+        self.openai_handler = openai_handler
+
+    # 先に生成した別の質問を取り出します。使えるものがない場合はNoneを返します
+    def take(self, user_state):
+        speculation = self.discard(user_state, used=True)
+        if speculation is None:
+            record_speculation('miss')
+            return None
+        record_speculation('hit')
+        return speculation['text']
+
+    # 保存されている先読みを削除し、使える場合はそれを返します
+    # usedがFalseの場合や期限切れの場合は、使われなかった先読みとして記録します
+    def discard(self, user_state, used=False):
+        speculation = (user_state.item or {}).get('speculative_alternate')
+        if not speculation:
+            return None
+        user_state.set_session_value('speculative_alternate', None)
+        usable = speculation.get('session_id') == user_state.session_id and int(speculation['expires_at']) > time.time()
+        if not used or not usable:
+            record_speculation('wasted', int(speculation.get('tokens', 0)))
+            return None
+        return speculation
+
+    # 返信した質問への別の質問を生成するジョブを作成します
+    # ジョブは返信とユーザー情報の書き込みの後に、lambda_function.submit_follow_up_jobsで実行します
+    def plan(self, user_id, session_id, conversation_history):
+        return {
+            'type': SPECULATION_JOB,
+            'job_id': uuid.uuid4().hex,
+            'user_id': user_id,
+            # ジョブキューでは、ユーザーの次のメッセージを先読みの完了まで待たせないよう、メッセージとは別のグループで順序を保ちます
+            'group_id': f'{user_id}:follow-up',
+            'session_id': session_id,
+            'conversation_history': conversation_history,
+        }
+
+    # ジョブとして別の質問を生成し、ユーザー情報に保存します。予算を超える場合は生成しません
+    def generate(self, job):
+        conversation_history = job['conversation_history']
+        messages = conversation_history + [{"role": "user", "content": ALTERNATE_QUESTION_PROMPT}]
+        estimated_tokens = count_message_tokens(messages) + QUESTION_PROFILE.max_tokens
+        if not reserve_budget(estimated_tokens):
+            record_speculation('skipped', estimated_tokens)
+            return
+        record_speculation('launched', estimated_tokens)
+        try:
+            text = self.openai_handler.generate_text(ALTERNATE_QUESTION_PROMPT, QUESTION_PROFILE, conversation_history)
+            tokens = count_message_tokens(conversation_history) + count_tokens(ALTERNATE_QUESTION_PROMPT) + count_tokens(text)
+            self.dynamodb_handler.update_user_attributes(job['user_id'], {'speculative_alternate': {
+                'text': text,
+                'session_id': job['session_id'],
+                'tokens': tokens,
+                'expires_at': int(time.time()) + SPECULATION_TTL_SECONDS
+            }})
+            record_speculation('generated', tokens)
+        except Exception as e:
+            print(f"Error while generating a speculative alternate question: {e}")
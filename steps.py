@@ -0,0 +1,55 @@
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 処理の途中で、OpenAIへのリクエストのような待ち時間の長い通信を要求するためのステップです
+# 処理はジェネレータとして書き、通信が必要な所でステップをyieldして結果を受け取ります
+# Lambdaではこのモジュールのrun_stepsが同じスレッドで通信を行い、常駐するサーバーではイベントループで通信を待ちます
+# deadlineはtime.monotonic()の値で、指定した場合はclientのtotal_timeoutの代わりにリトライを含めた全体の期限にします
+PostRequest = collections.namedtuple('PostRequest', ['client', 'url', 'headers', 'json', 'deadline'], defaults=[None])
+# 指定した秒数だけ待つステップです
+Delay = collections.namedtuple('Delay', ['seconds'])
+# ステップをyieldする複数のジェネレータを、最大max_parallel個まで同時に実行するステップです
+# 結果として、ジェネレータごとの(戻り値, 送出した例外)のリストを受け取ります
+Gather = collections.namedtuple('Gather', ['steps', 'max_parallel'])
+# ストリーミングの受信のように、ステップに分けられないブロックする処理を呼び出すステップです
+# 常駐するサーバーでは会話を処理するスレッドとは別のスレッドで呼び出すため、functionではスレッドごとのハンドラ（DynamoDB）を使いません
+Call = collections.namedtuple('Call', ['function', 'args'])
+
+
+# ステップをyieldするジェネレータを最後まで実行し、戻り値を返します。通信と待機はこのスレッドで行います
+def run_steps(steps):
+    result, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as e:
+            return e.value
+        result, error = None, None
+        try:
+            if isinstance(step, PostRequest):
+                result = step.client.post(step.url, headers=step.headers, json=step.json, deadline=step.deadline)
+            elif isinstance(step, Gather):
+                result = gather_steps(step)
+            elif isinstance(step, Call):
+                result = step.function(*step.args)
+            else:
+                time.sleep(step.seconds)
+        except Exception as e:
+            error = e
+
+
+# Gatherのジェネレータをスレッドで並行して実行し、(戻り値, 送出した例外)のリストを返します
+def gather_steps(step):
+    if not step.steps:
+        return []
+    with ThreadPoolExecutor(max(1, min(step.max_parallel, len(step.steps)))) as executor:
+        return list(executor.map(run_steps_safely, step.steps))
+
+
+# ジェネレータを最後まで実行し、(戻り値, 送出した例外)を返します
+def run_steps_safely(steps):
+    try:
+        return run_steps(steps), None
+    except Exception as e:
+        return None, e
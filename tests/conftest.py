@@ -0,0 +1,48 @@
+# テストではLINE、OpenAI、DynamoDBに接続せず、benchmarks/fakes.pyの代わりとmotoを使います
+import os
+import sys
+import threading
+
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+
+from fakes import FAKE_ENV, FakeOpenAIServer, LineRecorder, create_tables
+
+os.environ.update(FAKE_ENV)
+os.environ.setdefault('TRACE_OUTPUT', 'off')
+
+
+# motoのDynamoDBにユーザーとログのテーブルを作成します
+@pytest.fixture
+def dynamodb():
+    from moto import mock_aws
+    with mock_aws():
+        create_tables(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+        yield
+
+
+# OpenAIの代わりのサーバーを起動します
+@pytest.fixture(scope='session')
+def fake_openai():
+    server = FakeOpenAIServer(latency=0.0).start()
+    os.environ['OPENAI_API_URL'] = server.url
+    import openai_handler
+    openai_handler.OPENAI_API_URL = server.url
+    return server
+
+
+# LINE Bot APIの代わりに送信したメッセージを記録します
+@pytest.fixture
+def line_recorder():
+    import lambda_function
+    import line_handler
+    recorder = LineRecorder()
+    # 前のテストで作成したハンドラは前の代わりを保持しているので、すべてのスレッドで作り直させます
+    lambda_function.HANDLERS = threading.local()
+    previous = line_handler.LINE_BOT_API
+    line_handler.LINE_BOT_API = recorder
+    yield recorder
+    line_handler.LINE_BOT_API = previous
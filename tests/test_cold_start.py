@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+from fakes import FAKE_ENV
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# コールドスタートでは読み込まないモジュールです
+HEAVY_MODULES = ['boto3', 'botocore', 'linebot', 'requests']
+
+# lambda_functionだけを読み込んだ後に重いモジュールの有無を確認し、その後でメッセージを1件処理します
+SCRIPT = '''
+import json
+import sys
+sys.path.insert(0, "benchmarks")
+import lambda_function
+loaded = sorted(name for name in {heavy} if name in sys.modules)
+
+from moto import mock_aws
+from fakes import FakeOpenAIServer, LineRecorder, build_message_event, create_tables
+import line_handler
+import openai_handler
+server = FakeOpenAIServer(latency=0.0).start()
+openai_handler.OPENAI_API_URL = server.url
+recorder = LineRecorder()
+line_handler.LINE_BOT_API = recorder
+with mock_aws():
+    create_tables(lambda_function.USER_TABLE_NAME, lambda_function.LOG_TABLE_NAME)
+    event = build_message_event("cold-0", "Ucold", "Hello there.")
+    response = lambda_function.lambda_handler({{"body": json.dumps({{"events": [event]}})}}, None)
+server.stop()
+print(json.dumps({{"loaded": loaded, "status": response["statusCode"], "replies": [message.text for _, _, message in recorder.messages]}}))
+'''
+
+
+# lambda_functionの読み込みでは重いモジュールを読み込まず、初めてのメッセージの処理で読み込んで返信します
+def test_handler_works_after_lazy_import():
+    from fakes import FAKE_ANSWER
+    env = dict(os.environ, **FAKE_ENV, TRACE_OUTPUT='off')
+    env.pop('AWS_LAMBDA_FUNCTION_NAME', None)
+    result = subprocess.run([sys.executable, '-c', SCRIPT.format(heavy=HEAVY_MODULES)], cwd=ROOT_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    output = json.loads(result.stdout.splitlines()[-1])
+    assert output == {'loaded': [], 'status': 200, 'replies': [FAKE_ANSWER]}
@@ -0,0 +1,120 @@
+import json
+
+import boto3
+import botocore.client
+import pytest
+
+from fakes import FAKE_ENV, build_message_event
+
+# 変更前（ユーザー情報をその都度読み書きしていた版）に、会話を続けるメッセージ1件で行っていたDynamoDBの呼び出し回数です
+# どのモードでも、モードの取得、利用回数の確認と更新、モードの確認と更新、会話履歴の取得、ログの保存で10回でした
+BASELINE_CALLS_PER_MESSAGE = 10
+# モードごとに、モードに入ってから会話を続けるメッセージです
+MODE_MESSAGES = {
+    0: ['Hello there.', 'How are you?', 'I am fine.'],
+    1: ['【モード:フリートーク】', 'I like soccer.', 'I play it every weekend.'],
+    2: ['【モード:英文添削】', 'I has a pen.', 'She go to school yesterday.'],
+    3: ['【モード:発表練習】', 'I studied machine learning.', 'Because it is useful.'],
+}
+
+
+# GSIを持たない、インデックスを追加する前のログテーブルを作成します
+def create_log_table_without_index(table_name):
+    boto3.client('dynamodb').create_table(
+        TableName=table_name,
+        KeySchema=[{'AttributeName': 'line_user_id', 'KeyType': 'HASH'}, {'AttributeName': 'created_at', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'line_user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'created_at', 'AttributeType': 'S'},
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+# GSIがない場合は、ユーザーIDで検索してセッションのログだけを古い順に返します
+def test_session_logs_fall_back_to_the_user_query(dynamodb, monkeypatch):
+    import dynamodb_handler
+    from dynamodb_handler import DynamoDBHandler
+    monkeypatch.setattr(dynamodb_handler, 'LOG_SESSION_INDEX_UNAVAILABLE', {'since': None})
+    create_log_table_without_index('logs_without_index')
+    handler = DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], 'logs_without_index')
+    for session_id, count in (('old', 3), ('current', 4)):
+        for index in range(count):
+            handler.save_log('Unoindex', f'{session_id} {index}', 'answer', 1, session_id)
+    handler.save_log('Uother', 'other', 'answer', 1, 'current')
+
+    logs = handler.get_recent_logs('Unoindex', 3, 'current')
+    assert [log['user_message'] for log in logs] == ['current 1', 'current 2', 'current 3']
+    assert dynamodb_handler.LOG_SESSION_INDEX_UNAVAILABLE['since'] is not None
+    # 以降はGSIを試さずに検索し、セッションのログが上限より少なければ前のセッションのログの手前で終わります
+    logs = handler.get_recent_logs('Unoindex', 6, 'current')
+    assert [log['user_message'] for log in logs] == ['current 0', 'current 1', 'current 2', 'current 3']
+    after = logs[1]['created_at']
+    logs = handler.get_recent_logs('Unoindex', 6, 'current', after=after)
+    assert [log['user_message'] for log in logs] == ['current 2', 'current 3']
+    assert handler.get_recent_logs('Unoindex', 6, 'missing') == []
+
+
+def send(user_id, event_id, text):
+    import lambda_function
+    lambda_function.lambda_handler({'body': json.dumps({'events': [build_message_event(event_id, user_id, text)]})}, None)
+    # 返信の後に行うジョブの呼び出しも、そのメッセージの分として数えます
+    lambda_function.wait_for_follow_up_jobs()
+
+
+# すべてのテーブルへのDynamoDBの呼び出しを数えます
+@pytest.fixture
+def dynamodb_calls(monkeypatch):
+    calls = []
+    original = botocore.client.BaseClient._make_api_call
+
+    def make_api_call(client, operation_name, params):
+        if client.meta.service_model.service_name == 'dynamodb':
+            calls.append(operation_name)
+        return original(client, operation_name, params)
+
+    monkeypatch.setattr(botocore.client.BaseClient, '_make_api_call', make_api_call)
+    return calls
+
+
+# 会話を続けるメッセージ1件あたりの呼び出しは、どのモードでも変更前の半分以下です
+@pytest.mark.parametrize('mode_code', sorted(MODE_MESSAGES))
+def test_dynamodb_calls_per_message_are_halved(dynamodb, fake_openai, line_recorder, dynamodb_calls, monkeypatch, mode_code):
+    import lambda_function
+    monkeypatch.setattr(lambda_function, 'FOLLOW_UP_JOBS', 'thread')
+    user_id = f'Ucalls{mode_code}'
+    *warm_up, last = MODE_MESSAGES[mode_code]
+    for index, text in enumerate(warm_up):
+        send(user_id, f'{user_id}-{index}', text)
+    del dynamodb_calls[:]
+    send(user_id, f'{user_id}-last', last)
+    assert len(dynamodb_calls) <= BASELINE_CALLS_PER_MESSAGE / 2, dynamodb_calls
+
+
+# ユーザー情報のキャッシュを有効にすると読み込みを省けますが、他の実行環境での更新は有効期限まで見えません
+# 古いキャッシュで利用回数が少なく見えても、条件付きの書き込みで上限を守ります
+def test_stale_user_cache_still_enforces_the_limit(dynamodb, fake_openai, line_recorder, dynamodb_calls, monkeypatch):
+    import dynamodb_handler
+    from dynamodb_handler import DAILY_API_LIMIT, USAGE_LIMIT_MESSAGE, DynamoDBHandler, get_usage_date
+    from ttl_cache import TTLCache
+    monkeypatch.setattr(dynamodb_handler, 'USER_CACHE', TTLCache(16, 60))
+    send('Ustale', 'Ustale-0', 'Hello there.')
+    assert dynamodb_calls.count('GetItem') == 1
+    stale = dynamodb_handler.USER_CACHE.get('Ustale')
+    assert int(stale['api_count_total']) == 1
+
+    # 別の実行環境で上限まで利用されたものとし、この実行環境のキャッシュは古いままにします
+    handler = DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+    handler.user_table.update_item(
+        Key={'line_user_id': 'Ustale'},
+        UpdateExpression='SET api_count_total = :count, last_used_date = :date',
+        ExpressionAttributeValues={':count': DAILY_API_LIMIT, ':date': get_usage_date()}
+    )
+    dynamodb_handler.USER_CACHE.set('Ustale', stale)
+    requests_before = fake_openai.request_count
+    del dynamodb_calls[:]
+    send('Ustale', 'Ustale-1', 'How are you?')
+    assert 'GetItem' not in dynamodb_calls
+    assert fake_openai.request_count == requests_before
+    assert line_recorder.messages[-1][2].text == USAGE_LIMIT_MESSAGE
+    assert int(handler.user_table.get_item(Key={'line_user_id': 'Ustale'})['Item']['api_count_total']) == DAILY_API_LIMIT
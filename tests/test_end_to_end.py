@@ -0,0 +1,25 @@
+import random
+
+from fakes import FAKE_ANSWER, FAKE_ENV
+
+
+# モードを選ばずに送った文章のシナリオは、すべてのメッセージにモードコード0で返信します
+def test_free_text_scenario_replies_in_mode_0(dynamodb, fake_openai, line_recorder):
+    import lambda_function
+    from dynamodb_handler import get_dynamodb_resource
+    from end_to_end import SCENARIOS, run_user
+    from tracing import TRACE_LISTENERS
+    scenario = next(scenario for scenario in SCENARIOS if scenario[1] == 0)
+    traced_modes = []
+    TRACE_LISTENERS.append(lambda trace: traced_modes.append(trace.attributes.get('mode_code')))
+    try:
+        _, latencies = run_user(lambda_function, scenario, 0, random.Random(0))
+    finally:
+        TRACE_LISTENERS.pop()
+
+    assert len(latencies) == len(scenario[2])
+    assert [message.text for _, _, message in line_recorder.messages] == [FAKE_ANSWER] * len(scenario[2])
+    assert traced_modes == [0] * len(scenario[2])
+    logs = get_dynamodb_resource().Table(FAKE_ENV['LOG_TABLE_NAME']).scan()['Items']
+    assert sorted(log['user_message'] for log in logs) == sorted(scenario[2])
+    assert {int(log['mode_code']) for log in logs} == {0}
@@ -0,0 +1,68 @@
+import json
+
+from fakes import FAKE_ANSWER, FAKE_ENV, build_message_event
+
+MESSAGES = ['I like soccer.', 'I play it every weekend.', 'My team won yesterday.', 'I scored a goal.',
+            'We celebrated together.', 'I was very happy.', 'I want to play again.']
+
+
+def send(user_id, event_id, text):
+    import lambda_function
+    event = build_message_event(event_id, user_id, text)
+    lambda_function.lambda_handler({'body': json.dumps({'events': [event]})}, None)
+
+
+def create_pipeline():
+    from dynamodb_handler import DynamoDBHandler
+    from feedback_pipeline import FeedbackPipeline
+    from openai_handler import OpenAIHandler
+    dynamodb_handler = DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+    return FeedbackPipeline(dynamodb_handler, OpenAIHandler('dummy', dynamodb_handler))
+
+
+# ログを決められた数ずつに分け、最後の分は残りの数になります
+def test_split_into_chunks():
+    from feedback_pipeline import split_into_chunks
+    assert split_into_chunks(list(range(7)), 3) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert split_into_chunks([], 3) == []
+
+
+# 決められた数の会話がたまるたびに分析しておき、終了時には残りの会話だけを分析して分析結果をプロンプトに加えます
+def test_session_is_analyzed_in_chunks(dynamodb, fake_openai, line_recorder):
+    from feedback_pipeline import FEEDBACK_CHUNK_SIZE
+    from mode_registry import CHUNK_FINDINGS_HEADING
+    from steps import run_steps
+    from user_state import UserState
+    send('Uchunks', 'Uchunks-0', '【モード:フリートーク】')
+    for index, text in enumerate(MESSAGES[:FEEDBACK_CHUNK_SIZE + 1]):
+        send('Uchunks', f'Uchunks-{index + 1}', text)
+    pipeline = create_pipeline()
+    user_state = UserState(pipeline.dynamodb_handler, 'Uchunks')
+    logs = pipeline.dynamodb_handler.get_recent_logs('Uchunks', 20, user_state.session_id)
+    chunks = user_state.get_session_value('feedback_chunks')
+    assert [chunk['until'] for chunk in chunks] == [logs[FEEDBACK_CHUNK_SIZE - 1]['created_at']]
+
+    requests_before = fake_openai.request_count
+    prompt = run_steps(pipeline.build_prompt_steps('Feedback', 'Uchunks', user_state))
+    assert fake_openai.request_count == requests_before + 1
+    assert prompt == f'Feedback\n\n{CHUNK_FINDINGS_HEADING}\n（1）\n{FAKE_ANSWER}\n\n（2）\n{FAKE_ANSWER}'
+    assert [chunk['until'] for chunk in user_state.get_session_value('feedback_chunks')] == [
+        logs[FEEDBACK_CHUNK_SIZE - 1]['created_at'], logs[-1]['created_at']]
+    # 分析していないログがなければ、OpenAIを呼ばずに同じプロンプトを作成します
+    assert run_steps(pipeline.build_prompt_steps('Feedback', 'Uchunks', user_state)) == prompt
+    assert fake_openai.request_count == requests_before + 1
+
+
+# ログのないセッションの終了では分析を行わず、プロンプトをそのまま使ってフィードバックを返信します
+def test_session_end_without_logs(dynamodb, fake_openai, line_recorder):
+    from steps import run_steps
+    from user_state import UserState
+    pipeline = create_pipeline()
+    pipeline.dynamodb_handler.update_user_attributes('Uempty', {'mode_code': 1, 'session_id': 'empty'})
+    requests_before = fake_openai.request_count
+    assert run_steps(pipeline.build_prompt_steps('Feedback', 'Uempty', UserState(pipeline.dynamodb_handler, 'Uempty'))) == 'Feedback'
+    assert fake_openai.request_count == requests_before
+
+    send('Uempty', 'Uempty-0', '【フリートーク:完了】')
+    assert fake_openai.request_count == requests_before + 1
+    assert line_recorder.messages[-1][2].text == FAKE_ANSWER
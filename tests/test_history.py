@@ -0,0 +1,92 @@
+import json
+
+from fakes import FAKE_ENV, build_message_event
+
+
+class FakeLogs:
+    def __init__(self):
+        self.logs = []
+
+    def add(self, index):
+        self.logs.append({'created_at': f'2024-01-01 00:00:{index:02d}.000#0000',
+                          'user_message': 'word ' * 40, 'ai_response': 'word ' * 40})
+
+    def get_recent_logs(self, user_id, limit, session_id):
+        return self.logs[-limit:]
+
+
+class FakeSummarizer:
+    def __init__(self):
+        self.calls = 0
+
+    def summarize_history_steps(self, summary, messages):
+        self.calls += 1
+        return 'summary'
+        yield
+
+
+class FakeUsers:
+    def __init__(self, item=None):
+        self.item = item
+
+    def get_user(self, user_id):
+        return self.item
+
+
+def create_user_state(item=None):
+    from user_state import UserState
+    return UserState(FakeUsers(item), 'U')
+
+
+# 上限を超えた会話は返信の後に上限の半分まで要約し、次の数回の会話では要約を作り直しません
+def test_fold_runs_after_build_down_to_low_water_mark():
+    from history_builder import HistoryBuilder, count_tokens
+    from steps import run_steps
+    logs, summarizer, user_state = FakeLogs(), FakeSummarizer(), create_user_state({'session_id': 'session'})
+    for index in range(4):
+        logs.add(index)
+    log_tokens = count_tokens(logs.logs[0]['user_message']) * 2 + 8
+    builder = HistoryBuilder(logs, summarizer, token_budget=log_tokens * 3 + log_tokens // 2, fold_target=0.5)
+
+    history = builder.build('U', user_state)
+    assert summarizer.calls == 0
+    assert len(history) == 6
+    run_steps(builder.fold_steps('U', user_state))
+    assert summarizer.calls == 1
+    assert user_state.get_session_value('history_summary_until') == logs.logs[2]['created_at']
+
+    for index in range(4, 6):
+        logs.add(index)
+        history = builder.build('U', user_state)
+        run_steps(builder.fold_steps('U', user_state))
+        assert history[0]['role'] == 'system'
+    assert summarizer.calls == 1
+
+
+# 新しいセッションでは、以前のセッションの要約を会話履歴に含めません
+def test_new_session_ignores_previous_summary():
+    from history_builder import HistoryBuilder
+    user_state = create_user_state({'session_id': 'old', 'history_summary': 'old summary',
+                                    'history_summary_until': '2024-01-01 00:00:00.000#0000'})
+    builder = HistoryBuilder(FakeLogs(), FakeSummarizer())
+    assert builder.build('U', user_state)[0]['content'].endswith('old summary')
+
+    user_state.start_session()
+    assert builder.build('U', user_state) == []
+
+
+# 利用回数の上限に達したユーザーでは、会話履歴を組み立てず要約も行いません
+def test_over_limit_user_skips_history(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import lambda_function
+    from dynamodb_handler import DAILY_API_LIMIT, get_dynamodb_resource, get_usage_date
+    from history_builder import HistoryBuilder
+
+    def fail(*args, **kwargs):
+        raise AssertionError('history was built for a user over the limit')
+
+    monkeypatch.setattr(HistoryBuilder, 'build', fail)
+    get_dynamodb_resource().Table(FAKE_ENV['USER_TABLE_NAME']).put_item(Item={
+        'line_user_id': 'Ulimit', 'api_count_total': DAILY_API_LIMIT, 'last_used_date': get_usage_date()})
+    event = build_message_event('limit-1', 'Ulimit', 'hello')
+    lambda_function.lambda_handler({'body': json.dumps({'events': [event]})}, None)
+    assert len(line_recorder.messages) == 1
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+import requests
+
+from fakes import FakeOpenAIServer
+
+REQUEST = {'model': 'gpt-4o-mini', 'messages': [{'role': 'user', 'content': 'Hello'}]}
+
+
+@pytest.fixture
+def server():
+    server = FakeOpenAIServer(latency=0.0, stall_seconds=2.0).start()
+    yield server
+    server.stop()
+
+
+def create_client(**options):
+    from http_client import RetryingHttpClient
+    options.setdefault('backoff_base', 0.01)
+    return RetryingHttpClient(**options)
+
+
+# 429と5xxはバックオフしてリトライし、成功した応答を返します
+def test_retries_rate_limits_and_server_errors(server):
+    server.inject('429', '503', '500')
+    client = create_client(max_retries=3)
+    response = client.post(server.url, json=REQUEST)
+    assert response.status_code == 200
+    assert client.last_retry_count == 3
+    assert server.request_count == 4
+
+
+# リトライの回数を使い切った場合は最後のエラーの応答を返します
+def test_returns_last_error_after_max_retries(server):
+    server.inject('503', '503', '503')
+    client = create_client(max_retries=2)
+    response = client.post(server.url, json=REQUEST)
+    assert response.status_code == 503
+    assert server.request_count == 3
+
+
+# 応答が止まった場合は読み込みのタイムアウトで打ち切ってリトライします
+def test_retries_a_stalled_request_after_the_read_timeout(server):
+    server.inject('stall')
+    client = create_client(read_timeout=0.2, max_retries=1)
+    started_at = time.monotonic()
+    response = client.post(server.url, json=REQUEST)
+    assert response.status_code == 200
+    assert time.monotonic() - started_at < 1.0
+
+
+# リトライを含めた全体の時間はtotal_timeoutを超えません
+def test_total_timeout_bounds_retries(server):
+    server.inject('stall', 'stall', 'stall')
+    client = create_client(read_timeout=5, max_retries=3, total_timeout=0.5)
+    started_at = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        client.post(server.url, json=REQUEST)
+    assert time.monotonic() - started_at < 1.0
+
+
+# 遅いリクエストには2本目を重ね、早く返った方を採用します
+def test_hedged_request_wins_over_a_stalled_one(server):
+    server.inject('stall')
+    client = create_client(hedge=True, hedge_min_delay=0.1, max_retries=0)
+    started_at = time.monotonic()
+    response = client.post(server.url, json=REQUEST)
+    assert response.status_code == 200
+    assert time.monotonic() - started_at < 1.0
+    assert server.request_count == 2
@@ -0,0 +1,77 @@
+import json
+import threading
+
+import pytest
+
+from fakes import FAKE_ENV, build_message_event
+
+
+# Lambdaではメモリへの記録で再配信を検出できないため、テーブルの設定を必須にします
+def test_lambda_requires_idempotency_table(monkeypatch):
+    import idempotency
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_TABLE_NAME', None)
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', 'line-bot')
+    with pytest.raises(ValueError):
+        idempotency.create_idempotency_store()
+
+    monkeypatch.delenv('AWS_LAMBDA_FUNCTION_NAME')
+    assert isinstance(idempotency.create_idempotency_store(), idempotency.InMemoryIdempotencyStore)
+
+
+# スレッドごとに別のboto3のリソースからテーブルを作成します
+def test_dynamodb_store_uses_a_table_per_thread(dynamodb):
+    from idempotency import DynamoDBIdempotencyStore
+    store = DynamoDBIdempotencyStore('idempotency')
+    resources = []
+    thread = threading.Thread(target=lambda: resources.append(store.table.meta.client))
+    thread.start()
+    thread.join()
+    assert store.table.meta.client is not resources[0]
+
+
+def send(event):
+    import lambda_function
+    return lambda_function.lambda_handler({'body': json.dumps({'events': [event]})}, None)
+
+
+def get_api_count(user_id):
+    from dynamodb_handler import DynamoDBHandler
+    item = DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME']).get_user(user_id)
+    return int(item['api_count_total'])
+
+
+# 再配信されたイベントでは、OpenAIの呼び出し、利用回数の加算、返信を繰り返しません
+def test_redelivered_event_is_processed_once(dynamodb, fake_openai, line_recorder):
+    event = build_message_event('redelivered-0', 'Uredelivered', 'I like soccer.')
+    requests_before = fake_openai.request_count
+    send(event)
+    send(event)
+    assert fake_openai.request_count == requests_before + 1
+    assert get_api_count('Uredelivered') == 1
+    assert len(line_recorder.messages) == 1
+
+
+# 最初の処理に失敗したイベントは、再配信で処理をやり直せます
+def test_failed_event_can_be_retried(dynamodb, fake_openai, line_recorder):
+    event = build_message_event('retried-0', 'Uretried', 'I like soccer.')
+    fake_openai.inject('400')
+    send(event)
+    assert line_recorder.messages == []
+    assert get_api_count('Uretried') == 0
+    send(event)
+    assert len(line_recorder.messages) == 1
+    assert get_api_count('Uretried') == 1
+
+
+# Lambdaで記録先のテーブルを設定していない場合は、返信せずに呼び出し全体を失敗させます
+def test_lambda_without_table_fails_the_invocation(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import idempotency
+    import lambda_function
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_TABLE_NAME', None)
+    monkeypatch.setattr(lambda_function, 'IDEMPOTENCY_STORE', None)
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', 'line-bot')
+    with pytest.raises(ValueError):
+        send(build_message_event('no-table-0', 'Unotable', 'I like soccer.'))
+    with pytest.raises(ValueError):
+        lambda_function.worker_handler({'Records': []}, None)
+    assert line_recorder.messages == []
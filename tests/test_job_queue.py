@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from fakes import build_message_event
+
+
+def build_sqs_event(jobs):
+    return {'Records': [{'messageId': f"m-{job['job_id']}", 'body': json.dumps(job)} for job in jobs]}
+
+
+def build_job(event_id, user_id, text):
+    return {'job_id': event_id, 'user_id': user_id, 'event': build_message_event(event_id, user_id, text)}
+
+
+# 失敗したジョブと、同じユーザーのそれ以降のジョブはSQSに再配信させます
+def test_worker_reports_failed_jobs(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import lambda_function
+    original = lambda_function.handle_user_message_steps
+
+    def failing_handle_user_message(user_message, *args):
+        if user_message == 'boom':
+            raise RuntimeError('simulated failure')
+        return original(user_message, *args)
+
+    monkeypatch.setattr(lambda_function, 'handle_user_message_steps', failing_handle_user_message)
+    jobs = [
+        build_job('job-1', 'Uworker-a', 'hello'),
+        build_job('job-2', 'Uworker-a', 'boom'),
+        build_job('job-3', 'Uworker-a', 'after the failure'),
+        build_job('job-4', 'Uworker-b', 'hello'),
+    ]
+    response = lambda_function.worker_handler(build_sqs_event(jobs), None)
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'm-job-2'}, {'itemIdentifier': 'm-job-3'}]}
+    assert len(line_recorder.messages) == 2
+
+
+# SQSのバックエンドにはキューのURLが必要です
+def test_sqs_backend_requires_queue_url(monkeypatch):
+    import job_queue
+    monkeypatch.setattr(job_queue, 'JOB_QUEUE_URL', None)
+    with pytest.raises(ValueError):
+        job_queue.create_job_queue('sqs')
@@ -0,0 +1,22 @@
+import json
+
+from fakes import FAKE_ENV, build_message_event
+
+
+def query_logs(user_id):
+    from boto3.dynamodb.conditions import Key
+    from dynamodb_handler import get_dynamodb_resource
+    table = get_dynamodb_resource().Table(FAKE_ENV['LOG_TABLE_NAME'])
+    return table.query(KeyConditionExpression=Key('line_user_id').eq(user_id))['Items']
+
+
+# 同じユーザーの複数のイベントが同じ秒に処理されても、ログが上書きされずにすべて残ります
+def test_same_user_batch_keeps_every_log(dynamodb, fake_openai, line_recorder):
+    import lambda_function
+    events = [build_message_event(f'batch-{index}', 'Ubatch', f'message {index}') for index in range(3)]
+    lambda_function.lambda_handler({'body': json.dumps({'events': events})}, None)
+
+    logs = query_logs('Ubatch')
+    assert len(line_recorder.messages) == 3
+    assert [log['user_message'] for log in logs] == ['message 0', 'message 1', 'message 2']
+    assert len({log['created_at'] for log in logs}) == 3
@@ -0,0 +1,73 @@
+import boto3
+
+
+def create_lecture_table():
+    boto3.client('dynamodb').create_table(
+        TableName='lectures',
+        KeySchema=[{'AttributeName': 'mode_code', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'mode_code', 'AttributeType': 'N'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+# 追加した講義が最大数を超えると、古い講義から削除されます
+def test_dynamodb_store_caps_lectures_on_append(dynamodb):
+    from lecture_pool import DynamoDBLectureStore
+    create_lecture_table()
+    store = DynamoDBLectureStore('lectures')
+    for index in range(5):
+        store.add_lectures(5, [{'id': str(index), 'text': f'lecture {index}'}], pool_max=3)
+    assert [lecture['id'] for lecture in store.get_lectures(5)] == ['2', '3', '4']
+
+
+def test_file_store_caps_lectures_on_append(tmp_path):
+    from lecture_pool import FileLectureStore
+    store = FileLectureStore(str(tmp_path))
+    for index in range(5):
+        store.add_lectures(5, [{'id': str(index), 'text': f'lecture {index}'}], pool_max=3)
+    assert [lecture['id'] for lecture in store.get_lectures(5)] == ['2', '3', '4']
+
+
+class FakeUserState:
+    def __init__(self):
+        self.served = {}
+
+    def get_served_lectures(self, mode_code):
+        return self.served.get(mode_code, [])
+
+    def mark_lecture_served(self, mode_code, lecture_id):
+        self.served[mode_code] = self.get_served_lectures(mode_code) + [lecture_id]
+
+
+# 同じユーザーには同じ講義を2回配らず、受けていない講義がなくなるとNoneを返します
+def test_take_does_not_repeat_lectures_for_a_user(tmp_path):
+    from lecture_pool import FileLectureStore, LecturePool
+    pool = LecturePool(FileLectureStore(str(tmp_path)))
+    pool.store.add_lectures(5, [{'id': str(index), 'text': f'lecture {index}'} for index in range(2)])
+    user_state, other_user_state = FakeUserState(), FakeUserState()
+    assert [pool.take(5, user_state) for _ in range(3)] == ['lecture 0', 'lecture 1', None]
+    assert pool.take(5, other_user_state) == 'lecture 0'
+    # その場で生成して追加した講義は、追加したユーザーには配りません
+    pool.add(5, 'lecture 2', user_state)
+    assert pool.take(5, user_state) is None
+    assert pool.take(5, other_user_state) == 'lecture 1'
+
+
+# 講義を生成している間に追加された講義を上書きせずに、足りない分を補充します
+def test_refill_keeps_lectures_added_while_generating(dynamodb, tmp_path):
+    from lecture_pool import DynamoDBLectureStore, FileLectureStore, refill_lecture_pools
+    from mode_registry import LECTURE_TOPICS
+    create_lecture_table()
+    for store in (DynamoDBLectureStore('lectures'), FileLectureStore(str(tmp_path))):
+        class ConcurrentOpenAIHandler:
+            # 最初の生成の間に、ユーザーへの返信で講義が追加されたものとします
+            def generate_text(self, prompt):
+                if not store.get_lectures(5):
+                    store.add_lectures(5, [{'id': 'served', 'text': 'added by a reply'}])
+                return 'generated'
+
+        refilled = refill_lecture_pools(store, ConcurrentOpenAIHandler(), pool_size=2, pool_max=3)
+        assert refilled == {mode_code: 2 for mode_code in LECTURE_TOPICS}
+        assert [lecture['text'] for lecture in store.get_lectures(5)] == ['added by a reply', 'generated', 'generated']
+        # ストックが足りているテーマには補充しません
+        assert refill_lecture_pools(store, ConcurrentOpenAIHandler(), pool_size=2, pool_max=3)[5] == 0
@@ -0,0 +1,58 @@
+import boto3
+from boto3.dynamodb.types import Binary
+
+from fakes import FAKE_ENV
+from log_codec import FORMAT_VERSION_COMPRESSED, decode_log_item, encode_log_item
+
+LONG_RESPONSE = 'Great! Could you tell me more about it? ' * 50
+
+
+# しきい値以上のテキストだけを圧縮し、復元すると元の項目に戻ります
+def test_round_trip():
+    item = {'line_user_id': 'U', 'created_at': '2024-04-01 12:00:00.000', 'user_message': 'Hi', 'ai_response': LONG_RESPONSE}
+    encoded = encode_log_item(item, threshold=100)
+    assert encoded['user_message'] == 'Hi'
+    assert isinstance(encoded['ai_response'], bytes)
+    assert encoded['format_version'] == FORMAT_VERSION_COMPRESSED
+    assert encoded['compressed_fields'] == ['ai_response']
+    assert decode_log_item(encoded) == item
+    assert decode_log_item(encode_log_item(item, threshold=0)) == item
+
+
+# 形式のバージョンがない古い項目は、テキストはそのまま、Binary型の値は圧縮されたものとして復元します
+def test_rows_without_format_version():
+    plain = {'line_user_id': 'U', 'user_message': 'Hi', 'ai_response': 'Hello!'}
+    assert decode_log_item(plain) == plain
+    encoded = encode_log_item({'ai_response': LONG_RESPONSE}, threshold=100)
+    assert decode_log_item({'ai_response': Binary(encoded['ai_response'])}) == {'ai_response': LONG_RESPONSE}
+
+
+# format_versionとcompressed_fieldsを射影しないGSIから読み込んだログも復元します
+def test_index_without_codec_fields(dynamodb, monkeypatch):
+    import dynamodb_handler
+    import log_codec
+    from dynamodb_handler import DynamoDBHandler
+    monkeypatch.setattr(log_codec, 'LOG_COMPRESS_THRESHOLD', 100)
+    monkeypatch.setattr(dynamodb_handler, 'LOG_SESSION_INDEX_UNAVAILABLE', {'since': None})
+    boto3.client('dynamodb').create_table(
+        TableName='logs_with_narrow_index',
+        KeySchema=[{'AttributeName': 'line_user_id', 'KeyType': 'HASH'}, {'AttributeName': 'created_at', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'line_user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'created_at', 'AttributeType': 'S'},
+            {'AttributeName': 'session_id', 'AttributeType': 'S'},
+        ],
+        GlobalSecondaryIndexes=[{
+            'IndexName': dynamodb_handler.LOG_SESSION_INDEX_NAME,
+            'KeySchema': [{'AttributeName': 'session_id', 'KeyType': 'HASH'}, {'AttributeName': 'created_at', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['user_message', 'ai_response']}
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    handler = DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], 'logs_with_narrow_index')
+    handler.save_log('Unarrow', 'Tell me about soccer.', LONG_RESPONSE, 1, 'session')
+
+    logs = handler.get_recent_logs('Unarrow', 5, 'session')
+    assert isinstance(handler.log_table.scan()['Items'][0]['ai_response'], Binary)
+    assert [(log['user_message'], log['ai_response']) for log in logs] == [('Tell me about soccer.', LONG_RESPONSE)]
+    assert dynamodb_handler.LOG_SESSION_INDEX_UNAVAILABLE['since'] is None
@@ -0,0 +1,81 @@
+import os
+
+import botocore.client
+import pytest
+
+from fakes import FAKE_ENV
+from log_export_throughput import get_created_at, populate, read_exported_keys
+
+
+# ログテーブルへの読み込みの操作を記録し、fail_atを指定した場合はその回数目のScanで失敗します
+@pytest.fixture
+def read_calls(monkeypatch):
+    calls = {'operations': [], 'fail_at': None}
+    original = botocore.client.BaseClient._make_api_call
+
+    def make_api_call(client, operation_name, params):
+        if operation_name in ('Scan', 'Query'):
+            calls['operations'].append(operation_name)
+            if operation_name == 'Scan' and calls['operations'].count('Scan') == calls['fail_at']:
+                raise RuntimeError('simulated interruption')
+        return original(client, operation_name, params)
+
+    monkeypatch.setattr(botocore.client.BaseClient, '_make_api_call', make_api_call)
+    return calls
+
+
+def create_exporter(tmp_path, until, segments=2):
+    from log_export import LogExporter
+    return LogExporter(FAKE_ENV['LOG_TABLE_NAME'], str(tmp_path), os.path.join(tmp_path, '_checkpoint.json'),
+                       segments, until=until)
+
+
+def get_log_table():
+    from dynamodb_handler import get_dynamodb_resource
+    return get_dynamodb_resource().Table(FAKE_ENV['LOG_TABLE_NAME'])
+
+
+# 途中で止まった書き出しはチェックポイントから再開し、行が欠けたり重複したりしません
+def test_interrupted_export_resumes_from_the_checkpoint(dynamodb, read_calls, monkeypatch, tmp_path):
+    import log_export
+    monkeypatch.setattr(log_export, 'EXPORT_PAGE_SIZE', 20)
+    monkeypatch.setattr(log_export, 'EXPORT_CHECKPOINT_PAGES', 2)
+    populate(get_log_table(), 300, 0, seed=0)
+    until = get_created_at(300)[:23]
+    read_calls['fail_at'] = 7
+    with pytest.raises(RuntimeError):
+        create_exporter(tmp_path, until).run()
+    assert 0 < len(read_exported_keys(tmp_path)) < 300
+
+    read_calls['fail_at'] = None
+    create_exporter(tmp_path, until).run()
+    keys = read_exported_keys(tmp_path)
+    assert len(keys) == len(set(keys)) == 300
+
+
+# 完了後の書き出しは日付ごとのGSIをQueryし、テーブルをScanせずに前回より新しいログだけを書き出します
+def test_incremental_export_queries_only_new_logs(dynamodb, read_calls, tmp_path):
+    populate(get_log_table(), 300, 0, seed=0)
+    create_exporter(tmp_path, get_created_at(300)[:23]).run()
+    assert set(read_calls['operations']) == {'Scan'}
+
+    populate(get_log_table(), 200, 300, seed=1)
+    del read_calls['operations'][:]
+    exported, _ = create_exporter(tmp_path, get_created_at(500)[:23]).run()
+    assert exported == 200
+    assert set(read_calls['operations']) == {'Query'}
+    keys = read_exported_keys(tmp_path)
+    assert len(keys) == len(set(keys)) == 500
+
+
+# GSIがない場合や--scanを指定した場合は、完了後の書き出しもScanで読み込みます
+def test_incremental_export_scans_without_the_index(dynamodb, read_calls, monkeypatch, tmp_path):
+    import dynamodb_handler
+    populate(get_log_table(), 100, 0, seed=0)
+    create_exporter(tmp_path, get_created_at(100)[:23]).run()
+    populate(get_log_table(), 50, 100, seed=1)
+    monkeypatch.setattr(dynamodb_handler, 'LOG_DATE_INDEX_NAME', 'missing-index')
+    del read_calls['operations'][:]
+    exported, _ = create_exporter(tmp_path, get_created_at(150)[:23]).run()
+    assert exported == 50
+    assert set(read_calls['operations']) == {'Scan'}
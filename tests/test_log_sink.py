@@ -0,0 +1,68 @@
+import botocore.client
+import pytest
+
+from fakes import FAKE_ENV
+
+
+def build_item(index):
+    return {'line_user_id': 'Usink', 'created_at': f'2024-04-01 12:00:00.{index:03d}#0000', 'session_id': 'S',
+            'user_message': f'message {index}', 'ai_response': 'answer', 'mode_code': 1}
+
+
+def get_saved_messages():
+    from dynamodb_handler import get_dynamodb_resource
+    items = get_dynamodb_resource().Table(FAKE_ENV['LOG_TABLE_NAME']).scan()['Items']
+    return sorted(item['user_message'] for item in items)
+
+
+# failuresの回数だけBatchWriteItemを失敗させます
+@pytest.fixture
+def failing_batch_writes(monkeypatch):
+    failures = {'remaining': 0}
+    original = botocore.client.BaseClient._make_api_call
+
+    def make_api_call(client, operation_name, params):
+        if operation_name == 'BatchWriteItem' and failures['remaining'] > 0:
+            failures['remaining'] -= 1
+            raise RuntimeError('simulated throttling')
+        return original(client, operation_name, params)
+
+    monkeypatch.setattr(botocore.client.BaseClient, '_make_api_call', make_api_call)
+    return failures
+
+
+# 書き込みに失敗したログはバッファに戻り、失敗の後に追加したログと一緒に次の書き込みで保存されます
+def test_failed_flush_is_retried(dynamodb, failing_batch_writes, monkeypatch):
+    import log_sink
+    monkeypatch.setattr(log_sink, 'LOG_FLUSH_SIZE', 100)
+    sink = log_sink.LogSink(FAKE_ENV['LOG_TABLE_NAME'])
+    for index in range(3):
+        sink.add(build_item(index))
+    failing_batch_writes['remaining'] = 1
+    assert sink.flush() == 0
+    assert get_saved_messages() == []
+    # 書き込まれていないログも、会話履歴のために読み込めます
+    assert [item['user_message'] for item in sink.get_pending('Usink', 'S')] == ['message 0', 'message 1', 'message 2']
+
+    sink.add(build_item(3))
+    assert sink.flush() == 4
+    assert get_saved_messages() == ['message 0', 'message 1', 'message 2', 'message 3']
+    assert sink.get_pending('Usink') == []
+    assert sink.flush() == 0
+
+
+# 失敗が続いた場合は、最大件数を超えた古いログから捨てます
+def test_buffer_is_capped_after_repeated_failures(dynamodb, failing_batch_writes, monkeypatch):
+    import log_sink
+    monkeypatch.setattr(log_sink, 'LOG_FLUSH_SIZE', 100)
+    monkeypatch.setattr(log_sink, 'LOG_MAX_BUFFERED', 3)
+    sink = log_sink.LogSink(FAKE_ENV['LOG_TABLE_NAME'])
+    failing_batch_writes['remaining'] = 2
+    for index in range(2):
+        sink.add(build_item(index))
+    sink.flush()
+    for index in range(2, 4):
+        sink.add(build_item(index))
+    sink.flush()
+    assert sink.flush() == 3
+    assert get_saved_messages() == ['message 1', 'message 2', 'message 3']
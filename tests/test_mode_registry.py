@@ -0,0 +1,72 @@
+import hashlib
+
+import pytest
+
+from mode_registry import ACTION_ALTERNATE, ACTION_END, ACTION_ENTER, ACTION_FEEDBACK, get_command, get_quick_reply
+
+# 変更前のline_handler.pyのif/elifで扱っていたメッセージと、その動作、モードコード、プロンプトです
+# プロンプトは、変更前の各行の字下げと空行を除いた本文のSHA-256の先頭16文字です
+LEGACY_COMMANDS = [
+    ('【英文添削:完了】', ACTION_END, 0, None),
+    ('【会話フレーズ講義:完了】', ACTION_END, 0, None),
+    ('【フリートーク:完了】', ACTION_FEEDBACK, 0, 'abc4975405f73b79'),
+    ("I don't know.", ACTION_ALTERNATE, None, '2f7a0901fb05c657'),
+    ('【発表練習:完了】', ACTION_FEEDBACK, 0, '3d12804bde9ffc87'),
+    ('【発表練習:分からない】', ACTION_ALTERNATE, None, '2f7a0901fb05c657'),
+    ('【モード:フリートーク】', ACTION_ENTER, 1, '27d613c7629cbf7d'),
+    ('【モード:英文添削】', ACTION_ENTER, 2, 'd4afbaa98116cc9a'),
+    ('【モード:発表練習】', ACTION_ENTER, 3, '1ed4f80c4bbdedaf'),
+    ('【モード:会話フレーズ講義】', ACTION_ENTER, 4, None),
+    ('【モード:日常生活】', ACTION_ENTER, 5, '59565307ed609c54'),
+    ('【モード:気持ち】', ACTION_ENTER, 6, '2eb9830bdf3048cc'),
+    ('【モード:天気】', ACTION_ENTER, 7, '6f0535269c5e0afd'),
+    ('【モード:観光】', ACTION_ENTER, 8, '0f4917ebaa1a9a0d'),
+    ('【モード:レストラン】', ACTION_ENTER, 9, '14718af92880b502'),
+    ('【モード:ショッピング】', ACTION_ENTER, 10, '9d93beaa06eff667'),
+    ('【モード:学校】', ACTION_ENTER, 11, '5e1f485ced38532f'),
+    ('【モード:スポーツ】', ACTION_ENTER, 12, '4002b500e1421565'),
+    ('【モード:恋愛】', ACTION_ENTER, 13, '02903b073a94044a'),
+    ('【モード:ビジネス】', ACTION_ENTER, 14, '4b35ed4f93ef053d'),
+    ('【モード:電話】', ACTION_ENTER, 15, '026883c425e6817f'),
+    ('【モード:会議】', ACTION_ENTER, 16, '8f0b7acd6d048caf'),
+]
+MENU_BUTTONS = [('フリートーク', '【モード:フリートーク】'), ('英文添削', '【モード:英文添削】'),
+                ('発表練習', '【モード:発表練習】'), ('会話フレーズ講義', '【モード:会話フレーズ講義】')]
+# 変更前のgenerate_quick_reply_itemsが返していた、モードコードごとのボタン（ラベルと送信するテキスト）です
+LEGACY_QUICK_REPLIES = {
+    0: MENU_BUTTONS,
+    1: [('完了', '【フリートーク:完了】'), ('分からない', "I don't know.")],
+    2: [('完了', '【英文添削:完了】')],
+    3: [('完了', '【発表練習:完了】'), ('分からない', "I don't know.")],
+    4: [(topic, f'【モード:{topic}】') for topic in ['日常生活', '気持ち', '天気', '観光', 'レストラン', 'ショッピング',
+                                                   '学校', 'スポーツ', '恋愛', 'ビジネス', '電話', '会議']],
+    **{mode_code: [('完了', '【会話フレーズ講義:完了】')] for mode_code in range(5, 17)},
+    17: MENU_BUTTONS,
+}
+
+
+def fingerprint(prompt):
+    if prompt is None:
+        return None
+    text = '\n'.join(line.strip() for line in prompt.strip().splitlines() if line.strip())
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+# 変更前に扱っていたメッセージは、どれも同じ動作、モードコード、プロンプトのコマンドになります
+@pytest.mark.parametrize('text, action, mode_code, prompt', LEGACY_COMMANDS)
+def test_legacy_messages_map_to_the_same_command(text, action, mode_code, prompt):
+    command = get_command(text)
+    assert (command.action, command.mode_code, fingerprint(command.prompt)) == (action, mode_code, prompt)
+
+
+# どのモードコードでも、変更前と同じクイックリプライを返します
+@pytest.mark.parametrize('mode_code', sorted(LEGACY_QUICK_REPLIES))
+def test_legacy_quick_replies(mode_code):
+    items = get_quick_reply(mode_code).items
+    assert [(item.action.label, item.action.text) for item in items] == LEGACY_QUICK_REPLIES[mode_code]
+
+
+# コマンドでないメッセージはコマンドとして扱いません
+def test_other_messages_are_not_commands():
+    assert get_command('I like soccer.') is None
+    assert get_command('【モード:不明】') is None
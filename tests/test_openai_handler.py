@@ -0,0 +1,222 @@
+import json
+
+import pytest
+import requests
+
+REQUEST = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'Hello'}], 'max_tokens': 10}
+
+
+class FakeResponse:
+    def __init__(self, status_code, content='Hi!'):
+        self.status_code = status_code
+        self.retry_count = 0
+        self.text = json.dumps({'model': 'fake', 'choices': [{'message': {'content': content}}]})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def start_fallback_steps():
+    from mode_registry import QUALITY_PROFILE
+    from openai_handler import OpenAIHandler
+    steps = OpenAIHandler('dummy', None).post_with_fallback_steps(dict(REQUEST), QUALITY_PROFILE)
+    return steps, next(steps)
+
+
+# 5xxの応答の後は、最初の送信と同じ期限で代わりのモデルに送信します
+def test_server_errors_fall_back_within_the_same_deadline():
+    from mode_registry import QUALITY_PROFILE
+    steps, first = start_fallback_steps()
+    second = steps.send(FakeResponse(503))
+    assert first.json['model'] == 'gpt-4'
+    assert second.json['model'] == QUALITY_PROFILE.fallback_model
+    assert second.deadline == first.deadline
+    with pytest.raises(StopIteration) as stopped:
+        steps.send(FakeResponse(200))
+    assert stopped.value.value['choices'][0]['message']['content'] == 'Hi!'
+
+
+# 通信エラーの後も代わりのモデルに送信します
+def test_connection_errors_fall_back():
+    from mode_registry import QUALITY_PROFILE
+    steps, _ = start_fallback_steps()
+    assert steps.throw(requests.ConnectionError('refused')).json['model'] == QUALITY_PROFILE.fallback_model
+
+
+# 4xxの応答と全体のタイムアウトでは代わりのモデルを使わずに例外を送出します
+def test_client_errors_and_timeouts_do_not_fall_back():
+    from openai_handler import OpenAIError
+    for status_code in (400, 429):
+        steps, _ = start_fallback_steps()
+        with pytest.raises(OpenAIError) as raised:
+            steps.send(FakeResponse(status_code))
+        assert raised.value.status_code == status_code
+    steps, _ = start_fallback_steps()
+    with pytest.raises(requests.Timeout):
+        steps.throw(requests.Timeout('Exceeded the total timeout'))
+
+
+# 期限を使い切った後は、5xxの応答でも代わりのモデルに送信しません
+def test_no_fallback_after_the_deadline(monkeypatch):
+    import openai_handler
+    from openai_handler import OpenAIError
+    monkeypatch.setattr(openai_handler.HTTP_CLIENT, 'total_timeout', 0)
+    steps, _ = start_fallback_steps()
+    with pytest.raises(OpenAIError):
+        steps.send(FakeResponse(500))
+
+
+# 400の応答はOpenAIに1回だけ送信し、加算した利用回数を戻します
+def test_bad_request_is_sent_once_and_refunded(dynamodb, fake_openai):
+    from dynamodb_handler import DynamoDBHandler
+    from fakes import FAKE_ENV
+    from openai_handler import OpenAIError, OpenAIHandler
+    dynamodb_handler = DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+    requests_before = fake_openai.request_count
+    fake_openai.inject('400')
+    with pytest.raises(OpenAIError):
+        OpenAIHandler('dummy', dynamodb_handler).get_ai_response('Hello', 'Ubad', [], 1)
+    assert fake_openai.request_count == requests_before + 1
+    assert int(dynamodb_handler.get_user('Ubad')['api_count_total']) == 0
+
+
+# data行のJSONだけを順に取り出し、[DONE]で終わります
+def test_parse_sse_lines():
+    from openai_handler import parse_sse_lines
+    lines = [': keep-alive', '', 'event: message', 'data: {"choices": [{"delta": {"content": "Hi"}}]}', '',
+             'data: {"choices": [], "usage": {"completion_tokens": 1}}', 'data: [DONE]', 'data: {"ignored": true}']
+    assert list(parse_sse_lines(lines)) == [{'choices': [{'delta': {'content': 'Hi'}}]},
+                                            {'choices': [], 'usage': {'completion_tokens': 1}}]
+
+
+# 一定の長さがたまるたびに最後の文の区切りで分け、連結すると全文になります
+def test_split_at_boundaries():
+    from openai_handler import split_at_boundaries
+    texts = ['Hello there. ', 'How are', ' you? I am', ' fine', '. Thanks']
+    chunks = list(split_at_boundaries(texts, min_chars=10))
+    assert chunks == ['Hello there. ', 'How are you? ', 'I am fine. ', 'Thanks']
+    assert ''.join(chunks) == ''.join(texts)
+    assert list(split_at_boundaries(['no boundary here'], min_chars=5)) == ['no boundary here']
+
+
+def send_streaming_message(monkeypatch, event_id, user_id):
+    import lambda_function
+    import line_handler
+    import openai_handler
+    from fakes import build_message_event
+    monkeypatch.setattr(line_handler, 'OPENAI_STREAMING', True)
+    monkeypatch.setattr(openai_handler, 'STREAM_MIN_CHUNK_CHARS', 20)
+    event = build_message_event(event_id, user_id, 'I like soccer.')
+    lambda_function.lambda_handler({'body': json.dumps({'events': [event]})}, None)
+
+
+# 最初のテキストはリプライで、以降はプッシュメッセージで順に送信し、全文をログに保存します
+# メトリクスは通常の呼び出しと同じ項目に、最初のテキストを受信するまでの時間を加えて出力します
+def test_stream_replies_then_pushes_in_order(dynamodb, fake_openai, line_recorder, monkeypatch, capsys):
+    from dynamodb_handler import get_dynamodb_resource
+    from fakes import FAKE_ANSWER, FAKE_ENV
+    send_streaming_message(monkeypatch, 'stream-0', 'Ustream')
+    kinds = [kind for kind, _, _ in line_recorder.messages]
+    assert len(kinds) > 1
+    assert kinds == ['reply'] + ['push'] * (len(kinds) - 1)
+    assert ' '.join(message.text for _, _, message in line_recorder.messages) == FAKE_ANSWER
+    log = get_dynamodb_resource().Table(FAKE_ENV['LOG_TABLE_NAME']).scan()['Items'][0]
+    assert log['ai_response'] == FAKE_ANSWER
+    metrics = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"openai_call"' in line]
+    assert metrics[-1]['stream'] is True
+    assert metrics[-1]['completion_tokens'] > 0
+    assert metrics[-1]['latency_ms'] >= metrics[-1]['first_chunk_ms'] > 0
+
+
+# ストリーミングの途中で失敗した場合は、加算した利用回数を戻します
+def test_stream_failure_refunds_usage(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import openai_handler
+    from dynamodb_handler import DynamoDBHandler
+    from fakes import FAKE_ENV
+    original = openai_handler.parse_sse_lines
+
+    def broken_parse_sse_lines(lines):
+        events = original(lines)
+        yield next(events)
+        raise requests.exceptions.ChunkedEncodingError('connection broken')
+
+    monkeypatch.setattr(openai_handler, 'parse_sse_lines', broken_parse_sse_lines)
+    send_streaming_message(monkeypatch, 'stream-1', 'Ubroken')
+    item = DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME']).get_user('Ubroken')
+    assert int(item['api_count_total']) == 0
+
+
+class StreamResponse:
+    retry_count = 0
+
+    def __init__(self, status_code, lines=()):
+        self.status_code = status_code
+        self.lines = lines
+        self.text = '{"error": {"message": "injected"}}'
+        self.closed = False
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(self.lines)
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# ストリーミングのリクエストを記録し、モデルごとに決めた応答を返すHTTPクライアントの代わりを設定します
+def fake_stream_post(monkeypatch, responses):
+    import openai_handler
+    posted = []
+
+    def post(url, headers=None, json=None, stream=False, deadline=None):
+        posted.append((json['model'], deadline))
+        return responses[json['model']]
+
+    monkeypatch.setattr(openai_handler.HTTP_CLIENT, 'post', post)
+    return posted
+
+
+def create_stream_handler(monkeypatch, refunds):
+    from openai_handler import OpenAIHandler
+    handler = OpenAIHandler('dummy', None)
+    monkeypatch.setattr(handler, 'add_usage', lambda user_id, mode_code, user_state: None)
+    monkeypatch.setattr(handler, 'refund_usage', lambda user_id, user_state: refunds.append(user_id))
+    return handler
+
+
+# 200以外の応答はコネクションを戻せるように閉じてから例外を送出し、4xxでは代わりのモデルを使いません
+def test_stream_error_response_is_closed(monkeypatch):
+    from openai_handler import OpenAIError
+    from steps import run_steps
+    error_response = StreamResponse(400)
+    posted = fake_stream_post(monkeypatch, {'gpt-4': error_response})
+    refunds = []
+    with pytest.raises(OpenAIError):
+        run_steps(create_stream_handler(monkeypatch, refunds).stream_ai_response_steps('Hello', 'U', [], 1, list))
+    assert [model for model, _ in posted] == ['gpt-4']
+    assert error_response.closed
+    assert refunds == ['U']
+
+
+# 5xxの応答では、通常の呼び出しと同じく同じ期限で代わりのモデルに送信します
+def test_stream_falls_back_on_server_errors(monkeypatch, capsys):
+    from mode_registry import QUALITY_PROFILE
+    from steps import run_steps
+    fallback_model = QUALITY_PROFILE.fallback_model
+    lines = ['data: ' + json.dumps({'model': fallback_model, 'choices': [{'delta': {'content': 'Hi!'}}]}), 'data: [DONE]']
+    error_response = StreamResponse(503)
+    posted = fake_stream_post(monkeypatch, {'gpt-4': error_response, fallback_model: StreamResponse(200, lines)})
+    refunds = []
+    chunks = run_steps(create_stream_handler(monkeypatch, refunds).stream_ai_response_steps('Hello', 'U', [], 1, list))
+    assert chunks == ['Hi!']
+    assert [model for model, _ in posted] == ['gpt-4', fallback_model]
+    assert posted[0][1] == posted[1][1]
+    assert error_response.closed
+    assert refunds == []
+    metrics = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"openai_call"' in line]
+    assert metrics[-1]['model'] == fallback_model
@@ -0,0 +1,70 @@
+import json
+
+from fakes import FAKE_ANSWER, FAKE_ENV, build_message_event
+
+
+def send(user_id, event_id, text):
+    import lambda_function
+    event = build_message_event(event_id, user_id, text)
+    lambda_function.lambda_handler({'body': json.dumps({'events': [event]})}, None)
+
+
+def create_dynamodb_handler():
+    from dynamodb_handler import DynamoDBHandler
+    return DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+
+
+# 前後の文章やJSONでない応答を許容し、質問のある項目だけを最大数まで取り出します
+def test_parse_plan():
+    from presentation_practice import PRESENTATION_QUESTION_COUNT, parse_plan
+    questions = [{'question': ' Why? ', 'alternate': 'How?'}, {'question': 'What?'}, {'alternate': 'only'}, 'text']
+    text = 'Here are the questions:\n' + json.dumps({'questions': questions}) + '\nGood luck!'
+    assert parse_plan(text) == [{'question': 'Why?', 'alternate': 'How?'}, {'question': 'What?', 'alternate': ''}]
+    many = json.dumps({'questions': [{'question': f'Q{index}'} for index in range(PRESENTATION_QUESTION_COUNT + 2)]})
+    assert len(parse_plan(many)) == PRESENTATION_QUESTION_COUNT
+    assert parse_plan('no questions') == []
+    assert parse_plan('{broken json}') == []
+
+
+# 生成済みの質問を順に返信し、「分からない」には生成済みの代わりの質問を返します
+# 回答の評価は返信の後のジョブで行い、評価のメモをフィードバックのプロンプトに加えます
+def test_questions_advance_and_answers_are_evaluated(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import lambda_function
+    from presentation_practice import PRESENTATION_DONE_MESSAGE, PresentationPractice
+    from user_state import UserState
+    monkeypatch.setattr(lambda_function, 'FOLLOW_UP_JOBS', 'thread')
+    send('Upresent', 'Upresent-0', '【モード:発表練習】')
+    send('Upresent', 'Upresent-1', 'I studied machine learning at university.')
+    assert line_recorder.messages[-1][2].text == 'Q1:What made you choose this topic (1)?'
+
+    send('Upresent', 'Upresent-2', 'Because it is useful.')
+    assert line_recorder.messages[-1][2].text == 'Q2:What made you choose this topic (2)?'
+    send('Upresent', 'Upresent-3', '【発表練習:分からない】')
+    assert line_recorder.messages[-1][2].text == 'Q2:What was the hardest part (2)?'
+    send('Upresent', 'Upresent-4', 'It was the math.')
+    send('Upresent', 'Upresent-5', 'I want to be an engineer.')
+    assert line_recorder.messages[-1][2].text == PRESENTATION_DONE_MESSAGE
+    lambda_function.wait_for_follow_up_jobs()
+
+    user_state = UserState(create_dynamodb_handler(), 'Upresent')
+    assert sorted(user_state.get_session_value('presentation_notes')) == [
+        f'What made you choose this topic (1)?: {FAKE_ANSWER}',
+        f'What made you choose this topic (3)?: {FAKE_ANSWER}',
+        f'What was the hardest part (2)?: {FAKE_ANSWER}',
+    ]
+    prompt = PresentationPractice(None, None).build_feedback_prompt('Feedback', user_state)
+    assert prompt.startswith('Feedback\n\n#各回答の評価メモ\n')
+    assert f'What was the hardest part (2)?: {FAKE_ANSWER}' in prompt
+
+
+# セッションが変わった後に完了した評価は、新しいセッションのメモに追加しません
+def test_evaluation_from_an_old_session_is_dropped(dynamodb, fake_openai, line_recorder):
+    from openai_handler import OpenAIHandler
+    from presentation_practice import PresentationPractice
+    dynamodb_handler = create_dynamodb_handler()
+    dynamodb_handler.update_user_attributes('Uold', {'session_id': 'new', 'presentation_notes': []})
+    practice = PresentationPractice(dynamodb_handler, OpenAIHandler('dummy', dynamodb_handler))
+    practice.evaluate_answer(practice.plan_evaluation('Uold', 'old', 'Why?', 'Because.'))
+    assert dynamodb_handler.get_user('Uold')['presentation_notes'] == []
+    practice.evaluate_answer(practice.plan_evaluation('Uold', 'new', 'Why?', 'Because.'))
+    assert dynamodb_handler.get_user('Uold')['presentation_notes'] == [f'Why?: {FAKE_ANSWER}']
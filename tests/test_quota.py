@@ -0,0 +1,117 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from botocore.exceptions import ClientError
+
+from fakes import FAKE_ENV
+
+
+def create_handler():
+    from dynamodb_handler import DynamoDBHandler
+    return DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME'])
+
+
+def get_user_item(user_id):
+    from dynamodb_handler import get_dynamodb_resource
+    return get_dynamodb_resource().Table(FAKE_ENV['USER_TABLE_NAME']).get_item(Key={'line_user_id': user_id})['Item']
+
+
+# 多数のスレッドが同時に加算しても、1日の上限を超えて受け付けません
+@pytest.mark.parametrize('initial_count', [None, 0, 3])
+def test_parallel_usage_is_never_over_admitted(dynamodb, initial_count):
+    from dynamodb_handler import DAILY_API_LIMIT, UsageContention, UsageLimitExceeded, get_dynamodb_resource, get_usage_date
+    user_id = f'Uquota-{initial_count}'
+    if initial_count is not None:
+        get_dynamodb_resource().Table(FAKE_ENV['USER_TABLE_NAME']).put_item(
+            Item={'line_user_id': user_id, 'api_count_total': initial_count, 'last_used_date': get_usage_date()})
+    results = []
+    results_lock = threading.Lock()
+    start = threading.Barrier(32)
+
+    # boto3のリソースはスレッドごとに作成されるため、ハンドラもスレッドごとに作成します
+    def hammer(_):
+        handler = create_handler()
+        start.wait()
+        # 競合で受け付けられなかった呼び出しは、ユーザーが送り直した場合と同じくやり直します
+        attempts = 3
+        while attempts:
+            try:
+                handler.update_user_usage(user_id, 1, 1)
+                outcome = 'admitted'
+            except UsageLimitExceeded:
+                outcome = 'limited'
+            except UsageContention:
+                outcome = 'contention'
+            if outcome != 'contention':
+                attempts -= 1
+            with results_lock:
+                results.append(outcome)
+
+    with ThreadPoolExecutor(32) as executor:
+        list(executor.map(hammer, range(32)))
+
+    admitted = results.count('admitted')
+    assert admitted == DAILY_API_LIMIT - (initial_count or 0)
+    assert int(get_user_item(user_id)['api_count_total']) == DAILY_API_LIMIT
+
+
+# 前日の利用回数は午前4時の区切りで数え直します
+def test_usage_resets_on_a_new_usage_date(dynamodb):
+    from dynamodb_handler import DAILY_API_LIMIT, get_dynamodb_resource
+    get_dynamodb_resource().Table(FAKE_ENV['USER_TABLE_NAME']).put_item(
+        Item={'line_user_id': 'Ureset', 'api_count_total': DAILY_API_LIMIT, 'last_used_date': '2000-01-01'})
+    item = create_handler().update_user_usage('Ureset', 1, 2)
+    assert int(item['api_count_total']) == 1
+    assert int(item['mode_code']) == 2
+
+
+# 上限に達した後の加算は、DynamoDBの値を変えずにUsageLimitExceededを送出します
+def test_usage_limit_raises_typed_exception(dynamodb):
+    from dynamodb_handler import DAILY_API_LIMIT, USAGE_LIMIT_MESSAGE, UsageLimitExceeded
+    handler = create_handler()
+    for _ in range(DAILY_API_LIMIT):
+        handler.update_user_usage('Ulimit', 1, 1)
+    with pytest.raises(UsageLimitExceeded, match=USAGE_LIMIT_MESSAGE):
+        handler.update_user_usage('Ulimit', 1, 1)
+    assert int(get_user_item('Ulimit')['api_count_total']) == DAILY_API_LIMIT
+
+
+# 競合で書き込めなかった場合は、上限ではなくUsageContentionとして報告します
+def test_lost_races_raise_contention_not_limit(dynamodb, monkeypatch):
+    from dynamodb_handler import UsageContention
+    handler = create_handler()
+    error = ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'lost the race'}}, 'UpdateItem')
+
+    def always_conflicting_update_item(**kwargs):
+        raise error
+
+    monkeypatch.setattr(handler.user_table, 'update_item', always_conflicting_update_item, raising=False)
+    with pytest.raises(UsageContention):
+        handler.update_user_usage('Ucontention', 1, 1)
+
+
+# 上限に達したユーザーにはOpenAIを呼ばずに上限のメッセージを、混雑で受け付けられなかった場合は
+# 利用回数を戻して混雑のメッセージを、返信の層で返信します
+def test_refusals_are_mapped_to_messages_when_replying(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import json
+    import lambda_function
+    from dynamodb_handler import DAILY_API_LIMIT, USAGE_LIMIT_MESSAGE, get_dynamodb_resource, get_usage_date
+    from fakes import build_message_event
+    from openai_handler import OpenAIHandler
+    from rate_limiter import RATE_LIMITED_MESSAGE, RateLimited
+    get_dynamodb_resource().Table(FAKE_ENV['USER_TABLE_NAME']).put_item(
+        Item={'line_user_id': 'Uover', 'api_count_total': DAILY_API_LIMIT, 'last_used_date': get_usage_date(), 'mode_code': 1})
+    requests_before = fake_openai.request_count
+    lambda_function.lambda_handler({'body': json.dumps({'events': [build_message_event('over-0', 'Uover', 'Hello.')]})}, None)
+    assert fake_openai.request_count == requests_before
+    assert line_recorder.messages[-1][2].text == USAGE_LIMIT_MESSAGE
+
+    def rate_limited_admit_steps(self, data):
+        raise RateLimited(RATE_LIMITED_MESSAGE)
+        yield
+
+    monkeypatch.setattr(OpenAIHandler, 'admit_steps', rate_limited_admit_steps)
+    lambda_function.lambda_handler({'body': json.dumps({'events': [build_message_event('busy-0', 'Ubusy', 'Hello.')]})}, None)
+    assert line_recorder.messages[-1][2].text == RATE_LIMITED_MESSAGE
+    assert int(get_user_item('Ubusy')['api_count_total']) == 0
@@ -0,0 +1,61 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pytest
+from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+
+
+def create_limiter_table():
+    boto3.client('dynamodb').create_table(
+        TableName='rate_limits',
+        KeySchema=[{'AttributeName': 'limiter_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'limiter_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+# 他のインスタンスとの競合が続く場合は、待ち時間の上限で打ち切ります
+def test_conflicts_stop_at_the_deadline(dynamodb, monkeypatch):
+    from rate_limiter import DynamoDBRateLimiter, RateLimited
+    create_limiter_table()
+    original_make_api_call = BaseClient._make_api_call
+    attempts = []
+
+    def conflicting_call(client, operation_name, api_params):
+        if operation_name == 'PutItem' and api_params.get('TableName') == 'rate_limits':
+            attempts.append(time.monotonic())
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'conflict'}}, operation_name)
+        return original_make_api_call(client, operation_name, api_params)
+
+    monkeypatch.setattr(BaseClient, '_make_api_call', conflicting_call)
+    limiter = DynamoDBRateLimiter('rate_limits', 'openai', 1000, 100000, max_wait_seconds=0.5)
+    started_at = time.monotonic()
+    with pytest.raises(RateLimited):
+        limiter.admit(10)
+    assert time.monotonic() - started_at < 1.0
+    assert len(attempts) < 50
+
+
+# 多数のスレッドが同時に取得しても、取得できた分だけバケットが減ります
+def test_parallel_acquire_consumes_each_request_once(dynamodb):
+    from rate_limiter import DynamoDBRateLimiter
+    create_limiter_table()
+    limiter = DynamoDBRateLimiter('rate_limits', 'openai', 1000, 100000, max_wait_seconds=5)
+    start = threading.Barrier(8)
+
+    def acquire(_):
+        start.wait()
+        for _ in range(5):
+            limiter.admit(10)
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(acquire, range(8)))
+    refilled = (time.monotonic() - started_at) * 1000 / 60
+    from dynamodb_handler import get_dynamodb_resource
+    item = get_dynamodb_resource().Table('rate_limits').get_item(Key={'limiter_id': 'openai'})['Item']
+    # 実行中に補充された分を許容して、40回分が引かれていることを確かめます
+    assert 1000 - 40 <= float(item['request_tokens']) <= 1000 - 40 + refilled
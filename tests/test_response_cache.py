@@ -0,0 +1,94 @@
+import json
+import time
+
+import boto3
+
+from fakes import build_message_event
+from response_cache import build_cache_key
+
+CONTEXT = [{'role': 'system', 'content': 'system'}]
+
+
+def key(prompt, context=CONTEXT):
+    return build_cache_key('gpt-4', prompt, context, 3)
+
+
+# 全角半角と空白の違いは同じキーにし、大文字小文字の違いは別のキーにします
+def test_cache_key_keeps_case_but_folds_width_and_spaces():
+    assert key('i  like  soccer.') == key('ｉ like soccer． ')
+    assert key('i like soccer.') != key('I like soccer.')
+
+
+# 送信する文脈が異なる場合は別のキーにします
+def test_cache_key_includes_the_context():
+    history = CONTEXT + [{'role': 'assistant', 'content': 'Send me a sentence.'}]
+    assert key('I has a pen.') != key('I has a pen.', history)
+
+
+def create_cache_table():
+    boto3.client('dynamodb').create_table(
+        TableName='response_cache',
+        KeySchema=[{'AttributeName': 'cache_key', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'cache_key', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+# 保存した応答はメモリから、別の実行環境ではDynamoDBから返し、DynamoDBから返した応答はメモリにも保存します
+def test_two_tier_hits_and_misses(dynamodb):
+    from response_cache import RESPONSE_CACHE_STATS, ResponseCache
+    create_cache_table()
+    stats_before = dict(RESPONSE_CACHE_STATS)
+    cache = ResponseCache('response_cache')
+    assert cache.get(key('I has a pen.')) is None
+    cache.set(key('I has a pen.'), 'I have a pen.', 1200.0)
+    assert cache.get(key('I has a pen.')) == ('I have a pen.', 1200.0)
+
+    other = ResponseCache('response_cache')
+    assert other.get(key('I has a pen.')) == ('I have a pen.', 1200.0)
+    assert other.memory.get(key('I has a pen.')) is not None
+    assert other.get(key('She go to school.')) is None
+    for name, count in (('miss', 2), ('hit_memory', 1), ('hit_dynamodb', 1)):
+        assert RESPONSE_CACHE_STATS[name] == stats_before.get(name, 0) + count
+
+
+# メモリの有効期限が切れた応答はDynamoDBから、DynamoDBの有効期限が切れた応答はTTLの削除を待たずにミスとします
+def test_expired_entries_are_not_returned(dynamodb, monkeypatch):
+    import ttl_cache
+    from response_cache import ResponseCache
+    create_cache_table()
+    cache = ResponseCache('response_cache')
+    cache.set(key('I has a pen.'), 'I have a pen.', 1200.0)
+    now = time.monotonic()
+    monkeypatch.setattr(ttl_cache.time, 'monotonic', lambda: now + cache.memory.ttl_seconds + 1)
+    assert cache.memory.get(key('I has a pen.')) is None
+    assert cache.get(key('I has a pen.')) == ('I have a pen.', 1200.0)
+    monkeypatch.undo()
+
+    cache.memory.delete(key('I has a pen.'))
+    cache.get_table().update_item(Key={'cache_key': key('I has a pen.')}, UpdateExpression='SET expires_at = :past',
+                                  ExpressionAttributeValues={':past': int(time.time()) - 1})
+    assert cache.get(key('I has a pen.')) is None
+
+
+def send(user_id, event_id, text):
+    import lambda_function
+    lambda_function.lambda_handler({'body': json.dumps({'events': [build_message_event(event_id, user_id, text)]})}, None)
+
+
+# 英文添削では会話履歴が異なるユーザーの間でも同じ英文の応答を共有し、会話履歴を読み込みません
+def test_cached_mode_shares_replies_across_histories(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import line_handler
+    from response_cache import ResponseCache
+    monkeypatch.setattr(line_handler, 'RESPONSE_CACHE', ResponseCache(None))
+    built = []
+    monkeypatch.setattr(line_handler.HistoryBuilder, 'build', lambda self, user_id, user_state: built.append(user_id) or [])
+    send('Ucache-a', 'Ucache-a-0', '【モード:英文添削】')
+    send('Ucache-a', 'Ucache-a-1', 'We was happy.')
+    send('Ucache-b', 'Ucache-b-0', '【モード:英文添削】')
+    requests_before = fake_openai.request_count
+    send('Ucache-a', 'Ucache-a-2', 'I has a pen.')
+    send('Ucache-b', 'Ucache-b-1', 'I  has a pen.')
+    assert fake_openai.request_count == requests_before + 1
+    assert line_recorder.messages[-1][2].text == line_recorder.messages[-2][2].text
+    assert built == []
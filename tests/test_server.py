@@ -0,0 +1,123 @@
+import asyncio
+import json
+import multiprocessing
+import queue
+
+from fakes import build_message_event
+
+
+async def post_webhooks(app, bodies):
+    import aiohttp
+    from aiohttp import web
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    statuses = []
+    async with aiohttp.ClientSession() as session:
+        for body in bodies:
+            async with session.post(f'http://127.0.0.1:{port}/callback', data=json.dumps(body)) as response:
+                statuses.append(response.status)
+    await runner.cleanup()
+    return statuses
+
+
+# 同じユーザーのイベントは、別々のWebhookで届いても同じワーカーに受信順で渡します
+def test_dispatcher_routes_each_user_to_one_worker():
+    import server
+    queues = [queue.Queue() for _ in range(4)]
+    pending_counts = [multiprocessing.Value('i', 0) for _ in range(4)]
+    bodies = [{'events': [build_message_event(f'e{index}-{user}', f'U{user}', f'message {index}') for user in range(8)]}
+              for index in range(3)]
+    statuses = asyncio.run(post_webhooks(server.WebhookDispatcher(queues, pending_counts).create_app(), bodies))
+
+    assert statuses == [200, 200, 200]
+    for user in range(8):
+        index = server.get_worker_index(f'U{user}', 4)
+        received = [user_events[0]['message']['text'] for user_id, user_events in queues[index].queue if user_id == f'U{user}']
+        assert received == ['message 0', 'message 1', 'message 2']
+    assert sum(count.value for count in pending_counts) == 24
+
+
+# ワーカーの処理待ちが上限に達した場合は503を返し、LINEに再送させます
+def test_dispatcher_rejects_when_the_worker_is_busy():
+    import server
+    queues = [queue.Queue()]
+    pending_counts = [multiprocessing.Value('i', 0)]
+    body = {'events': [build_message_event('busy', 'Ubusy', 'hello')]}
+    statuses = asyncio.run(post_webhooks(server.WebhookDispatcher(queues, pending_counts, max_pending=1).create_app(), [body, body]))
+    assert statuses == [200, 503]
+
+
+# OpenAIの応答はイベントループで待つため、スレッド数より多くの会話が同時に応答を待てます
+def test_conversations_wait_for_openai_without_holding_threads(dynamodb, line_recorder, monkeypatch):
+    import openai_handler
+    import server
+    from async_http_client import AsyncRetryingHttpClient
+    from fakes import FakeOpenAIServer
+    fake = FakeOpenAIServer(latency=0.5).start()
+    monkeypatch.setattr(openai_handler, 'OPENAI_API_URL', fake.url)
+    waits = {'current': 0, 'peak': 0}
+    original_post = AsyncRetryingHttpClient.post
+
+    async def counting_post(client, *args, **kwargs):
+        waits['current'] += 1
+        waits['peak'] = max(waits['peak'], waits['current'])
+        try:
+            return await original_post(client, *args, **kwargs)
+        finally:
+            waits['current'] -= 1
+
+    monkeypatch.setattr(AsyncRetryingHttpClient, 'post', counting_post)
+    events = queue.Queue()
+    pending_count = multiprocessing.Value('i', 20)
+    for index in range(20):
+        events.put((f'Ulane-{index}', [build_message_event(f'lane-{index}', f'Ulane-{index}', 'I like soccer.')]))
+    events.put(None)
+    try:
+        asyncio.run(server.serve_queue(server.WebhookServer(worker_threads=2), events, pending_count))
+    finally:
+        fake.stop()
+
+    assert len(line_recorder.messages) == 20
+    assert pending_count.value == 0
+    assert waits['peak'] > 2
+
+
+# 終了時のフィードバックのための会話の分析に時間がかかっても、同じスレッドで処理する他のユーザーへの返信を待たせません
+def test_slow_feedback_does_not_delay_other_users_on_the_lane(dynamodb, line_recorder, monkeypatch):
+    import time
+    import openai_handler
+    import server
+    from dynamodb_handler import get_dynamodb_resource
+    from fakes import FAKE_ENV, FakeOpenAIServer
+    fake = FakeOpenAIServer(latency=0.0, slow_prompts={'#以下の英会話の一部について': 1.5}).start()
+    monkeypatch.setattr(openai_handler, 'OPENAI_API_URL', fake.url)
+    get_dynamodb_resource().Table(FAKE_ENV['USER_TABLE_NAME']).put_item(
+        Item={'line_user_id': 'Uslow', 'mode_code': 1, 'session_id': 'slow-session'})
+    for index in range(2):
+        get_dynamodb_resource().Table(FAKE_ENV['LOG_TABLE_NAME']).put_item(Item={
+            'line_user_id': 'Uslow', 'created_at': f'2024-04-01 12:00:0{index}.000#00000000', 'session_id': 'slow-session',
+            'user_message': 'I like soccer.', 'ai_response': 'Why do you like it?', 'mode_code': 1})
+    replied_at = {}
+    original_record = line_recorder.record
+
+    def record(kind, target, messages):
+        replied_at[target] = time.monotonic()
+        original_record(kind, target, messages)
+
+    monkeypatch.setattr(line_recorder, 'record', record)
+    events = queue.Queue()
+    pending_count = multiprocessing.Value('i', 2)
+    events.put(('Uslow', [build_message_event('slow', 'Uslow', '【フリートーク:完了】')]))
+    events.put(('Ufast', [build_message_event('fast', 'Ufast', 'I like soccer.')]))
+    events.put(None)
+    started_at = time.monotonic()
+    try:
+        asyncio.run(server.serve_queue(server.WebhookServer(worker_threads=1), events, pending_count))
+    finally:
+        fake.stop()
+
+    assert replied_at['reply-fast'] - started_at < 1.0
+    assert replied_at['reply-slow'] - started_at >= 1.5
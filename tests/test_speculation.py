@@ -0,0 +1,76 @@
+import json
+
+from fakes import FAKE_ENV, build_message_event
+
+
+def send(user_id, event_id, text):
+    import lambda_function
+    event = build_message_event(event_id, user_id, text)
+    lambda_function.lambda_handler({'body': json.dumps({'events': [event]})}, None)
+
+
+def get_user(user_id):
+    from dynamodb_handler import DynamoDBHandler
+    return DynamoDBHandler(FAKE_ENV['USER_TABLE_NAME'], FAKE_ENV['LOG_TABLE_NAME']).get_user(user_id)
+
+
+# フリートークで質問を受け取るまで進め、先読みのジョブの完了を待ちます
+def start_free_talk(user_id, monkeypatch):
+    import lambda_function
+    import line_handler
+    import speculation
+    monkeypatch.setattr(line_handler, 'SPECULATIVE_ALTERNATES', True)
+    monkeypatch.setattr(lambda_function, 'FOLLOW_UP_JOBS', 'thread')
+    monkeypatch.setattr(speculation, 'SPECULATION_BUDGET', {'window_started_at': 0.0, 'tokens': 0})
+    send(user_id, f'{user_id}-0', '【モード:フリートーク】')
+    send(user_id, f'{user_id}-1', 'I like soccer.')
+    lambda_function.wait_for_follow_up_jobs()
+
+
+# 先読みした質問はOpenAIを呼ばずに返信し、その場で生成した場合と同じく利用回数に数えます
+def test_speculation_hit_is_served_and_charged(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import speculation
+    start_free_talk('Uhit', monkeypatch)
+    speculated = get_user('Uhit')['speculative_alternate']
+    api_count = int(get_user('Uhit')['api_count_total'])
+    requests_before = fake_openai.request_count
+    hits_before = speculation.SPECULATION_STATS['hit']
+
+    send('Uhit', 'Uhit-2', "I don't know.")
+    assert fake_openai.request_count == requests_before
+    assert speculation.SPECULATION_STATS['hit'] == hits_before + 1
+    assert line_recorder.messages[-1][2].text == speculated['text']
+    item = get_user('Uhit')
+    assert int(item['api_count_total']) == api_count + 1
+    assert item['speculative_alternate'] is None
+
+
+# 先読みがない場合は、その場で別の質問を生成します
+def test_speculation_miss_generates_on_demand(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import lambda_function
+    import speculation
+    start_free_talk('Umiss', monkeypatch)
+    monkeypatch.setattr(lambda_function, 'FOLLOW_UP_JOBS', 'off')
+    # 質問に回答すると先読みは不要になり、回答への返信の後の先読みは行われません
+    send('Umiss', 'Umiss-2', 'I play it every weekend.')
+    assert get_user('Umiss')['speculative_alternate'] is None
+    requests_before = fake_openai.request_count
+    misses_before = speculation.SPECULATION_STATS['miss']
+
+    send('Umiss', 'Umiss-3', "I don't know.")
+    assert fake_openai.request_count == requests_before + 1
+    assert speculation.SPECULATION_STATS['miss'] == misses_before + 1
+
+
+# 予算を超える先読みはOpenAIを呼ばずに取りやめます
+def test_speculation_over_budget_is_skipped(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import speculation
+    monkeypatch.setattr(speculation, 'SPECULATION_TOKEN_BUDGET', 10)
+    skipped_before = speculation.SPECULATION_STATS['skipped']
+    requests_before = fake_openai.request_count
+
+    start_free_talk('Ubudget', monkeypatch)
+    # 開始時のメッセージはOpenAIを呼ばないため、回答への返信の1回だけです
+    assert fake_openai.request_count == requests_before + 1
+    assert speculation.SPECULATION_STATS['skipped'] == skipped_before + 1
+    assert get_user('Ubudget').get('speculative_alternate') is None
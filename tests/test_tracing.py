@@ -0,0 +1,35 @@
+import json
+import threading
+
+from fakes import build_message_event
+
+
+# 1回のメッセージの処理について、段階ごとの時間とOpenAIの呼び出しのリトライ回数を記録します
+def test_trace_breaks_down_each_stage(dynamodb, fake_openai, line_recorder, monkeypatch):
+    import lambda_function
+    import tracing
+    traces = []
+    monkeypatch.setattr(tracing, 'TRACE_LISTENERS', [traces.append])
+    fake_openai.inject('429')
+    event = build_message_event('trace-1', 'Utrace', 'I like soccer.')
+    lambda_function.lambda_handler({'body': json.dumps({'events': [event]})}, None)
+
+    trace, = traces
+    breakdown = trace.breakdown()
+    for stage in ('dynamodb.get_user', 'history.build', 'openai.post_chat_completion', 'line.reply_message'):
+        assert stage in breakdown
+    assert max(breakdown.values()) <= trace.duration_ms
+    post, = [span for span in trace.spans if span['name'] == 'openai.post_chat_completion']
+    assert post['retries'] == 1
+    assert post['status_code'] == 200
+
+
+# リトライ回数はスレッドごとに記録し、他のスレッドの呼び出しで上書きされません
+def test_retry_count_is_per_thread():
+    from http_client import RetryingHttpClient
+    client = RetryingHttpClient()
+    client.last_retry_count = 2
+    thread = threading.Thread(target=lambda: setattr(client, 'last_retry_count', 5))
+    thread.start()
+    thread.join()
+    assert client.last_retry_count == 2
@@ -0,0 +1,71 @@
+import boto3
+import pytest
+from boto3.dynamodb.types import TypeSerializer
+
+import usage_aggregates
+from dynamodb_handler import DAILY_API_LIMIT
+from usage_aggregates import DynamoDBAggregateStore, InMemoryAggregateStore, apply_stream_records
+
+USAGE_DATE = '2024-04-01'
+SERIALIZER = TypeSerializer()
+
+
+def stream_record(event_id, table_name, event_name, new_image, old_image=None):
+    images = {'NewImage': {name: SERIALIZER.serialize(value) for name, value in new_image.items()}}
+    if old_image is not None:
+        images['OldImage'] = {name: SERIALIZER.serialize(value) for name, value in old_image.items()}
+    return {'eventID': event_id, 'eventName': event_name, 'dynamodb': images,
+            'eventSourceARN': f'arn:aws:dynamodb:us-east-1:123456789012:table/{table_name}/stream/0'}
+
+
+# ユーザー情報のapi_count_totalを順に変えたレコードです
+def usage_records(user_id, counts):
+    images = [{'line_user_id': user_id, 'last_used_date': USAGE_DATE, 'api_count_total': count, 'mode_code': 1}
+              for count in counts]
+    return [stream_record(f'{user_id}-usage-{index}', usage_aggregates.USER_TABLE_NAME, 'MODIFY', new, old)
+            for index, (old, new) in enumerate(zip(images, images[1:]))]
+
+
+def log_record(user_id, index):
+    return stream_record(f'{user_id}-log-{index}', usage_aggregates.LOG_TABLE_NAME, 'INSERT', {
+        'line_user_id': user_id, 'created_at': f'{USAGE_DATE} 12:00:{index:02d}.000#0000{index:04x}',
+        'mode_code': 1, 'latency_ms': 100})
+
+
+# 返金の後に再び利用しても、同じ利用日のユーザーは1回だけ数えます。キャッシュだけで返信したユーザーも数えます
+def test_users_are_counted_once_per_day_across_batches(dynamodb):
+    boto3.client('dynamodb').create_table(
+        TableName='usage_aggregates',
+        KeySchema=[{'AttributeName': 'aggregate_key', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'aggregate_key', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    batches = [
+        usage_records('Urefund', [0, 1, 0]) + [log_record('Urefund', 0)],
+        usage_records('Urefund', [0, 1]) + [log_record('Urefund', 1)],
+        usage_records('Ulimit', [DAILY_API_LIMIT - 1, DAILY_API_LIMIT, DAILY_API_LIMIT - 1]),
+        usage_records('Ulimit', [DAILY_API_LIMIT - 1, DAILY_API_LIMIT]) + [log_record('Ulimit', 2)],
+        # キャッシュから返信した場合は利用回数が増えず、ログだけが追加されます
+        [log_record('Ucached', 3)],
+    ]
+    for store in (DynamoDBAggregateStore('usage_aggregates'), InMemoryAggregateStore()):
+        for records in batches:
+            assert apply_stream_records(records, store)
+        # 同じバッチの再試行では数えません
+        assert not apply_stream_records(batches[1], store)
+        day = store.get_day(USAGE_DATE)
+        assert day['active_users'] == 3
+        assert day['limit_reached_users'] == 1
+        assert day['messages'] == 4
+        assert day['api_calls'] == 2
+
+
+# Lambdaではメモリに保存した集計が失われるため、テーブルの設定を必須にします
+def test_lambda_requires_aggregate_table(monkeypatch):
+    monkeypatch.setattr(usage_aggregates, 'USAGE_AGGREGATE_TABLE_NAME', None)
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', 'usage-stream')
+    with pytest.raises(ValueError):
+        usage_aggregates.create_aggregate_store()
+
+    monkeypatch.delenv('AWS_LAMBDA_FUNCTION_NAME')
+    assert isinstance(usage_aggregates.create_aggregate_store(), InMemoryAggregateStore)
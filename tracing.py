@@ -0,0 +1,185 @@
+import contextlib
+import cProfile
+import functools
+import inspect
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+
+from metrics import log_metrics, to_json_value
+
+# トレースの出力形式です（json / emf / off）。emfの場合はCloudWatchの埋め込みメトリクス形式で出力します
+TRACE_OUTPUT = os.environ.get('TRACE_OUTPUT', 'json')
+TRACE_NAMESPACE = os.environ.get('TRACE_NAMESPACE', 'LineEnglishBot')
+# cProfileでプロファイルを取るトレースの割合です（0で無効）
+TRACE_PROFILE_SAMPLE_RATE = float(os.environ.get('TRACE_PROFILE_SAMPLE_RATE', '0'))
+TRACE_PROFILE_TOP_N = int(os.environ.get('TRACE_PROFILE_TOP_N', '20'))
+
+# 実行中のトレースはスレッドごとに保持します
+CURRENT_TRACE = threading.local()
+# 完了したトレースを受け取る関数です。ベンチマークなどで段階ごとの時間を集計するのに使います
+TRACE_LISTENERS = []
+
+
+# 1回の処理の間に記録した区間をまとめるクラス
+class Trace:
+    # コンストラクタでトレースの名前と属性を初期化します
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.spans = []
+        self.stack = []
+        self.duration_ms = None
+        self.started_at = time.perf_counter()
+
+    # 段階の名前ごとに、かかった時間の合計（ミリ秒）を返します。入れ子の区間の時間は外側の区間にも含まれます
+    def breakdown(self):
+        totals = {}
+        for span in self.spans:
+            totals[span['name']] = round(totals.get(span['name'], 0) + span['duration_ms'], 3)
+        return totals
+
+    # ログに出力する形式に変換します
+    def to_record(self):
+        return dict(self.attributes, trace=self.name, duration_ms=self.duration_ms,
+                    breakdown=self.breakdown(), spans=self.spans)
+
+    # トレースを開始してからの経過時間（ミリ秒）を返します
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self.started_at) * 1000, 3)
+
+
+# 実行中のトレースを返します。トレースの外ではNoneを返します
+def get_current_trace():
+    return getattr(CURRENT_TRACE, 'trace', None)
+
+
+# このスレッドで実行中のトレースを設定します。処理の途中で別のスレッドに移る場合に、移った先で呼び出します
+def set_current_trace(trace):
+    CURRENT_TRACE.trace = trace
+
+
+# トレースを開始します。終了時に記録した区間を出力し、完了したトレースを受け取る関数に渡します
+@contextlib.contextmanager
+def start_trace(name, **attributes):
+    trace = Trace(name, attributes)
+    previous = get_current_trace()
+    CURRENT_TRACE.trace = trace
+    profiler = None
+    if TRACE_PROFILE_SAMPLE_RATE > 0 and random.random() < TRACE_PROFILE_SAMPLE_RATE:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    trace.started_at = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace.duration_ms = trace.elapsed_ms()
+        CURRENT_TRACE.trace = previous
+        # トレースの出力に失敗しても、メッセージの処理は失敗させません
+        try:
+            if profiler is not None:
+                profiler.disable()
+                emit_profile(trace, profiler)
+            emit_trace(trace)
+            for listener in TRACE_LISTENERS:
+                listener(trace)
+        except Exception as e:
+            print(f"Error while emitting trace: {e}")
+
+
+# 区間の時間を記録します。トレースの外では何もしません
+@contextlib.contextmanager
+def span(name, **attributes):
+    trace = get_current_trace()
+    if trace is None:
+        yield None
+        return
+    record = dict(attributes, name=name, depth=len(trace.stack))
+    trace.spans.append(record)
+    trace.stack.append(record)
+    started_at = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record['duration_ms'] = round((time.perf_counter() - started_at) * 1000, 3)
+        trace.stack.pop()
+
+
+# 実行中の区間に属性（トークン数やリトライ回数など）を追加します。トレースの外では何もしません
+def set_span_attributes(**attributes):
+    trace = get_current_trace()
+    if trace is not None and trace.stack:
+        trace.stack[-1].update(attributes)
+
+
+# トレース全体に属性（モードコードなど）を追加します。トレースの外では何もしません
+def set_trace_attributes(**attributes):
+    trace = get_current_trace()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+# メソッドの呼び出しを区間として記録するデコレータです
+# ステップをyieldするジェネレータの場合は、途中で通信を待つ時間も含めて最後まで実行した時間を記録します
+def traced(name):
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def steps_wrapper(*args, **kwargs):
+                with span(name):
+                    return (yield from function(*args, **kwargs))
+            return steps_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# 完了したトレースを設定された形式で出力します
+def emit_trace(trace):
+    if TRACE_OUTPUT == 'off':
+        return
+    if TRACE_OUTPUT == 'emf':
+        print(json.dumps(build_emf_record(trace), ensure_ascii=False, default=to_json_value))
+    else:
+        log_metrics('trace', **trace.to_record())
+
+
+# CloudWatchの埋め込みメトリクス形式のレコードを作成します。段階ごとの時間をモードコードの次元で記録します
+def build_emf_record(trace):
+    breakdown = trace.breakdown()
+    metrics = [{'Name': 'duration_ms', 'Unit': 'Milliseconds'}]
+    metrics += [{'Name': f'{name}_ms', 'Unit': 'Milliseconds'} for name in breakdown]
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': TRACE_NAMESPACE,
+                'Dimensions': [['trace', 'mode_code']],
+                'Metrics': metrics
+            }]
+        },
+        'trace': trace.name,
+        'mode_code': str(trace.attributes.get('mode_code')),
+        'duration_ms': trace.duration_ms,
+        'spans': trace.spans
+    }
+    record.update({f'{name}_ms': duration_ms for name, duration_ms in breakdown.items()})
+    return record
+
+
+# プロファイルの結果のうち、累積時間の長い関数を出力します
+def emit_profile(trace, profiler):
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(TRACE_PROFILE_TOP_N)
+    log_metrics('profile', trace=trace.name, duration_ms=trace.duration_ms, stats=output.getvalue())
@@ -0,0 +1,45 @@
+import collections
+import threading
+import time
+
+
+# 有効期限付きのLRUキャッシュを管理するクラス
+class TTLCache:
+    # コンストラクタで最大件数と有効期限（秒）を初期化します
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    # キャッシュが有効かどうかを返します
+    def enabled(self):
+        return self.max_size > 0 and self.ttl_seconds > 0
+
+    # キーに対応する値を取得します。期限切れまたは存在しない場合はNoneを返します
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    # キーと値を保存します。最大件数を超えた場合は最も古い項目を削除します
+    def set(self, key, value):
+        if not self.enabled():
+            return
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl_seconds, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    # キーに対応する値を削除します
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
@@ -0,0 +1,331 @@
+# ユーザーとログのテーブルの変更（DynamoDB Streamsのレコード）から、利用日ごとの利用状況の集計を更新します
+# 集計は利用日ごとに1つの項目にまとめるため、ダッシュボードはテーブルをScanせずに1回の読み込みで表示できます
+# 実行方法: python usage_aggregates.py replay 記録したレコード.jsonl [--batch-size N]
+#           python usage_aggregates.py show 利用日（YYYY-MM-DD）
+import argparse
+import collections
+import datetime
+import decimal
+import hashlib
+import json
+import os
+import threading
+import time
+
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+from dynamodb_handler import DAILY_API_LIMIT, get_dynamodb_resource, get_usage_date
+
+# 集計を保存するテーブルです（パーティションキー: aggregate_key）。未設定の場合はプロセス内のメモリに保存します
+USAGE_AGGREGATE_TABLE_NAME = os.environ.get('USAGE_AGGREGATE_TABLE_NAME')
+USER_TABLE_NAME = os.environ.get('USER_TABLE_NAME')
+LOG_TABLE_NAME = os.environ.get('LOG_TABLE_NAME')
+# 処理済みのバッチの記録を保持する秒数です（DynamoDBのTTLで削除されます）。Lambdaが同じバッチを再試行する間だけ残れば十分です
+AGGREGATE_BATCH_TTL_SECONDS = int(os.environ.get('AGGREGATE_BATCH_TTL_SECONDS', str(24 * 60 * 60)))
+# ユーザーを利用日ごとに1回だけ数えるための記録を保持する秒数です。利用日とStreamsの保持期間（24時間）が過ぎるまで残します
+AGGREGATE_USER_DAY_TTL_SECONDS = int(os.environ.get('AGGREGATE_USER_DAY_TTL_SECONDS', str(3 * 24 * 60 * 60)))
+# 応答時間のヒストグラムの区切り（ミリ秒）です
+LATENCY_BUCKETS_MS = (250, 500, 1000, 2000, 4000, 8000, 16000)
+# TransactWriteItemsで1回に書き込める最大件数です
+TRANSACT_WRITE_LIMIT = 100
+# ログのcreated_atの先頭の日時の形式（日本時間）です。以降のミリ秒と接尾辞は使いません
+CREATED_AT_FORMAT = '%Y-%m-%d %H:%M:%S'
+# 集計に使う属性です
+LOG_ATTRIBUTES = ('line_user_id', 'created_at', 'mode_code', 'latency_ms')
+USER_ATTRIBUTES = ('line_user_id', 'last_used_date', 'api_count_total', 'mode_code')
+
+DESERIALIZER = TypeDeserializer()
+
+
+# 利用日の集計の項目のキーを返します
+def get_day_key(usage_date):
+    return f'day#{usage_date}'
+
+
+# ユーザーを利用日ごとに1回だけ数えたことの記録の項目のキーを返します
+def get_user_day_key(usage_date, name, user_id):
+    return f'user#{usage_date}#{name}#{user_id}'
+
+
+# 応答時間が入るヒストグラムの区間の名前を返します
+def get_latency_bucket(latency_ms):
+    for bound in LATENCY_BUCKETS_MS:
+        if latency_ms <= bound:
+            return f'le_{bound}'
+    return 'le_inf'
+
+
+# Streamsのレコードの送信元のテーブル名を返します（例: arn:aws:dynamodb:...:table/logs/stream/...）
+def get_table_name(record):
+    return record.get('eventSourceARN', '').split(':table/', 1)[-1].split('/', 1)[0]
+
+
+# Streamsのレコードの画像（AttributeValueの形式）のうち、集計に使う属性を通常の値に変換します
+# 圧縮したテキストなどのバイナリはLambdaのイベントではBase64の文字列になっているため、変換しません
+def deserialize_image(image, names):
+    return {name: DESERIALIZER.deserialize(image[name]) for name in names if name in (image or {})}
+
+
+# ログの追加から、利用日とモードごとのメッセージ数と応答時間を数えます
+# メッセージを送ったユーザーは、キャッシュや生成済みの講義で返信した場合も含めて、利用したユーザーとしてuser_daysに記録します
+def add_log_counts(counters, user_days, image):
+    created_at = image.get('created_at')
+    if not created_at:
+        return
+    usage_date = get_usage_date(datetime.datetime.strptime(created_at[:19], CREATED_AT_FORMAT))
+    mode = int(image.get('mode_code', 0))
+    counts = counters[usage_date]
+    counts['messages'] += 1
+    counts[f'mode_{mode}_messages'] += 1
+    if image.get('latency_ms') is not None:
+        latency_ms = int(image['latency_ms'])
+        counts[f'mode_{mode}_latency_count'] += 1
+        counts[f'mode_{mode}_latency_sum_ms'] += latency_ms
+        counts[f'mode_{mode}_latency_{get_latency_bucket(latency_ms)}'] += 1
+    if image.get('line_user_id'):
+        user_days.add((usage_date, 'active_users', image['line_user_id']))
+
+
+# ユーザー情報の変更から、利用日ごとのAPIの利用回数を数え、上限に達したユーザーをuser_daysに記録します
+def add_usage_counts(counters, user_days, old_image, new_image):
+    usage_date = new_image.get('last_used_date')
+    if not usage_date:
+        return
+    new_count = int(new_image.get('api_count_total', 0))
+    # 利用日が変わった場合は、update_user_usageと同じく回数が0から数え直されています
+    old_count = int(old_image.get('api_count_total', 0)) if old_image.get('last_used_date') == usage_date else 0
+    delta = new_count - old_count
+    if delta == 0:
+        return
+    mode = int(new_image.get('mode_code', 0))
+    counts = counters[usage_date]
+    # 返金（refund_user_usage）で回数が減った場合は、その分を差し引きます
+    counts['api_calls'] += delta
+    counts[f'mode_{mode}_api_calls'] += delta
+    # 返金の後に再び上限に達した場合も、同じ利用日には1回だけ数えます
+    if old_count < DAILY_API_LIMIT <= new_count and new_image.get('line_user_id'):
+        user_days.add((usage_date, 'limit_reached_users', new_image['line_user_id']))
+
+
+# Streamsのレコードを利用日ごとのカウンタにまとめます。書き込みの回数を減らすため、バッチの中で先に合計します
+# ユーザー数は、(利用日, カウンタの名前, ユーザーID)の集合として別に返し、保存先で利用日ごとに1回だけ数えます
+def aggregate_records(records):
+    counters = collections.defaultdict(collections.Counter)
+    user_days = set()
+    for record in records:
+        table_name = get_table_name(record)
+        event_name = record.get('eventName')
+        images = record.get('dynamodb', {})
+        # ログのキーは一意なので、追加（INSERT）だけを数えます。有効期限による削除（REMOVE）では、過去の集計を減らしません
+        if table_name == LOG_TABLE_NAME and event_name == 'INSERT':
+            add_log_counts(counters, user_days, deserialize_image(images.get('NewImage'), LOG_ATTRIBUTES))
+        elif table_name == USER_TABLE_NAME and event_name in ('INSERT', 'MODIFY'):
+            add_usage_counts(counters, user_days, deserialize_image(images.get('OldImage'), USER_ATTRIBUTES),
+                             deserialize_image(images.get('NewImage'), USER_ATTRIBUTES))
+    # 差し引きで0になったカウンタは書き込みません
+    counters = {usage_date: {name: value for name, value in counts.items() if value}
+                for usage_date, counts in counters.items() if any(counts.values())}
+    return counters, user_days
+
+
+# バッチのIDを返します。Lambdaが同じバッチを再試行した場合は同じIDになります
+def get_batch_id(records):
+    digest = hashlib.sha256()
+    for record in records:
+        digest.update(record.get('eventID', '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+# Streamsのレコードのバッチを集計に反映します。反映した場合はTrue、処理済みのバッチの場合はFalseを返します
+def apply_stream_records(records, store):
+    if not records:
+        return False
+    counters_by_date, user_days = aggregate_records(records)
+    return store.apply(get_batch_id(records), counters_by_date, user_days)
+
+
+# 集計をDynamoDBのテーブルに保存するクラス
+class DynamoDBAggregateStore:
+    # コンストラクタでテーブル名を初期化します
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    # カウンタを加算します。処理済みのバッチの記録と同じトランザクションで書き込むため、再試行で二重に数えません
+    # ユーザー数は、ユーザーと利用日ごとの記録と同じトランザクションで加算し、別のバッチでも二重に数えません
+    def apply(self, batch_id, counters_by_date, user_days=()):
+        # リソースのクライアントは、put_itemなどと同じく通常の値をAttributeValueの形式に変換します
+        client = get_dynamodb_resource().meta.client
+        dates = sorted(counters_by_date)
+        applied = False
+        # 記録の項目の分を除いた件数ずつ書き込みます（1回のバッチの利用日は通常1〜2日です）
+        for index in range(0, max(1, len(dates)), TRANSACT_WRITE_LIMIT - 1):
+            items = [self.build_marker(f'batch#{batch_id}#{index}', AGGREGATE_BATCH_TTL_SECONDS)]
+            items += [self.build_update(usage_date, counters_by_date[usage_date])
+                      for usage_date in dates[index:index + TRANSACT_WRITE_LIMIT - 1]]
+            applied = self.transact(client, items) or applied
+        # バッチの途中で失敗して再試行された場合も、まだ数えていないユーザーだけを数えます
+        for usage_date, name, user_id in sorted(user_days):
+            items = [self.build_marker(get_user_day_key(usage_date, name, user_id), AGGREGATE_USER_DAY_TTL_SECONDS),
+                     self.build_update(usage_date, {name: 1})]
+            applied = self.transact(client, items) or applied
+        return applied
+
+    # トランザクションで書き込みます。最初の項目の記録が既にある場合は書き込まずにFalseを返します
+    def transact(self, client, items):
+        try:
+            client.transact_write_items(TransactItems=items)
+            return True
+        except ClientError as e:
+            reasons = e.response.get('CancellationReasons') or []
+            if not reasons or reasons[0].get('Code') != 'ConditionalCheckFailed':
+                raise
+            return False
+
+    # 処理済みであることの記録を作成する書き込みです。記録は有効期限の後にDynamoDBのTTLで削除されます
+    def build_marker(self, aggregate_key, ttl_seconds):
+        return {'Put': {
+            'TableName': self.table_name,
+            'Item': {
+                'aggregate_key': aggregate_key,
+                'expires_at': int(time.time()) + ttl_seconds,
+            },
+            'ConditionExpression': 'attribute_not_exists(aggregate_key)',
+        }}
+
+    # 利用日の項目のカウンタを加算する書き込みです
+    def build_update(self, usage_date, counts):
+        names = {f'#c{index}': name for index, name in enumerate(counts)}
+        values = {f':c{index}': value for index, value in enumerate(counts.values())}
+        return {'Update': {
+            'TableName': self.table_name,
+            'Key': {'aggregate_key': get_day_key(usage_date)},
+            'UpdateExpression': 'ADD ' + ', '.join(f'#c{index} :c{index}' for index in range(len(counts))),
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values,
+        }}
+
+    # 利用日の集計を1回の読み込みで取得します
+    def get_day(self, usage_date):
+        table = get_dynamodb_resource().Table(self.table_name)
+        item = table.get_item(Key={'aggregate_key': get_day_key(usage_date)}).get('Item') or {}
+        return {name: int(value) for name, value in item.items() if isinstance(value, decimal.Decimal)}
+
+
+# ローカルテスト用に集計をメモリに保存するクラス
+class InMemoryAggregateStore:
+    # コンストラクタで空の集計を初期化します
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.days = collections.defaultdict(collections.Counter)
+        self.batch_ids = set()
+        self.user_days = set()
+
+    # カウンタを加算します。処理済みのバッチと、数えたユーザーは二重に数えません
+    def apply(self, batch_id, counters_by_date, user_days=()):
+        with self.lock:
+            new_user_days = set(user_days) - self.user_days
+            if batch_id in self.batch_ids and not new_user_days:
+                return False
+            if batch_id not in self.batch_ids:
+                self.batch_ids.add(batch_id)
+                for usage_date, counts in counters_by_date.items():
+                    self.days[usage_date].update(counts)
+            for usage_date, name, _ in new_user_days:
+                self.days[usage_date][name] += 1
+            self.user_days |= new_user_days
+            return True
+
+    # 利用日の集計を取得します
+    def get_day(self, usage_date):
+        with self.lock:
+            return dict(self.days.get(usage_date, {}))
+
+
+# 環境変数の設定に応じた集計の保存先を作成します
+# Lambdaではメモリに保存した集計が実行環境ごとに分かれて失われるため、テーブルの設定を必須にします
+def create_aggregate_store():
+    if USAGE_AGGREGATE_TABLE_NAME:
+        return DynamoDBAggregateStore(USAGE_AGGREGATE_TABLE_NAME)
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        raise ValueError("USAGE_AGGREGATE_TABLE_NAME is required when running on AWS Lambda")
+    print("Warning: USAGE_AGGREGATE_TABLE_NAME is not set; aggregates are kept in memory and lost when the process exits")
+    return InMemoryAggregateStore()
+
+
+# ヒストグラムから百分位数の上限（ミリ秒）を見積もります。最後の区間に入る場合はNoneを返します
+def estimate_percentile(histogram, ratio):
+    total = sum(histogram.values())
+    if total == 0:
+        return None
+    rank = total * ratio
+    seen = 0
+    for bound in LATENCY_BUCKETS_MS:
+        seen += histogram.get(f'le_{bound}', 0)
+        if seen >= rank:
+            return bound
+    return None
+
+
+# 利用日の集計の項目を、ダッシュボードに表示する形式に変換します
+def summarize_day(counts):
+    modes = sorted({int(name.split('_')[1]) for name in counts if name.startswith('mode_')})
+    summary = {name: counts.get(name, 0) for name in ('active_users', 'api_calls', 'messages', 'limit_reached_users')}
+    summary['modes'] = {}
+    for mode in modes:
+        prefix = f'mode_{mode}_'
+        histogram = {bucket: counts.get(f'{prefix}latency_{bucket}', 0)
+                     for bucket in [f'le_{bound}' for bound in LATENCY_BUCKETS_MS] + ['le_inf']}
+        latency_count = counts.get(f'{prefix}latency_count', 0)
+        summary['modes'][mode] = {
+            'messages': counts.get(f'{prefix}messages', 0),
+            'api_calls': counts.get(f'{prefix}api_calls', 0),
+            'latency_mean_ms': round(counts.get(f'{prefix}latency_sum_ms', 0) / latency_count, 1) if latency_count else None,
+            'latency_p50_ms': estimate_percentile(histogram, 0.50),
+            'latency_p95_ms': estimate_percentile(histogram, 0.95),
+            'latency_histogram': histogram,
+        }
+    return summary
+
+
+# 記録したStreamsのレコード（1行に1レコードのJSON）を読み込みます
+def load_recorded_records(path):
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+# 記録したレコードを、Lambdaと同じようにバッチに分けて集計に反映します。反映したバッチ数を返します
+def replay(records, store, batch_size=100):
+    applied = 0
+    for index in range(0, len(records), batch_size):
+        if apply_stream_records(records[index:index + batch_size], store):
+            applied += 1
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    replay_parser = subparsers.add_parser('replay', help='記録したレコードを集計に反映します')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--batch-size', type=int, default=100)
+    show_parser = subparsers.add_parser('show', help='利用日の集計を表示します')
+    show_parser.add_argument('usage_date')
+    args = parser.parse_args()
+
+    store = create_aggregate_store()
+    if args.command == 'replay':
+        records = load_recorded_records(args.path)
+        batches = replay(records, store, args.batch_size)
+        print(f"applied {batches} batches ({len(records)} records)")
+        # メモリに保存した場合は、プロセスの終了で失われるため集計をすべて表示します
+        if isinstance(store, InMemoryAggregateStore):
+            for usage_date in sorted(store.days):
+                print(json.dumps({usage_date: summarize_day(store.get_day(usage_date))}, ensure_ascii=False))
+    else:
+        print(json.dumps(summarize_day(store.get_day(args.usage_date)), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import uuid
+
+from dynamodb_handler import DAILY_API_LIMIT, USAGE_LIMIT_MESSAGE, UsageLimitExceeded, get_usage_date
+from lecture_pool import LECTURE_POOL_MAX
+
+DEFAULT_MODE_CODE = 0
+# セッションごとにリセットする属性と初期値です
+SESSION_ATTRIBUTES = {
+    'history_summary': '',
+    'history_summary_until': '',
+    'presentation_plan': None,
+    'presentation_index': 0,
+    'presentation_notes': [],
+    'speculative_alternate': None,
+    'feedback_chunks': [],
+    'feedback_turns': 0,
+}
+
+
+# 1回のリクエストの間、ユーザー情報を保持し、変更をまとめて書き込むクラス
+class UserState:
+    # コンストラクタでユーザー情報を1回だけ読み込みます
+    def __init__(self, dynamodb_handler, user_id):
+        self.dynamodb_handler = dynamodb_handler
+        self.user_id = user_id
+        self.item = dynamodb_handler.get_user(user_id)
+        self.mode_code = self.item.get('mode_code', DEFAULT_MODE_CODE) if self.item is not None else DEFAULT_MODE_CODE
+        self.session_id = self.item.get('session_id') if self.item is not None else None
+        # まだ書き込まれていない属性の変更です
+        self.pending_attributes = {}
+        # 返信の後に行うために保留した、会話履歴の要約と、先読みや回答の評価のジョブです
+        self.pending_history_fold = None
+        self.pending_jobs = []
+
+    # モードコードを変更します。書き込みはflushまたはadd_usageの時にまとめて行います
+    def set_mode_code(self, mode_code):
+        if mode_code != self.mode_code:
+            self.mode_code = mode_code
+            self.pending_attributes['mode_code'] = mode_code
+
+    # モードに入った時に新しいセッションを開始します。会話履歴の要約などのセッションごとの属性もリセットします
+    def start_session(self):
+        self.session_id = uuid.uuid4().hex
+        self.pending_attributes['session_id'] = self.session_id
+        self.pending_attributes.update(SESSION_ATTRIBUTES)
+
+    # セッションごとの属性を取得します。書き込まれていない変更があればそれを返します
+    def get_session_value(self, name):
+        if name in self.pending_attributes:
+            return self.pending_attributes[name]
+        return (self.item or {}).get(name, SESSION_ATTRIBUTES[name])
+
+    # セッションごとの属性を変更します。書き込みはflushまたはadd_usageの時にまとめて行います
+    def set_session_value(self, name, value):
+        self.pending_attributes[name] = value
+
+    # 今日の利用回数を取得します
+    def get_api_count(self):
+        if self.item is None or self.item.get('last_used_date') != get_usage_date():
+            return 0
+        return self.item.get('api_count_total', 0)
+
+    # 利用回数を加算します。保留中の変更も同じ書き込みで反映します
+    def add_usage(self, api_count):
+        # 読み込み済みの回数で上限に達している場合はDynamoDBを呼び出さずに終了します
+        if self.get_api_count() + api_count > DAILY_API_LIMIT:
+            raise UsageLimitExceeded(USAGE_LIMIT_MESSAGE)
+        extra_attributes = {name: value for name, value in self.pending_attributes.items() if name != 'mode_code'}
+        self.item = self.dynamodb_handler.update_user_usage(self.user_id, api_count, self.mode_code, extra_attributes)
+        self.pending_attributes = {}
+
+    # ユーザーが受けた講義のIDのリストを取得します
+    def get_served_lectures(self, mode_code):
+        name = f'served_lectures_{mode_code}'
+        if name in self.pending_attributes:
+            return self.pending_attributes[name]
+        return (self.item or {}).get(name, [])
+
+    # ユーザーが受けた講義として記録します。古い記録はストックの最大数を超えた分だけ削除します
+    def mark_lecture_served(self, mode_code, lecture_id):
+        served = self.get_served_lectures(mode_code) + [lecture_id]
+        self.pending_attributes[f'served_lectures_{mode_code}'] = served[-LECTURE_POOL_MAX:]
+
+    # 加算した利用回数を戻します
+    def refund_usage(self, api_count):
+        item = self.dynamodb_handler.refund_user_usage(self.user_id, api_count)
+        if item is not None:
+            self.item = item
+
+    # 会話履歴の要約を保存します。書き込みはflushの時にまとめて行います
+    def set_history_summary(self, summary, summary_until):
+        self.set_session_value('history_summary', summary)
+        self.set_session_value('history_summary_until', summary_until)
+
+    # 書き込まれていない変更があればDynamoDBに反映します
+    def flush(self):
+        if self.pending_attributes:
+            self.item = self.dynamodb_handler.update_user_attributes(self.user_id, self.pending_attributes)
+            self.pending_attributes = {}